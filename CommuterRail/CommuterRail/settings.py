@@ -70,6 +70,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'CommuterSchedule.profiling.ProfilingMiddleware', #Last, so the other middleware already ran when the view is profiled
 ]
 
 ROOT_URLCONF = 'CommuterRail.urls'
@@ -152,6 +153,70 @@ AUTH_USER_MODEL = 'CommuterUser.User'
 #MBTA
 MBTA_KEY = ""
 MBTA_URL = "https://api-v3.mbta.com"
+MBTA_ROUTE_CACHE_TTL = 6 * 60 * 60 #Seconds to reuse a station's route list before asking /routes again
+MBTA_COMBINED_PREDICTIONS = True #Fetch every station with one /predictions request and split it locally
+MBTA_FANOUT_WORKERS = 4 #Stations fetched at the same time when MBTA_COMBINED_PREDICTIONS is off
+MBTA_FANOUT_DEADLINE = 8 #Seconds a refresh waits for every station, late stations keep their previous board
+MBTA_HTTP_POOL_SIZE = 10 #Keep-alive connections shared by every MBTA call in a process
+MBTA_HTTP_CONNECT_TIMEOUT = 3.05 #Seconds
+MBTA_HTTP_READ_TIMEOUT = 10 #Seconds
+MBTA_HTTP_RETRIES = 2 #Retries after the first attempt on connection errors, timeouts, 429 and 5xx
+MBTA_HTTP_BACKOFF = 0.5 #Base seconds of the jittered exponential backoff
+MBTA_HTTP_BACKOFF_MAX = 4 #Upper bound of a single backoff sleep
+MBTA_RATE_LIMIT = 1000 / 60.0 #MBTA API calls per second shared by every worker process, keys allow 1000 per minute
+MBTA_RATE_LIMIT_BURST = 20 #Calls allowed back to back before the rate applies
+MBTA_RATE_LIMIT_MAX_WAIT = 10 #Seconds a call may wait for the rate limiter before giving up
+MBTA_RATE_LIMIT_FILE = os.path.join(BASE_DIR, ".mbta-ratelimit") #State shared by the worker processes, None to disable the limiter
+MBTA_STREAMING_PREDICTIONS = False #Keep the board up to date from the streaming /predictions feed instead of polling it
+MBTA_STREAM_READ_TIMEOUT = 60 #Seconds without any bytes before the stream is reconnected
+MBTA_STREAM_RECONNECT_DELAY = 5 #Seconds to wait before reconnecting a failed stream
+MBTA_STREAM_MAX_BACKOFF = 5 * 60 #Upper bound of the jittered backoff added to the reconnect delay while the API answers 429 or 5xx
+MBTA_GTFS_PATH = None #Local GTFS static feed (MBTA_GTFS.zip) used to look up station routes, /routes is asked when not set
+
+#Stations shown on the board: (board name, MBTA station id or name, title)
+COMMUTER_STATIONS = (
+    ("north_station", "place-north", "North Station"),
+    ("south_station", "South Station", "South Station"),
+)
+
+#Departure Board
+BOARD_REFRESH_INTERVAL = 15 #Seconds between background refreshes of the departure board
+BOARD_FIRST_REFRESH_TIMEOUT = 10 #Seconds a request waits for the first board of a new process
+BOARD_HISTORY_SIZE = 20 #Recent board versions kept so /page-info/ can answer with a delta
+BOARD_STREAM_HEARTBEAT = 15 #Seconds between heartbeats on /board-stream/ when the board doesn't change
+BOARD_STREAM_MAX_AGE = 5 * 60 #Seconds before a /board-stream/ connection is closed, browsers reconnect on their own
+BOARD_STREAM_QUEUE_SIZE = 16 #Board updates a /board-stream/ client may fall behind before it's disconnected
+BOARD_SCHEDULE_FALLBACK = True #Show the GTFS schedule (manage.py load_gtfs_schedule) for stations without realtime predictions
+BOARD_SCHEDULE_DEPARTURES = 10 #Scheduled departures shown per station
+BOARD_SHARED_PATH = None #Memory-mapped file the board is shared through by the worker processes of a node, e.g. /dev/shm/mbta-board
+BOARD_SHARED_SIZE = 1024 * 1024 #Bytes of the shared board file, the largest board that can be shared
+BOARD_SHARED_POLL_INTERVAL = 1 #Seconds between two reads of the shared board by the workers that don't fetch it
+BOARD_API_MAX_AGE = 5 #Seconds browsers and caches may reuse an /api/board/ answer without asking again
+BOARD_API_STALE_WHILE_REVALIDATE = BOARD_REFRESH_INTERVAL #Seconds past max-age a cache may serve the old answer while it revalidates
+
+#Prediction history
+HISTORY_DIR = None #Directory the predictions are recorded to, one gzip file per day, e.g. os.path.join(BASE_DIR, "history")
+HISTORY_RETENTION_DAYS = 90 #Days of history kept, older days are deleted
+HISTORY_FLUSH_INTERVAL = 60 #Seconds between two writes of the queued boards
+EXPORT_ALLOWED_IPS = ("127.0.0.1", "::1") #Clients allowed to download the history from /export/
+EXPORT_MAX_CONCURRENT = 2 #Exports streaming at once per worker process, each one holds a thread
+
+#Delay analytics
+ANALYTICS_ENABLED = BOARD_SHARED_PATH is not None #Keep delay quantiles and status counts per route, station and hour of week, served by /delays/. Only the worker refreshing the shared board records them, so with several workers it needs BOARD_SHARED_PATH, a single process (runserver) can turn it on alone
+ANALYTICS_PATH = os.path.join(BASE_DIR, ".delay-analytics.json") #Where they're saved to survive restarts, None to keep them in memory
+ANALYTICS_SAVE_INTERVAL = 60 #Seconds between two saves
+
+#Metrics
+METRICS_ALLOWED_IPS = ("127.0.0.1", "::1") #Clients allowed to scrape /metrics, each worker process reports its own
+
+#Profiling
+PROFILING_ENABLED = False #Profile a sample of the board requests, see CommuterSchedule.profiling
+PROFILING_SAMPLE_RATE = 1000 #Profile 1 in N requests, 0 to only profile requests with a signed X-Profile header
+PROFILING_URL_NAMES = ("home", "page_info") #Views that can be profiled
+PROFILING_DIR = os.path.join(BASE_DIR, "profiles") #Where .pstats and .collapsed files are written
+PROFILING_MAX_FILES = 200 #Oldest profiles are deleted past this many files...
+PROFILING_MAX_BYTES = 50 * 1024 * 1024 #...or past this many bytes
+PROFILING_TOKEN_MAX_AGE = 60 * 60 #Seconds an X-Profile token stays valid
 
 #Email Settings
 from CommuterRail.email_info import *
@@ -23,6 +23,12 @@ urlpatterns = [
     # url(r'^admin/', admin.site.urls), #REMOVED BECAUSE NO USER ACCESS NEEDED
     url(r'^$', schedule_views.index, name='home'),
     url(r'^page-info/$', schedule_views.get_page_info, name="page_info"),
+    url(r'^board-stream/$', schedule_views.board_stream, name="board_stream"),
+    url(r'^metrics$', schedule_views.metrics, name="metrics"),
+    url(r'^delays/$', schedule_views.delays, name="delays"),
+    url(r'^export/$', schedule_views.export, name="export"),
+    url(r'^api/board/$', schedule_views.board_api, name="board_api"),
+    url(r'^api/board/(?P<board>\w+)/$', schedule_views.board_api, name="station_board_api"),
 ]
 
 if settings.DEBUG:
@@ -0,0 +1,380 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+from django.utils import timezone
+from CommuterSchedule.utils import parse_iso8601
+
+logger = logging.getLogger(__name__)
+
+DEPARTED = "Departed"
+
+class DelaySketch(object):
+    """Mergeable quantile sketch of delays in seconds
+
+    Values are counted in logarithmic buckets, so any quantile is
+    estimated within `relative_accuracy` of the true value whatever the
+    distribution. Two sketches of the same accuracy merge by adding
+    their buckets, the result is the sketch of both sets of values.
+    Delays under a second (early or late) count as zero.
+
+    Args:
+        relative_accuracy (float): Relative error of the quantiles, e.g. 0.01 for 1%
+
+    """
+
+    __slots__ = ("relative_accuracy", "gamma", "_log_gamma", "positive", "negative", "zero", "count", "total", "minimum", "maximum")
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {} #bucket index -> count
+        self.negative = {} #bucket index of the absolute value -> count
+        self.zero = 0
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        """Function to add one delay, O(1)"""
+
+        if value >= 1:
+            index = int(math.ceil(math.log(value) / self._log_gamma))
+            self.positive[index] = self.positive.get(index, 0) + 1
+        elif value <= -1:
+            index = int(math.ceil(math.log(-value) / self._log_gamma))
+            self.negative[index] = self.negative.get(index, 0) + 1
+        else:
+            self.zero += 1
+
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def merge(self, other):
+        """Function to add the delays of another sketch of the same accuracy"""
+
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches of the same relative accuracy can be merged")
+
+        for buckets, others in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in others.items():
+                buckets[index] = buckets.get(index, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+            self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+
+    def value(self, index):
+        """Function to return the value a bucket stands for"""
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        """Function to estimate a quantile
+
+        Args:
+            q (float): Between 0 and 1, e.g. 0.9 for the p90
+
+        Returns:
+            The delay in seconds, None when the sketch is empty.
+        """
+
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True): #Most negative first
+            seen += self.negative[index]
+            if seen > rank:
+                return max(-self.value(index), self.minimum)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return min(self.value(index), self.maximum)
+        return self.maximum
+
+    def as_dict(self):
+        """Function to serialize the sketch for JSON"""
+
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": [[index, count] for index, count in self.positive.items()],
+            "negative": [[index, count] for index, count in self.negative.items()],
+            "zero": self.zero,
+            "count": self.count,
+            "total": self.total,
+            "minimum": self.minimum,
+            "maximum": self.maximum
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """Function to rebuild a sketch serialized by `as_dict`"""
+
+        sketch = cls(state["relative_accuracy"])
+        sketch.positive = dict((index, count) for index, count in state["positive"])
+        sketch.negative = dict((index, count) for index, count in state["negative"])
+        sketch.zero = state["zero"]
+        sketch.count = state["count"]
+        sketch.total = state["total"]
+        sketch.minimum = state["minimum"]
+        sketch.maximum = state["maximum"]
+        return sketch
+
+class DelayAnalytics(object):
+    """Delay and status statistics per route, station and hour of the week
+
+    `observe` takes every board as it's fetched. A prediction's delay is
+    how far its departure time moved from the first time it was on the
+    board, the realtime feed carries no schedule. It's added to the
+    sketch of its (route, board, hour of week) once, when the train
+    first departs or leaves the board, even if the feed flips it back to
+    Delayed and to Departed again. A prediction first seen already
+    Departed adds no delay, how late it left isn't known. Statuses are counted each time a
+    prediction enters one, e.g. Delayed.
+
+    The statistics are written to `path` every `save_interval` seconds,
+    with the predictions still on the board, so a restarted process
+    carries on with the trains it was following instead of counting them
+    again from the restart. Only one process may observe the boards, the
+    one refreshing them (see BOARD_SHARED_PATH): it loads the file once
+    when created and from then on only writes it. The other processes
+    are read-only and reload the file when it changed, so every worker
+    answers the same.
+
+    Args:
+        path (str): JSON file the statistics are kept in, None to keep them in memory
+        save_interval (float): Seconds between two writes of `path`
+        relative_accuracy (float): Relative error of the delay quantiles
+
+    """
+
+    def __init__(self, path=None, save_interval=60, relative_accuracy=0.01):
+        self.path = path
+        self.save_interval = save_interval
+        self.relative_accuracy = relative_accuracy
+        self.version = 0
+        self.observing = False #Set by the first `observe`, the file is then only written
+        self._sketches = {} #(route, board, hour of week) -> DelaySketch
+        self._statuses = {} #(route, board, hour of week) -> {status: count}
+        self._tracked = {} #(board, prediction_id) -> [key, first departure, last departure, status, delay recorded]
+        self._last_departures = None
+        self._summaries = {}
+        self._saved_at = time.time()
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
+        self.reload() #Pick up where the last process left off
+
+    def observe(self, departures):
+        """Function to update the statistics with a fetched board
+
+        Args:
+            departures (dict): Board name to `StationBoard` or None
+        """
+
+        with self._lock:
+            self.observing = True
+            if departures is self._last_departures: #Reused after a 304, nothing moved
+                return
+            self._last_departures = departures
+
+            seen = set()
+            for board, station_board in departures.items():
+                for prediction in station_board or ():
+                    tracked_id = (board, prediction.prediction_id)
+                    seen.add(tracked_id)
+                    tracked = self._tracked.get(tracked_id)
+                    if tracked is None:
+                        departure = timezone.localtime(prediction.departure_time)
+                        key = (prediction.route_id, board, departure.weekday() * 24 + departure.hour)
+                        departed = prediction.status == DEPARTED #Left before we saw it, its delay is unknown
+                        tracked = self._tracked[tracked_id] = [key, prediction.departure_time, None, None, departed]
+
+                    tracked[2] = prediction.departure_time
+                    if prediction.status != tracked[3]:
+                        tracked[3] = prediction.status
+                        if prediction.status:
+                            statuses = self._statuses.setdefault(tracked[0], {})
+                            statuses[prediction.status] = statuses.get(prediction.status, 0) + 1
+                        if prediction.status == DEPARTED and not tracked[4]:
+                            self._add_delay(tracked)
+
+            for tracked_id in [tracked_id for tracked_id in self._tracked if tracked_id not in seen]:
+                tracked = self._tracked.pop(tracked_id)
+                if not tracked[4]:
+                    self._add_delay(tracked)
+
+            self.version += 1
+            self._summaries = {}
+
+        if self.path and time.time() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def _add_delay(self, tracked):
+        key, first, last = tracked[:3]
+        sketch = self._sketches.get(key)
+        if sketch is None:
+            sketch = self._sketches[key] = DelaySketch(self.relative_accuracy)
+        sketch.add((last - first).total_seconds())
+        tracked[4] = True
+
+    def summary(self, route=None, station=None, weekday=None, hour=None):
+        """Function to merge the statistics matching a filter
+
+        Args:
+            route (str): MBTA route id, e.g. CR-Providence
+            station (str): Board name, e.g. south_station
+            weekday (int): 0 for Monday to 6 for Sunday
+            hour (int): 0 to 23, local time of the departure
+
+        Returns:
+            The Dictionary of the filter, the number of departures, the
+            delay quantiles in seconds and the status counts. Answers are
+            cached until the statistics change.
+        """
+
+        self.reload()
+
+        query = (route, station, weekday, hour)
+        summary = self._summaries.get(query)
+        if summary is not None:
+            return summary
+
+        with self._lock:
+            merged = DelaySketch(self.relative_accuracy)
+            statuses = {}
+            for key in set(self._sketches) | set(self._statuses):
+                key_route, key_station, hour_of_week = key
+                if (route is not None and key_route != route) or (station is not None and key_station != station) \
+                        or (weekday is not None and hour_of_week // 24 != weekday) or (hour is not None and hour_of_week % 24 != hour):
+                    continue
+                if key in self._sketches:
+                    merged.merge(self._sketches[key])
+                for status, count in self._statuses.get(key, {}).items():
+                    statuses[status] = statuses.get(status, 0) + count
+
+            summary = {
+                "route": route,
+                "station": station,
+                "weekday": weekday,
+                "hour": hour,
+                "departures": merged.count,
+                "delay_seconds": {
+                    "mean": merged.total / merged.count if merged.count else None,
+                    "min": merged.minimum,
+                    "p50": merged.quantile(0.5),
+                    "p90": merged.quantile(0.9),
+                    "p99": merged.quantile(0.99),
+                    "max": merged.maximum
+                },
+                "statuses": statuses,
+                "version": self.version
+            }
+            self._summaries[query] = summary
+
+        return summary
+
+    def state(self):
+        """Function to serialize the statistics and the predictions being tracked for JSON"""
+
+        with self._lock:
+            return {
+                "relative_accuracy": self.relative_accuracy,
+                "keys": [
+                    {
+                        "route": key[0],
+                        "station": key[1],
+                        "hour_of_week": key[2],
+                        "delays": self._sketches[key].as_dict() if key in self._sketches else None,
+                        "statuses": self._statuses.get(key, {})
+                    }
+                    for key in sorted(set(self._sketches) | set(self._statuses))
+                ],
+                "tracked": [
+                    {
+                        "board": board,
+                        "prediction_id": prediction_id,
+                        "route": key[0],
+                        "hour_of_week": key[2],
+                        "first": first.isoformat(),
+                        "last": last.isoformat(),
+                        "status": status,
+                        "recorded": recorded
+                    }
+                    for (board, prediction_id), (key, first, last, status, recorded) in sorted(self._tracked.items())
+                ]
+            }
+
+    def save(self):
+        """Function to write the statistics to `path`, atomically"""
+
+        temporary = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(temporary, "w") as state_file:
+                json.dump(self.state(), state_file)
+            os.rename(temporary, self.path)
+            self._loaded_mtime = os.stat(self.path).st_mtime #Our own write, nothing to reload
+        except (IOError, OSError):
+            logger.exception("Couldn't save the delay analytics to %s", self.path)
+        self._saved_at = time.time()
+
+    def reload(self):
+        """Function to load `path` when another process saved it since,
+        never once this process observes the boards itself
+
+        Returns:
+            True if the statistics were loaded.
+        """
+
+        if not self.path or self.observing:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError: #Nothing saved yet
+            return False
+        if mtime == self._loaded_mtime:
+            return False
+
+        try:
+            with open(self.path) as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            logger.exception("Couldn't load the delay analytics from %s", self.path)
+            return False
+
+        sketches, statuses = {}, {}
+        for entry in state["keys"]:
+            key = (entry["route"], entry["station"], entry["hour_of_week"])
+            if entry["delays"] is not None:
+                sketches[key] = DelaySketch.from_dict(entry["delays"])
+            if entry["statuses"]:
+                statuses[key] = entry["statuses"]
+        tracked = dict(
+            ((entry["board"], entry["prediction_id"]), [
+                (entry["route"], entry["board"], entry["hour_of_week"]),
+                parse_iso8601(entry["first"]),
+                parse_iso8601(entry["last"]),
+                entry["status"],
+                entry["recorded"]
+            ])
+            for entry in state.get("tracked", ()) #Files saved before the predictions were kept
+        )
+
+        with self._lock:
+            self._sketches, self._statuses, self._tracked = sketches, statuses, tracked
+            self.relative_accuracy = state["relative_accuracy"]
+            self._loaded_mtime = mtime
+            self.version += 1
+            self._summaries = {}
+        return True
@@ -0,0 +1,20 @@
+"""
+Microbenchmarks for the MBTA parsing pipeline. They run offline against
+the payloads in `data/`, from the CommuterRail directory, e.g.:
+
+    python -m CommuterSchedule.benchmarks.timestamps
+    python -m CommuterSchedule.benchmarks.pipeline --output results.json
+    python -m CommuterSchedule.benchmarks.broadcast --subscribers 10000
+"""
+import os
+import json
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+def load_payload(name):
+    """
+    Loads a JSON:API payload from `data/`, e.g. predictions.json.
+    """
+
+    with open(os.path.join(DATA_DIR, name)) as payload:
+        return json.load(payload)
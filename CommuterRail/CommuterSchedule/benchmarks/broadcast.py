@@ -0,0 +1,145 @@
+"""
+Load test of the /board-stream/ broadcast hub: N simulated subscribers
+follow the recorded board through a series of updates, a share of them
+never reading so they get evicted as slow consumers.
+
+    python -m CommuterSchedule.benchmarks.broadcast [--subscribers 10000] [--updates 50] [--output results.json]
+
+Reported per update:
+    encode_ms          `board_event` + `delta_event`, done once whatever the subscribers
+    publish_ms         queueing the shared bytes for every subscriber
+    us_per_subscriber  publish_ms per subscriber, should stay flat as subscribers grow
+    distinct_messages  distinct message objects queued per update, 2 when nothing is re-encoded
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+from CommuterSchedule.benchmarks import load_payload
+from CommuterSchedule.benchmarks.pipeline import scale_payload
+
+def boards(mbta, response, updates):
+    """
+    Returns `updates` + 1 departures dictionaries, each one with a
+    prediction delayed by another minute than in the previous one.
+    """
+
+    import datetime
+    from collections import OrderedDict
+    from CommuterSchedule.records import StationBoard
+
+    departures = mbta.normalize_predictions_response(response, mbta.stations)
+    stations = [board for board in departures if departures[board]]
+    sequence = [departures]
+    for update in range(updates):
+        departures = OrderedDict(departures)
+        station = stations[update % len(stations)]
+        predictions = list(departures[station])
+        index = update % len(predictions)
+        predictions[index] = predictions[index].replace(
+            departure_time=predictions[index].departure_time + datetime.timedelta(minutes=1), status="Delayed")
+        departures[station] = StationBoard.sorted(predictions)
+        sequence.append(departures)
+    return sequence
+
+def run(subscribers, updates, slow, predictions):
+    """
+    Publishes `updates` board versions to `subscribers` subscribers.
+
+    Returns:
+        The Dictionary written as JSON, see `main`.
+    """
+
+    from CommuterSchedule.board import BoardSnapshot, new_epoch
+    from CommuterSchedule.broadcast import BroadcastHub
+    from CommuterSchedule.mbta import MBTACommuterRail
+    from CommuterSchedule.views import board_event, delta_event
+
+    mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+    response = scale_payload(load_payload("predictions.json"), predictions)
+    epoch = new_epoch()
+    snapshots = [BoardSnapshot(departures, version, time.time(), epoch) for version, departures in enumerate(boards(mbta, response, updates), 1)]
+
+    hub = BroadcastHub()
+    clients = [hub.subscribe() for _ in range(subscribers)]
+    readers = [client for client in clients if random.random() >= slow] #The others never read
+
+    encoded = []
+    previous = None
+    results = []
+    for snapshot in snapshots:
+        started = time.time()
+        board = board_event(snapshot)
+        delta = delta_event(previous, snapshot) if previous is not None else None
+        encode = time.time() - started
+
+        started = time.time()
+        evicted = hub.publish(snapshot.tag, board, delta, previous.tag if previous is not None else None)
+        publish = time.time() - started
+
+        messages = set()
+        for client in readers: #What the client threads do, not timed
+            message = client.next(0)
+            if message:
+                messages.add(id(message))
+
+        encoded.append(len(board) + len(delta or b""))
+        results.append({
+            "version": snapshot.version,
+            "encode_ms": round(encode * 1e3, 3),
+            "publish_ms": round(publish * 1e3, 3),
+            "us_per_subscriber": round(publish * 1e6 / max(1, len(clients)), 3),
+            "distinct_messages": len(messages),
+            "evicted": evicted
+        })
+        previous = snapshot
+
+    updates_timed = results[1:] or results #The first full board has no delta
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "subscribers": subscribers,
+        "predictions": predictions,
+        "updates": len(results),
+        "encoded_bytes_per_update": sum(encoded) // len(encoded),
+        "median_encode_ms": sorted(result["encode_ms"] for result in updates_timed)[len(updates_timed) // 2],
+        "median_publish_ms": sorted(result["publish_ms"] for result in updates_timed)[len(updates_timed) // 2],
+        "max_distinct_messages": max(result["distinct_messages"] for result in results),
+        "stats": hub.stats(),
+        "results": results
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=10000, help="Simulated /board-stream/ clients")
+    parser.add_argument("--updates", type=int, default=50, help="Board versions published")
+    parser.add_argument("--slow", type=float, default=0.01, help="Share of subscribers that never read")
+    parser.add_argument("--predictions", type=int, default=100, help="Predictions on the board")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CommuterRail.settings")
+    import django
+    django.setup() #The events are encoded by the views
+
+    results = run(args.subscribers, args.updates, args.slow, args.predictions)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    sys.stderr.write("%d subscribers, %d predictions: encode %.3f ms once, publish %.3f ms (%.3f us/subscriber), %d evicted\n" % (
+        args.subscribers, args.predictions, results["median_encode_ms"], results["median_publish_ms"],
+        results["median_publish_ms"] * 1e3 / max(1, args.subscribers), results["stats"]["evicted"]))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
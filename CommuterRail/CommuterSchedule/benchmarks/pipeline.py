@@ -0,0 +1,197 @@
+"""
+Times each stage of the predictions pipeline on the recorded payload
+scaled to 10, 100, 1,000 and 10,000 predictions, and writes the results
+as JSON so two runs (e.g. two releases) can be compared.
+
+    python -m CommuterSchedule.benchmarks.pipeline [--sizes 10,100] [--output results.json]
+    python -m CommuterSchedule.benchmarks.pipeline --compare baseline.json [--threshold 1.25]
+
+Stages:
+    normalize   `fetch_commuter_rail_predictions` on a parsed response, upstream call excluded
+    join        indexing the includes and looking up each prediction's stop and trip
+    timestamps  `parse_iso8601` on every departure time, nothing memoized
+    serialize   the `get_page_info` loop, `serialize_predictions` + json.dumps of every station
+"""
+import os
+import sys
+import copy
+import json
+import time
+import timeit
+import platform
+import argparse
+import datetime
+from CommuterSchedule import utils
+from CommuterSchedule.benchmarks import load_payload
+
+SIZES = (10, 100, 1000, 10000)
+TIME_BUDGET = 0.2 #Seconds each timing should last at least, small payloads are repeated more
+
+def scale_payload(payload, size):
+    """
+    Builds a `/predictions` response of `size` predictions by repeating
+    the recorded ones. Every repetition gets its own prediction and trip
+    ids and departs a minute later, so nothing is shared by accident.
+    """
+
+    recorded = payload["data"]
+    trips = dict((related["id"], related) for related in payload["included"] if related["type"] == "trip")
+    others = [related for related in payload["included"] if related["type"] != "trip"]
+
+    data = []
+    included_trips = []
+    added_trips = set()
+    for index in range(size):
+        cycle, prediction = divmod(index, len(recorded))
+        prediction = copy.deepcopy(recorded[prediction])
+        trip_id = prediction["relationships"]["trip"]["data"]["id"]
+
+        prediction["id"] = "%s-%d" % (prediction["id"], cycle)
+        prediction["relationships"]["trip"]["data"]["id"] = "%s-%d" % (trip_id, cycle)
+        departure_time = utils.parse_iso8601(prediction["attributes"]["departure_time"])
+        prediction["attributes"]["departure_time"] = (departure_time + datetime.timedelta(minutes=cycle)).isoformat()
+        data.append(prediction)
+
+        if trip_id in trips and prediction["relationships"]["trip"]["data"]["id"] not in added_trips: #Trips are shared by the stops of a run
+            trip = copy.deepcopy(trips[trip_id])
+            trip["id"] = prediction["relationships"]["trip"]["data"]["id"]
+            added_trips.add(trip["id"])
+            included_trips.append(trip)
+
+    data.sort(key=lambda prediction: prediction["attributes"]["departure_time"]) #The API sorts by departure_time
+
+    return {"data": data, "included": others + included_trips}
+
+def best_time(function, minimum=TIME_BUDGET):
+    """
+    Returns the best seconds per call out of 5 timings of at least `minimum` seconds.
+    """
+
+    number = 1
+    while True:
+        elapsed = timeit.timeit(function, number=number)
+        if elapsed >= minimum:
+            break
+        number *= 10 if elapsed < minimum / 10 else 2
+    return min(timeit.repeat(function, number=number, repeat=5)) / number, number
+
+def stages(mbta, response):
+    """
+    Returns the Tuple of (stage, callable) timed for one payload.
+    """
+
+    from CommuterSchedule.views import serialize_predictions
+
+    stations = mbta.stations
+    departures = mbta.normalize_predictions_response(response, stations)
+    timestamps = [prediction["attributes"]["departure_time"] for prediction in response["data"]]
+
+    def normalize():
+        mbta.conditional_cache._entries.clear() #Never reuse the previous board
+        mbta.fetch_commuter_rail_predictions({}, stations)
+
+    def join():
+        stops, trips = mbta.index_related(response["included"])
+        mbta.map_stops_to_stations(response["included"], stations)
+        for prediction in response["data"]:
+            relationships = prediction["relationships"]
+            mbta.related_fields(stops[relationships["stop"]["data"]["id"]])
+            mbta.related_fields(trips[relationships["trip"]["data"]["id"]])
+
+    def timestamps_cold():
+        utils._timestamps.clear()
+        for value in timestamps:
+            utils.parse_iso8601(value)
+
+    def serialize():
+        json.dumps(dict((board, serialize_predictions(departures[board])) for board in stations))
+
+    return (("normalize", normalize), ("join", join), ("timestamps", timestamps_cold), ("serialize", serialize))
+
+def run(sizes):
+    """
+    Times every stage at every size.
+
+    Returns:
+        The Dictionary written as JSON, see `main`.
+    """
+
+    from CommuterSchedule.mbta import MBTACommuterRail, ConditionalCache
+
+    recorded = load_payload("predictions.json")
+    results = []
+
+    for size in sizes:
+        response = scale_payload(recorded, size)
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        mbta.conditional_cache = ConditionalCache()
+        mbta.fetch_data_from_mbta = lambda params, endpoint: response
+
+        for stage, function in stages(mbta, response):
+            seconds, number = best_time(function)
+            results.append({
+                "stage": stage,
+                "predictions": size,
+                "ms_per_call": round(seconds * 1e3, 4),
+                "us_per_prediction": round(seconds * 1e6 / size, 3),
+                "calls_per_timing": number
+            })
+
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": results
+    }
+
+def compare(baseline, current, threshold):
+    """
+    Returns the list of (stage, predictions, baseline ms, current ms) slower than `threshold` times the baseline.
+    """
+
+    previous = dict(((result["stage"], result["predictions"]), result["ms_per_call"]) for result in baseline["results"])
+    regressions = []
+    for result in current["results"]:
+        before = previous.get((result["stage"], result["predictions"]))
+        if before and result["ms_per_call"] > before * threshold:
+            regressions.append((result["stage"], result["predictions"], before, result["ms_per_call"]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(str(size) for size in SIZES), help="Comma separated prediction counts")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of a previous run, exits with 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown ratio counted as a regression")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CommuterRail.settings")
+    import django
+    django.setup() #The serialize stage uses the views
+
+    results = run([int(size) for size in args.sizes.split(",")])
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    for result in results["results"]:
+        sys.stderr.write("%-10s %6d predictions %10.3f ms %8.2f us/prediction\n" % (
+            result["stage"], result["predictions"], result["ms_per_call"], result["us_per_prediction"]))
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), results, args.threshold)
+        for stage, size, before, after in regressions:
+            sys.stderr.write("REGRESSION %s at %d predictions: %.3f ms -> %.3f ms\n" % (stage, size, before, after))
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
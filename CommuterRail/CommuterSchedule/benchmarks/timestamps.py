@@ -0,0 +1,53 @@
+"""
+Compares dateutil with the fixed-format `parse_iso8601` on the departure
+times of a predictions payload.
+
+    python -m CommuterSchedule.benchmarks.timestamps [--repeat N]
+"""
+import sys
+import timeit
+import argparse
+import dateutil.parser
+from CommuterSchedule import utils
+from CommuterSchedule.benchmarks import load_payload
+
+def departure_times(payload):
+    return [prediction["attributes"]["departure_time"] for prediction in payload["data"]]
+
+def run(repeat):
+    timestamps = departure_times(load_payload("predictions.json"))
+
+    def dateutil_parse():
+        for value in timestamps:
+            dateutil.parser.parse(value)
+
+    def fast_parse_cold():
+        utils._timestamps.clear() #Every refresh parses new strings
+        for value in timestamps:
+            utils.parse_iso8601(value)
+
+    def fast_parse_warm():
+        for value in timestamps: #Boards repeat most timestamps between refreshes
+            utils.parse_iso8601(value)
+
+    for value in timestamps:
+        assert utils.parse_iso8601(value) == dateutil.parser.parse(value)
+
+    results = []
+    for name, function in (("dateutil", dateutil_parse), ("parse_iso8601 (cold)", fast_parse_cold), ("parse_iso8601 (memoized)", fast_parse_warm)):
+        best = min(timeit.repeat(function, number=repeat, repeat=5)) / (repeat * len(timestamps))
+        results.append((name, best))
+
+    baseline = results[0][1]
+    print("%d timestamps per board, best of 5 x %d boards" % (len(timestamps), repeat))
+    for name, per_timestamp in results:
+        print("%-26s %8.2f us/timestamp %8.1fx" % (name, per_timestamp * 1e6, baseline / per_timestamp))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=200, help="Boards parsed per timing")
+    args = parser.parse_args(argv)
+    run(args.repeat)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,674 @@
+import os
+import time
+import binascii
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from CommuterSchedule.analytics import DelayAnalytics
+from CommuterSchedule.gtfs import StationRegistry
+from CommuterSchedule.history import HistoryRecorder, HistoryStore
+from CommuterSchedule.mbta import MBTACommuterRail, conditional_cache, single_flight
+from CommuterSchedule.metrics import collect, registry as metrics, timed
+from CommuterSchedule.ratelimit import SharedTokenBucket
+from CommuterSchedule.shared import SharedBoard, SharedBoardTooLarge
+from CommuterSchedule.schedule import next_scheduled_departures
+from CommuterSchedule.transport import MBTATransport
+from CommuterSchedule.streaming import PredictionStream, StreamingBoard
+
+logger = logging.getLogger(__name__)
+
+class BoardSnapshot(object):
+    """A read-only copy of the departure board at one point in time
+
+    Snapshots are shared by every request in the process, so nothing
+    handed out by a snapshot should be modified by its readers.
+
+    Args:
+        departures (dict): The result of `MBTACommuterRail.fetch_commuter_rail_departures()`
+        version (int): Increases every time the departures change
+        fetched_at (float): Unix timestamp of the refresh that produced the departures
+        epoch (str): Names the series of versions, see `BoardRefresher.epoch`
+
+    Attributes:
+        cache (dict): Data derived from the departures (deltas, serialized
+            payloads...) computed once and shared by every reader
+        timings (tuple): The (stage, seconds) of the refresh that produced
+            the departures, see `CommuterSchedule.metrics.timed`
+
+    """
+
+    __slots__ = ("departures", "version", "fetched_at", "epoch", "cache", "timings")
+
+    def __init__(self, departures, version, fetched_at, epoch=""):
+        self.departures = departures
+        self.version = version
+        self.fetched_at = fetched_at
+        self.epoch = epoch
+        self.cache = {}
+        self.timings = ()
+
+    @property
+    def tag(self):
+        """The version as shown to clients, e.g. 3f9a61c2:14
+
+        Version counters start over in every process, the epoch tells
+        apart two boards that happen to have the same number.
+        """
+        return "%s:%d" % (self.epoch, self.version)
+
+    @property
+    def age(self):
+        """Seconds since the departures were fetched"""
+        return max(0.0, time.time() - self.fetched_at)
+
+    def station(self, name):
+        """Function to return the predictions of one station
+
+        Args:
+            name (str): The board name, e.g. north_station
+
+        Returns:
+            The `StationBoard`, or None when there are no more trains.
+        """
+
+        return self.departures.get(name)
+
+    def cached(self, key, compute):
+        """Function to compute derived data once per snapshot
+
+        Two requests racing on a cold key may both compute it, which is
+        harmless since the result only depends on the snapshot.
+
+        Args:
+            key (hashable): Names the derived data
+            compute (callable): Called with no arguments on the first read
+
+        Returns:
+            The derived data.
+        """
+
+        try:
+            return self.cache[key]
+        except KeyError:
+            value = self.cache[key] = compute()
+            return value
+
+def diff_predictions(old, new):
+    """Function to compare the predictions of one station in two snapshots
+
+    Predictions are matched on `prediction_id`, the order keys of the
+    board change whenever a departure time does.
+
+    Args:
+        old (StationBoard or None): The station's board in the older snapshot
+        new (StationBoard or None): The station's board in the newer snapshot
+
+    Returns:
+        The Dictionary of:
+            added = [Prediction, ...]
+            changed = [Prediction, ...]
+            removed = [prediction_id, ...]
+            order = [prediction_id, ...] || Departure order of the newer snapshot
+    """
+
+    old_predictions = old.by_id() if old else {}
+    new_predictions = new.predictions if new else ()
+
+    delta = {"added": [], "changed": [], "removed": [], "order": []}
+    new_ids = set()
+    for prediction in new_predictions:
+        new_ids.add(prediction.prediction_id)
+        delta["order"].append(prediction.prediction_id)
+        previous = old_predictions.get(prediction.prediction_id)
+        if previous is None:
+            delta["added"].append(prediction)
+        elif previous is not prediction and previous != prediction: #Streaming boards share unchanged records
+            delta["changed"].append(prediction)
+    for prediction_id in old_predictions:
+        if prediction_id not in new_ids:
+            delta["removed"].append(prediction_id)
+
+    return delta
+
+def new_epoch():
+    """
+    Returns a random name for a series of board versions, e.g. 3f9a61c2.
+    """
+
+    return binascii.hexlify(os.urandom(4)).decode("ascii")
+
+class BoardRefresher(object):
+    """Keeps the latest `BoardSnapshot` fresh from a background thread
+
+    Views only ever read `latest()`, so their latency doesn't depend on
+    the MBTA API or on how many browsers are polling.
+
+    Args:
+        fetch (callable): Called with no arguments, returns the departures dictionary
+        interval (float): Seconds between the start of two refreshes
+        history (int): Number of recent versions kept to compute deltas from
+
+    Attributes:
+        epoch (str): Random name of this refresher's versions, new in
+            every process, so a version from another worker or from
+            before a restart is never mistaken for one of ours
+
+    """
+
+    def __init__(self, fetch, interval, history=20):
+        self.fetch = fetch
+        self.interval = interval
+        self.epoch = new_epoch()
+        self._history = deque(maxlen=history)
+        self.refreshes = 0
+        self.failures = 0
+        self._snapshot = None
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def refresh_once(self):
+        """Function to fetch the departures and publish a new snapshot
+
+        The version only moves forward when the departures differ from
+        the previous snapshot, so readers can cheaply tell if anything changed.
+
+        Returns:
+            The published `BoardSnapshot`.
+        """
+
+        with collect() as timings:
+            with timed("fetch"):
+                departures = self.fetch()
+        fetched_at = time.time()
+
+        with self._condition:
+            previous = self._snapshot
+            if previous is None:
+                version = 1
+            elif previous.departures == departures:
+                version = previous.version
+            else:
+                version = previous.version + 1
+            epoch = previous.epoch if previous is not None else self.epoch #Continues a followed board's versions
+            self._snapshot = BoardSnapshot(departures, version, fetched_at, epoch)
+            self._snapshot.timings = tuple(timings)
+            if previous is None or version != previous.version:
+                self._history.append(self._snapshot)
+            else:
+                self._snapshot.cache = previous.cache #Same departures, same derived data
+            self.refreshes += 1
+            self._condition.notify_all()
+            return self._snapshot
+
+    def latest(self, wait=None):
+        """Function to read the current snapshot
+
+        Args:
+            wait (float): Seconds to wait for the first refresh if there is no snapshot yet
+
+        Returns:
+            The latest `BoardSnapshot`, or None if nothing was fetched in time.
+        """
+
+        with self._condition:
+            if self._snapshot is None and wait:
+                self._condition.wait(wait)
+            return self._snapshot
+
+    def snapshot(self, tag):
+        """Function to find a recent snapshot by version
+
+        Args:
+            tag (str): The `BoardSnapshot.tag` a client saw earlier
+
+        Returns:
+            The `BoardSnapshot` of that version, or None if it's too old
+            or from another epoch.
+        """
+
+        with self._condition:
+            for snapshot in self._history:
+                if snapshot.tag == tag:
+                    return snapshot
+        return None
+
+    def wait_for_change(self, tag, timeout):
+        """Function to block until the board moves past a version
+
+        Args:
+            tag (str): The `BoardSnapshot.tag` the caller has seen last, or None
+            timeout (float): Maximum seconds to wait
+
+        Returns:
+            The latest `BoardSnapshot`, which still has `tag` if nothing
+            changed before the timeout (or None if there is no board yet).
+        """
+
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._snapshot is None or self._snapshot.tag == tag:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining) #Woken on every refresh, even when nothing changed
+            return self._snapshot
+
+    def run(self):
+        """Refresh loop, runs until `stop()` is called"""
+
+        while not self._stopped.is_set():
+            started = time.time()
+            try:
+                self.refresh_once()
+            except Exception:
+                self.failures += 1 #Keep serving the previous snapshot, it only gets older
+                metrics.count("refresh_failures")
+                logger.exception("Departure board refresh failed")
+            self._stopped.wait(max(0.0, self.interval - (time.time() - started)))
+
+    def start(self):
+        """Function to start the background refresh thread"""
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="board-refresher")
+        self._thread.daemon = True #Never keep the server from shutting down
+        self._thread.start()
+
+    def stop(self):
+        """Function to stop the background refresh thread"""
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+class SharedBoardRefresher(BoardRefresher):
+    """`BoardRefresher` that shares one board between worker processes
+
+    Only the process holding the `SharedBoard` writer lock calls `fetch`
+    and publishes the result. Every other worker polls the shared
+    segment and adopts the published snapshot, version included, so
+    versions mean the same thing in every worker and the MBTA API sees
+    one refresher per node however many workers there are. When the
+    writer dies its lock is released and the next poll of another
+    worker takes over.
+
+    Args:
+        fetch (callable): Called with no arguments by the writer, returns the departures dictionary
+        interval (float): Seconds between two fetches of the writer
+        shared (SharedBoard): The segment the board is published in
+        poll_interval (float): Seconds between two reads of the segment
+        history (int): Number of recent versions kept to compute deltas from
+
+    """
+
+    def __init__(self, fetch, interval, shared, poll_interval=1, history=20):
+        super(SharedBoardRefresher, self).__init__(fetch, poll_interval, history)
+        self.refresh_interval = interval
+        self.shared = shared
+
+    def follow(self):
+        """Function to adopt the board published in the segment
+
+        Returns:
+            The latest `BoardSnapshot`, None if nothing was published yet.
+        """
+
+        with self._condition:
+            current = self._snapshot
+
+        published = self.shared.read(current.version if current is not None else None, current.epoch if current is not None else None)
+        if published is None:
+            return current
+        version, fetched_at, epoch, departures = published
+
+        with self._condition:
+            previous = self._snapshot
+            if previous is not None and previous.version == version and previous.epoch == epoch:
+                if previous.fetched_at == fetched_at:
+                    return previous
+                self._snapshot = BoardSnapshot(previous.departures, version, fetched_at, epoch)
+                self._snapshot.cache = previous.cache #Same departures, same derived data
+            else:
+                if departures is None: #Raced with another follow(), read the board again next time
+                    return previous
+                self._snapshot = BoardSnapshot(departures, version, fetched_at, epoch)
+                self._history.append(self._snapshot)
+            self._condition.notify_all()
+            return self._snapshot
+
+    def refresh_once(self):
+        """Function to fetch and publish the board when this process is the
+        writer and the board is due, and to follow the segment otherwise
+
+        Returns:
+            The latest `BoardSnapshot`.
+        """
+
+        if not self.shared.acquire_writer():
+            return self.follow()
+
+        try:
+            current = self.follow() #Continue the versions of a previous writer
+        except Exception: #An unreadable segment mustn't keep the writer from publishing
+            logger.exception("The shared board couldn't be read, publishing a new one")
+            with self._condition:
+                current = self._snapshot
+        if current is not None and time.time() - current.fetched_at < self.refresh_interval:
+            return current
+
+        snapshot = super(SharedBoardRefresher, self).refresh_once()
+        try:
+            self.shared.publish(snapshot.version, snapshot.fetched_at, snapshot.departures, snapshot.epoch)
+        except SharedBoardTooLarge:
+            logger.exception("The departure board wasn't shared with the other workers")
+        return snapshot
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    """
+    Returns the process-wide `MBTATransport` configured from the settings.
+    """
+
+    global _transport
+
+    with _transport_lock:
+        if _transport is None:
+            limiter = None
+            if settings.MBTA_RATE_LIMIT_FILE:
+                limiter = SharedTokenBucket(
+                    settings.MBTA_RATE_LIMIT_FILE,
+                    settings.MBTA_RATE_LIMIT,
+                    settings.MBTA_RATE_LIMIT_BURST,
+                    settings.MBTA_RATE_LIMIT_MAX_WAIT
+                )
+            _transport = MBTATransport(
+                pool_size=settings.MBTA_HTTP_POOL_SIZE,
+                connect_timeout=settings.MBTA_HTTP_CONNECT_TIMEOUT,
+                read_timeout=settings.MBTA_HTTP_READ_TIMEOUT,
+                retries=settings.MBTA_HTTP_RETRIES,
+                backoff=settings.MBTA_HTTP_BACKOFF,
+                backoff_max=settings.MBTA_HTTP_BACKOFF_MAX,
+                limiter=limiter
+            )
+        return _transport
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_station_registry():
+    """
+    Returns the process-wide `StationRegistry` loaded from MBTA_GTFS_PATH,
+    or None when no GTFS feed is configured.
+    """
+
+    global _registry
+
+    if not settings.MBTA_GTFS_PATH:
+        return None
+
+    with _registry_lock:
+        if _registry is None:
+            started = time.time()
+            _registry = StationRegistry.from_gtfs(settings.MBTA_GTFS_PATH)
+            logger.info("Loaded %d commuter rail stations from %s in %.1fs",
+                        len(_registry.station_routes), settings.MBTA_GTFS_PATH, time.time() - started)
+        return _registry
+
+def get_mbta(transport=None):
+    """
+    Returns an `MBTACommuterRail` for the configured stations.
+    """
+
+    return MBTACommuterRail(
+        settings.MBTA_KEY,
+        settings.MBTA_URL,
+        settings.MBTA_ROUTE_CACHE_TTL,
+        transport if transport is not None else get_transport(),
+        stations=[(board, station) for board, station, title in settings.COMMUTER_STATIONS],
+        registry=get_station_registry()
+    )
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """
+    Returns the process-wide pool used to fetch the stations concurrently.
+    """
+
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid(): #A forked worker has the pool but not its threads
+            _executor = ThreadPoolExecutor(max_workers=settings.MBTA_FANOUT_WORKERS)
+            _executor_pid = os.getpid()
+        return _executor
+
+_history = None
+_history_pid = None
+_history_lock = threading.Lock()
+
+def get_history_recorder():
+    """
+    Returns the process-wide `HistoryRecorder` writing to HISTORY_DIR,
+    started on first use, or None when the history is turned off.
+    """
+
+    global _history, _history_pid
+
+    if not settings.HISTORY_DIR:
+        return None
+
+    with _history_lock:
+        if _history is None or _history_pid != os.getpid(): #A forked worker has the recorder but not its thread
+            _history = HistoryRecorder(
+                HistoryStore(settings.HISTORY_DIR, settings.HISTORY_RETENTION_DAYS),
+                settings.HISTORY_FLUSH_INTERVAL
+            )
+            _history_pid = os.getpid()
+            _history.start()
+        return _history
+
+_analytics = None
+_analytics_lock = threading.Lock()
+
+def get_delay_analytics():
+    """
+    Returns the process-wide `DelayAnalytics`, loaded from ANALYTICS_PATH.
+    """
+
+    global _analytics
+
+    with _analytics_lock:
+        if _analytics is None:
+            _analytics = DelayAnalytics(settings.ANALYTICS_PATH, settings.ANALYTICS_SAVE_INTERVAL)
+        return _analytics
+
+def with_observers(fetch, observers):
+    """
+    Wraps a fetch function so every fetched board is passed to each of
+    `observers` (e.g. `HistoryRecorder.record`) before being returned.
+    """
+
+    def fetch_observed():
+        departures = fetch()
+        for observe in observers:
+            try:
+                observe(departures)
+            except Exception: #The board is shown whatever happens to the statistics
+                logger.exception("Observing the board failed")
+        return departures
+
+    return fetch_observed
+
+def fetch_departures():
+    """
+    Fetches the departures for every station with the project settings.
+    Stations fetched separately run concurrently, a station missing
+    MBTA_FANOUT_DEADLINE keeps its board of the current snapshot.
+    """
+
+    transport = get_transport()
+    mbta = get_mbta(transport)
+
+    if settings.MBTA_COMBINED_PREDICTIONS:
+        departures = mbta.fetch_commuter_rail_departures(combined=True)
+    else:
+        current = _refresher.latest() if _refresher is not None else None
+        departures = mbta.fetch_commuter_rail_departures(
+            executor=get_executor(),
+            deadline=settings.MBTA_FANOUT_DEADLINE,
+            stale=current.departures if current is not None else None
+        )
+        logger.debug("MBTA station fetch seconds: %s", mbta.station_timings)
+    logger.debug("MBTA transport stats: %s", transport.stats())
+    logger.debug("MBTA conditional request stats: %s", mbta.conditional_cache.stats()) #Also scraped by /metrics, see board_gauges
+
+    return departures
+
+def start_prediction_stream():
+    """
+    Starts consuming the MBTA streaming predictions feed and returns a
+    fetch function reading the incrementally maintained board.
+    """
+
+    mbta = get_mbta()
+    streaming_board = StreamingBoard(mbta, mbta.stations)
+    stream = PredictionStream(
+        mbta,
+        streaming_board,
+        mbta.create_combined_payload,
+        read_timeout=settings.MBTA_STREAM_READ_TIMEOUT,
+        reconnect_delay=settings.MBTA_STREAM_RECONNECT_DELAY,
+        max_backoff=settings.MBTA_STREAM_MAX_BACKOFF
+    )
+    stream.start()
+
+    return lambda: streaming_board.departures(wait=settings.BOARD_FIRST_REFRESH_TIMEOUT)
+
+def with_scheduled_departures(fetch, limit):
+    """
+    Wraps a fetch function so stations without any realtime prediction
+    show their next scheduled departures instead of an empty board.
+    """
+
+    def fetch_with_schedule():
+        departures = fetch()
+        if all(station_board is not None for station_board in departures.values()):
+            return departures
+
+        stations = dict((board, station) for board, station, title in settings.COMMUTER_STATIONS)
+        departures = OrderedDict(departures) #The fetched dictionary can be shared with the conditional request cache
+
+        close_old_connections() #The refresher thread outlives any request
+        for board, station_board in departures.items():
+            if station_board is None and board in stations:
+                try:
+                    departures[board] = next_scheduled_departures(stations[board], limit)
+                except DatabaseError:
+                    logger.exception("Scheduled departures unavailable, run manage.py migrate and load_gtfs_schedule")
+
+        return departures
+
+    return fetch_with_schedule
+
+def start_on_first_call(start):
+    """
+    Defers `start()`, which returns a fetch function, to the first fetch.
+    """
+
+    started = []
+
+    def fetch():
+        if not started:
+            started.append(start())
+        return started[0]()
+
+    return fetch
+
+_refresher = None
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+def get_board_refresher():
+    """
+    Returns the process-wide `BoardRefresher`, starting it on first use.
+    Forked workers (e.g. gunicorn --preload) don't inherit the parent's
+    thread, so a new refresher is started per process.
+    """
+
+    global _refresher, _refresher_pid
+
+    with _refresher_lock:
+        if _refresher is None or _refresher_pid != os.getpid():
+            if settings.MBTA_STREAMING_PREDICTIONS:
+                fetch = start_on_first_call(start_prediction_stream) #Only the worker fetching the board holds a stream
+            else:
+                fetch = fetch_departures
+            observers = []
+            if settings.HISTORY_DIR:
+                observers.append(get_history_recorder().record)
+            if settings.ANALYTICS_ENABLED:
+                observers.append(get_delay_analytics().observe)
+            if observers:
+                fetch = with_observers(fetch, observers) #Before the fallback, scheduled departures aren't observed
+            if settings.BOARD_SCHEDULE_FALLBACK:
+                fetch = with_scheduled_departures(fetch, settings.BOARD_SCHEDULE_DEPARTURES)
+            if settings.BOARD_SHARED_PATH:
+                _refresher = SharedBoardRefresher(
+                    fetch,
+                    settings.BOARD_REFRESH_INTERVAL,
+                    SharedBoard(settings.BOARD_SHARED_PATH, settings.BOARD_SHARED_SIZE),
+                    settings.BOARD_SHARED_POLL_INTERVAL,
+                    settings.BOARD_HISTORY_SIZE
+                )
+            else:
+                _refresher = BoardRefresher(fetch, settings.BOARD_REFRESH_INTERVAL, settings.BOARD_HISTORY_SIZE)
+            _refresher_pid = os.getpid()
+            _refresher.start()
+        return _refresher
+
+def get_board_snapshot():
+    """
+    Returns the latest `BoardSnapshot`, waiting for the very first refresh
+    of the process if needed. An empty version 0 snapshot is returned
+    when the MBTA API couldn't be reached yet.
+    """
+
+    snapshot = get_board_refresher().latest(wait=settings.BOARD_FIRST_REFRESH_TIMEOUT)
+    if snapshot is None:
+        return BoardSnapshot({}, 0, time.time(), "none")
+    return snapshot
+
+def board_gauges():
+    """
+    Registers the gauges of the board and of the MBTA client read by `/metrics`.
+    """
+
+    def refresher_value(read):
+        return lambda: read(_refresher) if _refresher is not None and _refresher_pid == os.getpid() else None
+
+    def latest_value(read):
+        return refresher_value(lambda refresher: read(refresher.latest()) if refresher.latest() is not None else None)
+
+    metrics.gauge("board_version", latest_value(lambda snapshot: snapshot.version))
+    metrics.gauge("board_age_seconds", latest_value(lambda snapshot: snapshot.age))
+    metrics.gauge("board_refreshes", refresher_value(lambda refresher: refresher.refreshes))
+    metrics.gauge("mbta_in_flight", lambda: _transport.stats()["in_flight"] if _transport is not None else None)
+    metrics.gauge("mbta_pool_utilization", lambda: _transport.stats()["pool_utilization"] if _transport is not None else None)
+    metrics.gauge("mbta_coalesced_calls", lambda: single_flight.stats()["coalesced"])
+    metrics.gauge("mbta_not_modified", lambda: conditional_cache.stats()["not_modified"])
+    metrics.gauge("mbta_parses_saved", lambda: conditional_cache.stats()["parses_saved"]) #Boards reused after a 304
+    metrics.gauge("mbta_not_modified_evicted", lambda: conditional_cache.stats()["evicted"])
+    metrics.gauge("history_rows_written", lambda: _history.written if _history is not None and _history_pid == os.getpid() else None)
+    metrics.gauge("history_boards_dropped", lambda: _history.dropped if _history is not None and _history_pid == os.getpid() else None)
+
+board_gauges()
@@ -0,0 +1,206 @@
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class Subscriber(object):
+    """One push client of a `BroadcastHub`
+
+    Messages are the hub's shared bytes, queued by reference. When the
+    client falls `max_queue` messages behind it's evicted: the queue is
+    dropped and `next` returns None for good, the client reconnects and
+    catches up with a single full board.
+
+    """
+
+    __slots__ = ("version", "evicted", "_queue", "_ready")
+
+    def __init__(self, version):
+        self.version = version #Last version queued for this client
+        self.evicted = False
+        self._queue = deque()
+        self._ready = threading.Event()
+
+    def put(self, message, max_queue):
+        """Function used by the hub to queue a message
+
+        Returns:
+            False when the client was evicted instead.
+        """
+
+        if len(self._queue) >= max_queue:
+            self.evicted = True
+            self._queue.clear()
+            self._ready.set() #Wake the client up so it leaves
+            return False
+        self._queue.append(message)
+        self._ready.set()
+        return True
+
+    def next(self, timeout):
+        """Function to wait for the next message
+
+        Args:
+            timeout (float): Maximum seconds to wait, e.g. until the next heartbeat
+
+        Returns:
+            The message bytes, b"" when nothing came in time, None once evicted.
+        """
+
+        if not self._queue and not self.evicted:
+            self._ready.wait(timeout)
+        if self.evicted:
+            return None
+        try:
+            message = self._queue.popleft()
+        except IndexError:
+            return b""
+        if not self._queue:
+            self._ready.clear()
+            if self._queue: #Put between popleft and clear
+                self._ready.set()
+        return message
+
+class BroadcastHub(object):
+    """Pushes every board update to all the subscribed clients
+
+    Each update is encoded once, as a full board and as a delta from
+    the previous version, and the same bytes are queued for every
+    client: clients that have the previous version get the delta, the
+    others the full board. Publishing costs the encoding plus one queue
+    append per client, however many clients there are.
+
+    Args:
+        max_queue (int): Messages a client may fall behind before it's evicted
+
+    """
+
+    def __init__(self, max_queue=16):
+        self.max_queue = max_queue
+        self.published = 0
+        self.evicted = 0
+        self.refresher = None
+        self._subscribers = set()
+        self._current = None #(version, full board message)
+        self._delta = None #(base version, delta message) of the current version
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, version=None):
+        """Function to add a client
+
+        Args:
+            version (str): The version the client already shows, e.g. its Last-Event-ID
+
+        Returns:
+            The `Subscriber`, already holding the current board (or its
+            delta) when `version` is behind.
+        """
+
+        subscriber = Subscriber(version)
+        with self._lock:
+            if self._current is not None and self._current[0] != version:
+                delta = self._delta is not None and self._delta[0] == version
+                subscriber.put(self._delta[1] if delta else self._current[1], self.max_queue)
+                subscriber.version = self._current[0]
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Function to remove a client, e.g. when its connection closed"""
+
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, version, board, delta=None, base_version=None):
+        """Function to queue an update for every client
+
+        Args:
+            version (str): The board version, a `BoardSnapshot.tag`
+            board (bytes): The encoded full board
+            delta (bytes): The encoded changes since `base_version`, if any
+            base_version (str): The version `delta` applies to
+
+        Returns:
+            The number of clients evicted by this update.
+        """
+
+        with self._lock:
+            self._current = (version, board)
+            self._delta = (base_version, delta) if delta is not None else None
+            subscribers = list(self._subscribers)
+
+        evicted = []
+        for subscriber in subscribers:
+            message = delta if delta is not None and subscriber.version == base_version else board
+            if subscriber.put(message, self.max_queue):
+                subscriber.version = version
+            else:
+                evicted.append(subscriber)
+
+        with self._lock:
+            self._subscribers.difference_update(evicted)
+            self.published += 1
+            self.evicted += len(evicted)
+        return len(evicted)
+
+    def stats(self):
+        """Function to return the counters of the hub
+
+        Returns:
+            The Dictionary of subscribers, published updates and evicted clients.
+        """
+
+        with self._lock:
+            return {"subscribers": len(self._subscribers), "published": self.published, "evicted": self.evicted}
+
+    def follow(self, refresher, encode_board, encode_delta, poll=1.0):
+        """Function to publish every new snapshot of a refresher from a background thread
+
+        Args:
+            refresher (BoardRefresher): The board to follow
+            encode_board (callable): snapshot -> bytes of the full board
+            encode_delta (callable): (base snapshot, snapshot) -> bytes of the changes
+            poll (float): Seconds between two checks for `stop()`
+        """
+
+        self.refresher = refresher
+
+        def run(tag):
+            while not self._stopped.is_set():
+                snapshot = refresher.wait_for_change(tag, poll)
+                if snapshot is None or snapshot.tag == tag:
+                    continue
+                try:
+                    base = refresher.snapshot(tag) if tag else None
+                    self.publish(
+                        snapshot.tag,
+                        encode_board(snapshot),
+                        encode_delta(base, snapshot) if base is not None else None,
+                        tag
+                    )
+                except Exception:
+                    logger.exception("Broadcasting board version %s failed", snapshot.tag)
+                    time.sleep(poll)
+                    continue
+                tag = snapshot.tag
+
+        latest = refresher.latest()
+        if latest is not None: #Clients subscribing right away get the current board
+            self.publish(latest.tag, encode_board(latest))
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=run, args=(latest.tag if latest is not None else None,), name="board-broadcast")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Function to stop following the refresher"""
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
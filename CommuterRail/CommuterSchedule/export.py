@@ -0,0 +1,124 @@
+import json
+import zlib
+import datetime
+import threading
+from django.utils import timezone
+
+EXPORT_FIELDS = ("observed_at", "board", "route_id", "trip_id", "train_number", "platform_code", "status", "departure_time", "prediction_id")
+CHUNK_SIZE = 64 * 1024 #Bytes buffered before a chunk is sent
+
+def export_record(row):
+    """Function to pick the exported fields of a history row
+
+    Returns:
+        The List of values in `EXPORT_FIELDS` order.
+    """
+
+    observed_at = timezone.localtime(datetime.datetime.fromtimestamp(row["t"], timezone.utc)).isoformat()
+    return [observed_at] + [row.get(field) for field in EXPORT_FIELDS[1:]]
+
+def csv_line(values):
+    """Function to write one CSV line (RFC 4180), None is an empty field"""
+
+    fields = []
+    for value in values:
+        value = u"" if value is None else u"%s" % value
+        if any(character in value for character in u',"\r\n'):
+            value = u'"%s"' % value.replace(u'"', u'""')
+        fields.append(value)
+    return u",".join(fields) + u"\r\n"
+
+def ndjson_line(values):
+    """Function to write one JSON object per line"""
+    return json.dumps(dict(zip(EXPORT_FIELDS, values)), sort_keys=True) + u"\n"
+
+def export_chunks(rows, export_format):
+    """
+    Generator of the encoded export, in chunks of about CHUNK_SIZE bytes
+    so a long export is sent as it's read.
+
+    Args:
+        rows (iterable of dict): History rows, see `HistoryStore.rows`
+        export_format (str): csv or ndjson
+    """
+
+    if export_format == "csv":
+        line = csv_line
+        buffered, size = [csv_line(EXPORT_FIELDS).encode("utf-8")], 0
+    else:
+        line = ndjson_line
+        buffered, size = [], 0
+
+    for row in rows:
+        encoded = line(export_record(row)).encode("utf-8")
+        buffered.append(encoded)
+        size += len(encoded)
+        if size >= CHUNK_SIZE:
+            yield b"".join(buffered)
+            buffered, size = [], 0
+
+    if buffered:
+        yield b"".join(buffered)
+
+def gzip_chunks(chunks, level=6):
+    """
+    Generator compressing chunks into one gzip stream as they come, only
+    the compressor's window is held in memory.
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) #16+: gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+class ExportSlots(object):
+    """Caps the exports running at once in a process
+
+    An export holds a worker thread for as long as it streams, so only
+    `limit` of them run at the same time and the board keeps its threads.
+
+    Args:
+        limit (int): Exports allowed at once
+
+    """
+
+    def __init__(self, limit):
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def stream(self, chunks):
+        """Function to take a slot for the lifetime of a stream
+
+        Returns:
+            An iterator over `chunks` that gives the slot back once
+            closed, or None when every slot is taken.
+        """
+
+        if not self._slots.acquire(False):
+            return None
+        return SlotStream(chunks, self._slots.release)
+
+class SlotStream(object):
+    """Iterator giving its export slot back when closed, even before it started"""
+
+    def __init__(self, chunks, release):
+        self._chunks = iter(chunks)
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    next = __next__ #Python 2
+
+    def close(self):
+        """Called by Django once the response was sent or the client went away"""
+
+        if self._release is not None:
+            self._release()
+            self._release = None
+        if hasattr(self._chunks, "close"):
+            self._chunks.close()
@@ -0,0 +1,277 @@
+import io
+import csv
+import zipfile
+import datetime
+import six
+
+COMMUTER_RAIL_ROUTE_TYPE = "2"
+
+def read_gtfs_table(archive, name):
+    """Generator over the rows of one table of a GTFS zip
+
+    Rows are streamed, tables like stop_times.txt have millions of them.
+
+    Args:
+        archive (zipfile.ZipFile): The opened GTFS feed
+        name (str): The table's file name, e.g. stops.txt
+
+    Yields:
+        A Dictionary per row, keyed by column name.
+    """
+
+    with archive.open(name) as table:
+        if six.PY2:
+            reader = csv.DictReader(table)
+            if reader.fieldnames:
+                reader.fieldnames[0] = reader.fieldnames[0].lstrip("\xef\xbb\xbf") #utf-8 byte order mark
+            for row in reader:
+                yield row
+        else:
+            for row in csv.DictReader(io.TextIOWrapper(table, encoding="utf-8-sig", newline="")):
+                yield row
+
+class StationRegistry(object):
+    """Index of commuter rail stations built once from a GTFS static feed
+
+    Answers which commuter rail routes serve a station, and which station
+    a platform stop belongs to, without calling `/routes`. Loading streams
+    stop_times.txt once; afterwards every lookup is a dictionary access.
+
+    Args:
+        station_routes (dict of str: tuple): Parent station id to the commuter routes serving it
+        stop_parents (dict of str: str): Stop id to its parent station id
+        station_names (dict of str: str): Parent station id to its name
+
+    """
+
+    def __init__(self, station_routes, stop_parents, station_names):
+        self.station_routes = station_routes
+        self.stop_parents = stop_parents
+        self.station_names = station_names
+        self.stations_by_name = dict((name.lower(), station) for station, name in station_names.items())
+
+    @classmethod
+    def from_gtfs(cls, path):
+        """Function to build the registry from a GTFS zip
+
+        Args:
+            path (str): Path of the GTFS feed, e.g. MBTA_GTFS.zip
+
+        Returns:
+            The `StationRegistry` of every station served by a commuter rail trip.
+        """
+
+        with zipfile.ZipFile(path) as archive:
+            stop_parents = {}
+            stop_names = {}
+            for stop in read_gtfs_table(archive, "stops.txt"):
+                stop_parents[stop["stop_id"]] = stop.get("parent_station") or stop["stop_id"]
+                stop_names[stop["stop_id"]] = stop["stop_name"]
+
+            commuter_routes = set(
+                route["route_id"] for route in read_gtfs_table(archive, "routes.txt")
+                if route["route_type"] == COMMUTER_RAIL_ROUTE_TYPE
+            )
+            trip_routes = dict(
+                (trip["trip_id"], trip["route_id"]) for trip in read_gtfs_table(archive, "trips.txt")
+                if trip["route_id"] in commuter_routes
+            )
+
+            station_routes = {}
+            for stop_time in read_gtfs_table(archive, "stop_times.txt"):
+                route = trip_routes.get(stop_time["trip_id"])
+                if route is not None:
+                    station = stop_parents.get(stop_time["stop_id"], stop_time["stop_id"])
+                    station_routes.setdefault(station, set()).add(route)
+
+        return cls(
+            dict((station, tuple(sorted(routes))) for station, routes in station_routes.items()),
+            dict((stop, parent) for stop, parent in stop_parents.items() if parent in station_routes),
+            dict((station, stop_names.get(station, station)) for station in station_routes)
+        )
+
+    def resolve(self, station):
+        """Function to find the parent station id of a station
+
+        Args:
+            station (str): A parent station id (place-bbsta), a platform stop id,
+                or a station name (Back Bay)
+
+        Returns:
+            The parent station id, or None if no commuter rail serves it.
+        """
+
+        if station in self.station_routes:
+            return station
+        parent = self.stop_parents.get(station)
+        if parent is not None:
+            return parent
+        return self.stations_by_name.get(station.lower())
+
+    def routes_for(self, station):
+        """Function to list the commuter routes serving a station
+
+        Returns:
+            The list of route ids, or None if the station is unknown.
+        """
+
+        routes = self.station_routes.get(self.resolve(station))
+        return list(routes) if routes is not None else None
+
+    def parent_of(self, stop):
+        """Function to find the parent station id of a platform stop, or None"""
+        return self.stop_parents.get(stop)
+
+    def name_of(self, station):
+        """Function to find the name of a station, or None"""
+        return self.station_names.get(self.resolve(station))
+
+def parse_gtfs_time(value):
+    """Function to convert a GTFS HH:MM:SS time into seconds
+
+    Times go past 24:00:00 for trips that run after midnight.
+
+    Returns:
+        The seconds since the start of the service day.
+    """
+
+    hours, minutes, seconds = value.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+def parse_gtfs_date(value):
+    """Function to convert a GTFS YYYYMMDD date into a `datetime.date`"""
+    return datetime.datetime.strptime(value, "%Y%m%d").date()
+
+def read_service_dates(archive):
+    """Generator over the dates each service runs
+
+    Expands the weekly patterns of calendar.txt over their date range,
+    then applies the additions/removals of calendar_dates.txt. Either
+    file may be missing from a feed.
+
+    Yields:
+        The Tuple of (service_id, date).
+    """
+
+    names = archive.namelist()
+    weekdays = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+    dates = set()
+
+    if "calendar.txt" in names:
+        for service in read_gtfs_table(archive, "calendar.txt"):
+            runs_on = [service[weekday] == "1" for weekday in weekdays]
+            day = parse_gtfs_date(service["start_date"])
+            end = parse_gtfs_date(service["end_date"])
+            while day <= end:
+                if runs_on[day.weekday()]:
+                    dates.add((service["service_id"], day))
+                day += datetime.timedelta(days=1)
+
+    if "calendar_dates.txt" in names:
+        for exception in read_gtfs_table(archive, "calendar_dates.txt"):
+            service_date = (exception["service_id"], parse_gtfs_date(exception["date"]))
+            if exception["exception_type"] == "1":
+                dates.add(service_date)
+            else:
+                dates.discard(service_date)
+
+    for service_date in sorted(dates):
+        yield service_date
+
+def bulk_insert(model, rows, batch_size):
+    """Function to insert model instances in bounded batches
+
+    Args:
+        model (Model): The model class
+        rows (iterable of Model): Instances to insert, consumed lazily
+        batch_size (int): Rows held in memory and sent per INSERT
+
+    Returns:
+        The number of rows inserted.
+    """
+
+    inserted = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            model.objects.bulk_create(batch)
+            inserted += len(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+        inserted += len(batch)
+    return inserted
+
+def load_schedule(path, batch_size=5000):
+    """Function to replace the scheduled departures with the ones of a GTFS zip
+
+    stop_times.txt is streamed row by row and only commuter rail
+    departures are kept, so memory is bounded by the commuter trips
+    and one batch of rows, not by the size of the feed. Everything
+    is replaced in a single transaction, the board never reads a
+    half loaded schedule.
+
+    Args:
+        path (str): Path of the GTFS feed, e.g. MBTA_GTFS.zip
+        batch_size (int): Rows per INSERT
+
+    Returns:
+        The Dictionary of rows loaded per table.
+    """
+
+    from django.db import transaction
+    from CommuterSchedule.models import ScheduledDeparture, ScheduledStop, ServiceDate
+
+    with zipfile.ZipFile(path) as archive:
+        stops = {}
+        for stop in read_gtfs_table(archive, "stops.txt"):
+            stops[stop["stop_id"]] = ScheduledStop(
+                stop_id=stop["stop_id"],
+                name=stop["stop_name"],
+                station_id=stop.get("parent_station") or stop["stop_id"],
+                platform_code=stop.get("platform_code") or ""
+            )
+
+        commuter_routes = set(
+            route["route_id"] for route in read_gtfs_table(archive, "routes.txt")
+            if route["route_type"] == COMMUTER_RAIL_ROUTE_TYPE
+        )
+        trips = dict(
+            (trip["trip_id"], trip) for trip in read_gtfs_table(archive, "trips.txt")
+            if trip["route_id"] in commuter_routes
+        )
+
+        def departures():
+            for stop_time in read_gtfs_table(archive, "stop_times.txt"):
+                trip = trips.get(stop_time["trip_id"])
+                if trip is None or stop_time.get("pickup_type") == "1": #Not commuter rail, or drop off only
+                    continue
+                stop = stops.get(stop_time["stop_id"])
+                yield ScheduledDeparture(
+                    station_id=stop.station_id if stop else stop_time["stop_id"],
+                    stop_id=stop_time["stop_id"],
+                    direction_id=int(trip.get("direction_id") or 0),
+                    departure_seconds=parse_gtfs_time(stop_time["departure_time"]),
+                    service_id=trip["service_id"],
+                    trip_id=trip["trip_id"],
+                    route_id=trip["route_id"],
+                    headsign=stop_time.get("stop_headsign") or trip.get("trip_headsign") or "",
+                    train_number=trip.get("trip_short_name") or "",
+                    platform_code=stop.platform_code if stop else ""
+                )
+
+        with transaction.atomic():
+            ScheduledDeparture.objects.all().delete()
+            ScheduledStop.objects.all().delete()
+            ServiceDate.objects.all().delete()
+
+            return {
+                "stops": bulk_insert(ScheduledStop, six.itervalues(stops), batch_size),
+                "service_dates": bulk_insert(
+                    ServiceDate,
+                    (ServiceDate(service_id=service_id, date=date) for service_id, date in read_service_dates(archive)),
+                    batch_size
+                ),
+                "departures": bulk_insert(ScheduledDeparture, departures(), batch_size)
+            }
@@ -0,0 +1,247 @@
+import io
+import os
+import gzip
+import json
+import time
+import logging
+import datetime
+import threading
+from six.moves import queue
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+class HistoryStore(object):
+    """Append-only record of how the predictions changed, one file per day
+
+    Each day is a gzip file of JSON lines, `YYYY-MM-DD.ndjson.gz`. Every
+    `append` adds a complete gzip member in a single write, readers see
+    the concatenated members as one stream. Days older than
+    `retention_days` are deleted by `expire`, which bounds the disk used.
+
+    Args:
+        directory (str): Where the day files are kept, created if missing
+        retention_days (int): Days of history kept
+
+    """
+
+    SUFFIX = ".ndjson.gz"
+
+    def __init__(self, directory, retention_days=90):
+        self.directory = directory
+        self.retention_days = retention_days
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def partition(self, day):
+        """Function to return the path of a day's file"""
+        return os.path.join(self.directory, day.isoformat() + self.SUFFIX)
+
+    def append(self, day, rows):
+        """Function to append rows to a day
+
+        Args:
+            day (datetime.date): The day the rows were observed
+            rows (list of dict): JSON serializable rows
+        """
+
+        if not rows:
+            return
+
+        lines = "".join(json.dumps(row, sort_keys=True) + "\n" for row in rows).encode("utf-8")
+        member = io.BytesIO()
+        with gzip.GzipFile(fileobj=member, mode="wb", mtime=0) as compressed:
+            compressed.write(lines)
+
+        fd = os.open(self.partition(day), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, member.getvalue()) #One write per member, so appends never interleave
+        finally:
+            os.close(fd)
+
+    def read(self, day):
+        """Generator over the rows of a day, in the order they were appended"""
+
+        path = self.partition(day)
+        if not os.path.exists(path):
+            return
+        with gzip.open(path, "rb") as compressed:
+            for line in compressed:
+                yield json.loads(line.decode("utf-8"))
+
+    def rows(self, start, end, route=None, station=None):
+        """Generator over the recorded predictions between two times
+
+        Days are read one line at a time, so memory stays constant
+        whatever the range. Removals aren't included.
+
+        Args:
+            start (float): Unix timestamp, included
+            end (float): Unix timestamp, excluded
+            route (str): Only this MBTA route id, e.g. CR-Providence
+            station (str): Only this board, e.g. south_station
+
+        """
+
+        to_day = lambda timestamp: timezone.localtime(datetime.datetime.fromtimestamp(timestamp, timezone.utc)).date()
+        day, last_day = to_day(start), to_day(end)
+        while day <= last_day:
+            for row in self.read(day):
+                if row["op"] != "upsert" or not start <= row["t"] < end:
+                    continue
+                if (route is not None and row["route_id"] != route) or (station is not None and row["board"] != station):
+                    continue
+                yield row
+            day += datetime.timedelta(days=1)
+
+    def days(self):
+        """Function to list the days in the store, oldest first"""
+
+        return sorted(
+            datetime.datetime.strptime(name[:-len(self.SUFFIX)], "%Y-%m-%d").date()
+            for name in os.listdir(self.directory) if name.endswith(self.SUFFIX)
+        )
+
+    def expire(self, today):
+        """Function to delete the days past the retention
+
+        Returns:
+            The list of deleted days.
+        """
+
+        oldest = today - datetime.timedelta(days=self.retention_days)
+        expired = [day for day in self.days() if day < oldest]
+        for day in expired:
+            os.remove(self.partition(day))
+        return expired
+
+class HistoryRecorder(object):
+    """Writes the changes between successive boards to a `HistoryStore`
+
+    `record` only queues the board, the comparison and the compressed
+    writes happen on a background thread every `flush_interval` seconds.
+    Only predictions that appeared, changed or disappeared since the
+    previous board are written, an unchanged board costs nothing.
+
+    Rows look like:
+        {"t": observed_at, "op": "upsert", "board": "north_station", "prediction_id": ..., <Prediction fields>}
+        {"t": observed_at, "op": "remove", "board": "north_station", "prediction_id": ...}
+
+    Args:
+        store (HistoryStore): Where the rows are appended
+        flush_interval (float): Seconds between two writes
+        max_pending (int): Boards queued at most, newer boards are dropped past it
+
+    """
+
+    def __init__(self, store, flush_interval=60, max_pending=1000):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._last = {} #(board, prediction_id) -> Prediction
+        self._last_departures = None
+        self._expired_on = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record(self, departures, observed_at=None):
+        """Function to queue a board, never blocks
+
+        Args:
+            departures (dict): Board name to `StationBoard` or None
+            observed_at (float): Unix timestamp of the board, defaults to now
+        """
+
+        try:
+            self._queue.put_nowait((observed_at or time.time(), departures))
+        except queue.Full:
+            self.dropped += 1
+
+    def changes(self, observed_at, departures):
+        """Function to compute the rows of a board against the previous one
+
+        Returns:
+            The list of rows, empty when nothing changed.
+        """
+
+        if departures is self._last_departures: #Reused after a 304, nothing to compare
+            return []
+        self._last_departures = departures
+
+        rows = []
+        current = {}
+        for board, station_board in departures.items():
+            for prediction in station_board or ():
+                key = (board, prediction.prediction_id)
+                current[key] = prediction
+                previous = self._last.get(key)
+                if previous is None or (previous is not prediction and previous != prediction):
+                    row = prediction.as_dict(departure_time=prediction.departure_time.isoformat())
+                    row.update({"t": observed_at, "op": "upsert", "board": board})
+                    rows.append(row)
+
+        for board, prediction_id in self._last:
+            if (board, prediction_id) not in current:
+                rows.append({"t": observed_at, "op": "remove", "board": board, "prediction_id": prediction_id})
+
+        self._last = current
+        return rows
+
+    def flush(self):
+        """Function to write every queued board
+
+        Returns:
+            The number of rows written.
+        """
+
+        days = {}
+        while True:
+            try:
+                observed_at, departures = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            rows = self.changes(observed_at, departures)
+            if rows:
+                day = timezone.localtime(datetime.datetime.fromtimestamp(observed_at, timezone.utc)).date()
+                days.setdefault(day, []).extend(rows)
+
+        written = 0
+        for day, rows in sorted(days.items()):
+            self.store.append(day, rows)
+            written += len(rows)
+        self.written += written
+
+        today = timezone.localtime(timezone.now()).date()
+        if self._expired_on != today:
+            self.store.expire(today)
+            self._expired_on = today
+
+        return written
+
+    def run(self):
+        """Write loop, runs until `stop()` is called"""
+
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing the prediction history failed")
+
+    def start(self):
+        """Function to start the background writer thread"""
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="history-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Function to stop the writer thread, flushing what's queued"""
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -0,0 +1,26 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from CommuterSchedule.gtfs import load_schedule
+
+class Command(BaseCommand):
+    help = "Loads the commuter rail schedule of a GTFS static feed, shown when there are no realtime predictions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default=None,
+                            help="GTFS zip to load, defaults to MBTA_GTFS_PATH")
+        parser.add_argument("--batch-size", type=int, default=5000,
+                            help="Rows per INSERT, bounds the memory used while loading")
+
+    def handle(self, *args, **options):
+        path = options["path"] or settings.MBTA_GTFS_PATH
+        if not path:
+            raise CommandError("Pass the GTFS zip to load or set MBTA_GTFS_PATH")
+
+        started = time.time()
+        loaded = load_schedule(path, batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS(
+            "Loaded %(departures)d departures, %(stops)d stops and %(service_dates)d service dates" % loaded +
+            " in %.1fs" % (time.time() - started)
+        ))
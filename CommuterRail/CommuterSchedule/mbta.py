@@ -1,30 +1,246 @@
-import requests
+import time
+import logging
 import datetime
+import threading
 import dateutil.parser
-from CommuterSchedule.utils import UTC
+from concurrent import futures
+from CommuterSchedule.utils import UTC, parse_iso8601
+from CommuterSchedule.records import Prediction, StationBoard
+from CommuterSchedule.metrics import collect, merge, registry as metrics, timed
+from CommuterSchedule.ratelimit import SingleFlight
+from CommuterSchedule.transport import default_transport
 from collections import OrderedDict
 
+logger = logging.getLogger(__name__)
+
+class RouteCache(object):
+    """Process-level TTL cache for the commuter routes serving a station
+
+    The routes serving North & South Station change maybe once a season,
+    so there is no reason to ask `/routes` for them on every page load.
+    Entries are shared by every `MBTACommuterRail` instance in the process.
+
+    Args:
+        default_ttl (int): Seconds a route list stays fresh when the caller
+            doesn't provide its own ttl
+
+    """
+
+    DEFAULT_TTL = 6 * 60 * 60 #Six hours, routes rarely change during the day
+
+    def __init__(self, default_ttl=DEFAULT_TTL):
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._routes = {} #station -> (expires_at, routes)
+        self._lock = threading.Lock()
+
+    def get(self, station, loader, ttl=None):
+        """Function to return the cached routes for a station
+
+        Args:
+            station (str): The stop id the routes belong to
+            loader (callable): Called with no arguments to fetch the routes on a miss
+            ttl (int): Seconds to keep a freshly loaded list, defaults to `default_ttl`
+
+        Returns:
+            The list of route ids serving the station.
+
+        """
+
+        now = time.time()
+        with self._lock:
+            entry = self._routes.get(station)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        routes = loader() #Fetched outside the lock so a slow upstream doesn't block other stations
+
+        if routes: #Never cache an empty list, the next request should try again
+            if ttl is None:
+                ttl = self.default_ttl
+            with self._lock:
+                self._routes[station] = (now + ttl, routes)
+
+        return routes
+
+    def invalidate(self, station=None):
+        """Function to drop cached routes
+
+        Args:
+            station (str): The station to drop, or every station if None
+
+        """
+
+        with self._lock:
+            if station is None:
+                self._routes.clear()
+            else:
+                self._routes.pop(station, None)
+
+    def stats(self):
+        """Function to report the cache counters
+
+        Returns:
+            The Dictionary of hits, misses and cached stations.
+
+        """
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stations": len(self._routes)
+            }
+
+route_cache = RouteCache()
+
+class ConditionalCache(object):
+    """Process-level store of `Last-Modified` validators for MBTA responses
+
+    The MBTA API honours `If-Modified-Since`, so for every (endpoint, params)
+    the last parsed response is kept with its validator. A 304 hands back
+    the very same parsed object, which also lets callers reuse whatever
+    they computed from it (see `get_normalized`) instead of parsing again.
+
+    Args:
+        max_entries (int): Number of (endpoint, params) responses to remember
+
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.requests = 0
+        self.not_modified = 0
+        self.parses_saved = 0
+        self.evicted = 0
+        self._entries = OrderedDict() #key -> {"last_modified", "data", "normalized"}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(endpoint, params):
+        """Function to build the cache key of a request
+
+        Returns:
+            A hashable Tuple of the endpoint and its sorted parameters.
+        """
+
+        return (endpoint, tuple(sorted((str(name), str(value)) for name, value in params.items())))
+
+    def validator(self, key):
+        """Function to return the `If-Modified-Since` value for a request, or None"""
+
+        with self._lock:
+            self.requests += 1
+            entry = self._entries.get(key)
+            return entry["last_modified"] if entry else None
+
+    def reuse(self, key):
+        """Function to return the parsed response of a request answered with 304
+
+        Returns:
+            The parsed response, or None when it was evicted since its
+            validator was sent, the request has to be sent again without it.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.evicted += 1
+                return None
+            self.not_modified += 1
+            return entry["data"]
+
+    def store(self, key, last_modified, data):
+        """Function to remember a freshly parsed response and its validator"""
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {"last_modified": last_modified, "data": data, "normalized": {}}
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False) #Forget the oldest request
+
+    def get_normalized(self, key, data, variant=None):
+        """Function to return what was computed from a response the last time
+
+        Args:
+            key (tuple): See `key`
+            data (dict): The parsed response just returned by `fetch_data_from_mbta`
+            variant (hashable): Distinguishes different results computed from the same response
+
+        Returns:
+            The stored result if `data` is the response it was computed from, otherwise None.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["data"] is not data or variant not in entry["normalized"]:
+                return None
+            self.parses_saved += 1
+            return entry["normalized"][variant]
+
+    def set_normalized(self, key, data, result, variant=None):
+        """Function to remember what was computed from a response, see `get_normalized`"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["data"] is data:
+                entry["normalized"][variant] = result
+
+    def stats(self):
+        """Function to report the conditional request counters
+
+        Returns:
+            The Dictionary of requests, 304 answers, parses saved and
+            304s whose response had been evicted.
+        """
+
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "not_modified": self.not_modified,
+                "parses_saved": self.parses_saved,
+                "evicted": self.evicted,
+                "entries": len(self._entries)
+            }
+
+conditional_cache = ConditionalCache()
+
+single_flight = SingleFlight()
+
 class MBTACommuterRail(object):
     """MBTA Class that currently fetches real-time Commuter Rail Departures
     
-    Currently this class supports commuter rail departures for North & South Station.
-    Additonally functionality, stations, and support can be added. 
+    Supports commuter rail departures for any set of stations, North & South
+    Station by default. Additonally functionality and support can be added. 
 
     Args:
         mbta_key (str): This is the developer key provided by MBTA
         mbta_url (str): This is the current url for the MBTA API
+        route_cache_ttl (int): Seconds to reuse a station's route list, see `RouteCache`
+        transport (MBTATransport): Pooled HTTP transport, shared by default
+        stations (list of tuple): (board name, station id or name) pairs, North & South Station by default
+        registry (StationRegistry): GTFS index used instead of `/routes`, see `CommuterSchedule.gtfs`
 
     TODO:
         * Support versioning
 
     """
 
-    def __init__(self,mbta_key,mbta_url):
+    def __init__(self,mbta_key,mbta_url,route_cache_ttl=None,transport=None,stations=None,registry=None):
         self.timezone = UTC()
         self.mbta_key = mbta_key
         self.mbta_url = mbta_url
-        self.north_station = "place-north"
-        self.south_station = "South Station"
+        self.registry = registry
+        self.north_station = self.resolve_station("place-north")
+        self.south_station = self.resolve_station("South Station")
+        if stations is None:
+            stations = [("north_station", self.north_station), ("south_station", self.south_station)]
+        self.stations = OrderedDict(
+            (board, self.resolve_station(station)) for board, station in stations
+        ) #Board name used by the views -> station id used by the API
         self.commuter_vehicle_type = "2"
         self.routes_endpoint = "/routes"
         self.predictions_endpoint = "/predictions"
@@ -32,10 +248,30 @@ class MBTACommuterRail(object):
         self.direction_towards = 1
         self.unknown_platform = "TBD"
         self.missing_data = ""
+        self.route_cache = route_cache
+        self.route_cache_ttl = route_cache_ttl
+        self.transport = transport if transport is not None else default_transport
+        self.conditional_cache = conditional_cache
+        self.single_flight = single_flight
 
         if mbta_url != "https://api-v3.mbta.com":
             raise Exception("The Project doesn't currently support different versions of the API. It only supports v3 with this url: {}".format("https://api-v3.mbta.com"))
     
+    def resolve_station(self, station):
+        """Function to turn a configured station into the id sent to the API
+
+        Args:
+            station (str): A station id, platform id or name, e.g. Back Bay
+
+        Returns:
+            The parent station id from the registry, or `station` unchanged
+            when there is no registry or it doesn't know the station.
+        """
+
+        if self.registry is not None:
+            return self.registry.resolve(station) or station
+        return station
+
     def fetch_data_from_mbta(self, params,endpoint):
         """General Function to fetch data from MBTA API
 
@@ -44,26 +280,59 @@ class MBTACommuterRail(object):
             endpoint (str): The endpoint requested on the MBTA API
         
         Returns:
-            The JSON Dictionary from the MBTA API.
+            The JSON Dictionary from the MBTA API. When the API answers
+            304 Not Modified this is the same object returned last time.
+            Concurrent calls for the same request share a single fetch
+            (see `SingleFlight`) and the same object.
 
         """
 
+        cache_key = self.conditional_cache.key(endpoint,params)
+        return self.single_flight.do(cache_key, lambda: self._fetch_data_from_mbta(params,endpoint,cache_key))
+
+    def _fetch_data_from_mbta(self,params,endpoint,cache_key):
         request_url = self.mbta_url + endpoint
         headers = {"x-api-key": self.mbta_key}
 
-        r = requests.get(
-            request_url,
-            params=params,
-            headers=headers
-        )
+        last_modified = self.conditional_cache.validator(cache_key)
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
 
-        return r.json()
+        r = self._get(request_url,params,headers,endpoint)
+
+        if r.status_code == 304 and last_modified:
+            data = self.conditional_cache.reuse(cache_key)
+            if data is not None:
+                return data #Nothing transferred, nothing to parse
+            del headers["If-Modified-Since"] #Evicted meanwhile, nothing to reuse so ask for the full response
+            r = self._get(request_url,params,headers,endpoint)
+
+        with timed("json_decode"):
+            data = r.json()
+        if r.status_code == 200 and r.headers.get("Last-Modified"):
+            self.conditional_cache.store(cache_key,r.headers["Last-Modified"],data)
+
+        return data
+
+    def _get(self,request_url,params,headers,endpoint):
+        with timed(endpoint.strip("/")): #e.g. routes, predictions
+            r = self.transport.get(
+                request_url,
+                params=params,
+                headers=headers
+            )
+        metrics.count("mbta_responses", endpoint=endpoint, status=r.status_code)
+        return r
+
+    def fetch_station_routes(self, station):
+        """Function to fetch the commuter routes serving a station
+        from the `/routes` endpoint
+
+        Args:
+            station (str): The station id, e.g. place-north
 
-    def fetch_north_station_routes(self):
-        """Function to fetch commuter routes for North Station
-        
         Returns:
-            The list of commuter routes in North Station using
+            The list of commuter routes at the station using
             filter[type] = 2.
 
         """
@@ -71,7 +340,7 @@ class MBTACommuterRail(object):
         endpoint = self.routes_endpoint
 
         payload = {
-            "filter[stop]": self.north_station,
+            "filter[stop]": station,
             "filter[type]": self.commuter_vehicle_type
         }
 
@@ -82,227 +351,512 @@ class MBTACommuterRail(object):
 
         return cleaned_routes
 
-    def create_north_station_payload(self):
+    def station_routes(self, station):
+        """Function to look up the commuter routes serving a station
+
+        Stations known to the GTFS registry are answered from its index
+        without calling `/routes`, the others go through `RouteCache`.
+
+        Args:
+            station (str): The station id, e.g. place-north
+
+        Returns:
+            The list of route ids serving the station.
+        """
+
+        if self.registry is not None:
+            routes = self.registry.routes_for(station)
+            if routes is not None:
+                return routes
+
+        return self.route_cache.get(station, lambda: self.fetch_station_routes(station), self.route_cache_ttl)
+
+    def create_station_payload(self, station):
         """Function to generate commuter rail predictions
-        for North Station
+        for one station
         
+        Args:
+            station (str): The station id, e.g. place-north
+
         Returns:
             The OrderedDictionary of:
-                includes[stop,route,trip]
-                filter[route] = All North Station Routes
-                filter[stop] = place-north
+                includes = stop,route,trip
+                filter[route] = All routes of the station (see `station_routes`)
+                filter[stop] = The station id
                 filter[direction_id] = 0 || Away trip
                 filter[sort] = "departure_time" || Earliest first
         """
 
-        north_station_routes = self.fetch_north_station_routes()
+        routes = self.station_routes(station)
         
-        ns_payload = OrderedDict() #Using Ordered Dict to keep track of the sorted list
-        ns_payload["include"] = "stop,route,trip"
-        ns_payload["filter[stop]"] = self.north_station
-        ns_payload["filter[route]"] = ",".join(list(str(route) for route in north_station_routes))
-        ns_payload["filter[direction_id]"] = self.direction_away
-        ns_payload["sort"] = "departure_time"
+        payload = OrderedDict() #Using Ordered Dict to keep track of the sorted list
+        payload["include"] = "stop,route,trip"
+        payload["filter[stop]"] = station
+        payload["filter[route]"] = ",".join(list(str(route) for route in routes))
+        payload["filter[direction_id]"] = self.direction_away
+        payload["sort"] = "departure_time"
 
-        return ns_payload
+        return payload
 
+    def fetch_north_station_routes(self):
+        """Function to fetch commuter routes for North Station, see `fetch_station_routes`"""
+        return self.fetch_station_routes(self.north_station)
+
+    def create_north_station_payload(self):
+        """Function to generate commuter rail predictions
+        for North Station, see `create_station_payload`"""
+        return self.create_station_payload(self.north_station)
 
     def fetch_south_station_routes(self):
-        """Function to fetch commuter routes for South Station
+        """Function to fetch commuter routes for South Station, see `fetch_station_routes`"""
+        return self.fetch_station_routes(self.south_station)
+
+    def create_south_station_payload(self):
+        """Function to generate commuter rail predictions
+        for South Station, see `create_station_payload`"""
+        return self.create_station_payload(self.south_station)
+
+    def create_combined_payload(self):
+        """Function to generate a single commuter rail predictions
+        payload for every configured station together
+
+        The response is split back into per-station boards by
+        `fetch_commuter_rail_predictions` using `self.stations`.
         
         Returns:
-            The list of commuter routes in South Station using
-            filter[type] = 2.
+            The OrderedDictionary of:
+                includes = stop,route,trip
+                filter[route] = Union of the routes of every station (see `station_routes`)
+                filter[stop] = Every station id, e.g. place-north,South Station
+                filter[direction_id] = 0 || Away trip
+                filter[sort] = "departure_time" || Earliest first
+        """
+
+        combined_routes = []
+        seen = set()
+        for station in self.stations.values():
+            for route in self.station_routes(station):
+                if route not in seen: #Keep the first occurrence, some routes serve several stations
+                    seen.add(route)
+                    combined_routes.append(route)
+
+        combined_payload = OrderedDict() #Using Ordered Dict to keep track of the sorted list
+        combined_payload["include"] = "stop,route,trip"
+        combined_payload["filter[stop]"] = ",".join(self.stations.values())
+        combined_payload["filter[route]"] = ",".join(list(str(route) for route in combined_routes))
+        combined_payload["filter[direction_id]"] = self.direction_away
+        combined_payload["sort"] = "departure_time"
 
+        return combined_payload
+
+    def map_stops_to_stations(self,related_data,stations):
+        """Function to match the included stops of a predictions
+        response with the stations that were requested
+
+        Predictions point at platform stops (e.g. North Station-01), so a stop
+        belongs to a station when its id, its parent station, or its name
+        matches the station that was used in filter[stop].
+
+        Args:
+            related_data (list of dict): The `included` data from the MBTA API
+            stations (dict of str: str): Board name to station id, e.g. `self.stations`
+
+        Returns:
+            The Dictionary of stop_id = board name.
         """
 
-        endpoint = self.routes_endpoint
+        board_for_station = dict((station, board) for board, station in stations.items())
+        stop_boards = {}
 
-        payload = {
-            "filter[stop]": self.south_station,
-            "filter[type]": self.commuter_vehicle_type
+        for related in related_data:
+            if related["type"] != "stop":
+                continue
+            if self.registry is not None: #The GTFS index knows the parent of every platform
+                parent = self.registry.parent_of(related["id"])
+                if parent in board_for_station:
+                    stop_boards[related["id"]] = board_for_station[parent]
+                    continue
+            candidates = [related["id"], related.get("attributes", {}).get("name")]
+            parent_station = related.get("relationships", {}).get("parent_station", {}).get("data")
+            if parent_station:
+                candidates.append(parent_station["id"])
+            for candidate in candidates:
+                if candidate in board_for_station:
+                    stop_boards[related["id"]] = board_for_station[candidate]
+                    break
+
+        return stop_boards
+
+    def index_related(self,related_data):
+        """Function to index the included stops and trips by id
+
+        Args:
+            related_data (list of dict): The `included` data from the MBTA API
+
+        Returns:
+            The Tuple of (stop_id = stop, trip_id = trip) Dictionaries.
+        """
+
+        related_index = {"stop": {}, "trip": {}}
+        for related in related_data:
+            if related["type"] in related_index:
+                related_index[related["type"]][related["id"]] = related
+
+        return related_index["stop"], related_index["trip"]
+
+    def parse_timestamp(self,value):
+        """Function to parse an MBTA timestamp
+
+        Uses the strict fast path of `parse_iso8601`, anything unexpected
+        still goes through the general dateutil parser.
+
+        Args:
+            value (str): An ISO-8601 timestamp from the MBTA API
+
+        Returns:
+            The timezone aware datetime.
+        """
+
+        try:
+            return parse_iso8601(value)
+        except ValueError:
+            return dateutil.parser.parse(value)
+
+    def normalize_prediction(self,prediction,stops=None,trips=None,now=None):
+        """Function to turn a raw MBTA prediction into the
+        record shown on the board.
+
+        The headsign, train number and platform come from the
+        prediction's trip and stop when they're in `trips`/`stops`,
+        otherwise they're placeholders until `join_related`.
+
+        Args:
+            prediction (dict): A prediction resource from the MBTA API
+            stops (dict of str: dict): Included stops by id, see `index_related`
+            trips (dict of str: dict): Included trips by id, see `index_related`
+            now (datetime): The time of the batch being normalized, defaults to the current time
+
+        Returns:
+            The `Prediction` record.
+        """
+
+        relationships = prediction["relationships"]
+        departure_time = self.parse_timestamp(prediction["attributes"]["departure_time"])
+        status = self.prediction_status(prediction["attributes"]["status"],departure_time,now)
+
+        fields = {
+            "prediction_id": prediction["id"],
+            "departure_time": departure_time,
+            "status": status,
+            "route_id": relationships["route"]["data"]["id"],
+            "trip_id": relationships["trip"]["data"]["id"],
+            "stop_id": relationships["stop"]["data"]["id"],
+            "headsign": self.missing_data,
+            "train_number": self.missing_data,
+            "platform_code": self.unknown_platform #This value will be replaced later
         }
 
-        routes_response = self.fetch_data_from_mbta(payload,endpoint)
-        routes = routes_response["data"]
-        
-        cleaned_routes = list(route["id"] for route in routes) #Using a generator expression to pull out the commuter routes
+        if stops and fields["stop_id"] in stops:
+            fields.update(self.related_fields(stops[fields["stop_id"]]))
+        if trips and fields["trip_id"] in trips:
+            fields.update(self.related_fields(trips[fields["trip_id"]]))
 
-        return cleaned_routes
+        return Prediction(**fields)
+
+    def prediction_status(self,status,departure_time,now=None):
+        """Function to return the status shown for a prediction at `now`
+
+        Args:
+            status (str): The status from the MBTA API
+            departure_time (datetime): The predicted departure
+            now (datetime): The time the board is built, defaults to the current time
 
-    def create_south_station_payload(self):
-        """Function to generate commuter rail predictions
-        for South Station
-        
         Returns:
-            The OrderedDictionary of:
-                includes = stop,route,trip
-                filter[route] = All South Station Routes
-                filter[stop] = South Station
-                filter[direction_id] = 0 || Away trip
-                filter[sort] = "departure_time" || Earliest first
+            The status, Delayed instead of Departed while the departure is still ahead.
         """
 
-        south_station_routes = self.fetch_south_station_routes()
-        
-        ss_payload = OrderedDict() #Using Ordered Dict to keep track of the sorted list
-        ss_payload["include"] = "stop,route,trip"
-        ss_payload["filter[stop]"] = self.south_station
-        ss_payload["filter[route]"] = ",".join(list(str(route) for route in south_station_routes))
-        ss_payload["filter[direction_id]"] = self.direction_away
-        ss_payload["sort"] = "departure_time"
+        if now is None:
+            now = datetime.datetime.now(self.timezone)
+        if status == "Departed" and departure_time > now: #Noticed that API sometimes shows `departed` even though train is late, this helps handle those scenarios
+            return "Delayed"
+        return status
+
+    def refresh_statuses(self,cleaned,predictions_response,now=None):
+        """Function to bring the statuses of a board normalized earlier up to `now`
+
+        A status depends on when it's evaluated (see `prediction_status`),
+        so a board reused after a 304 is checked again against the
+        statuses of the response it was normalized from.
+
+        Args:
+            cleaned: The `StationBoard` or None, or the OrderedDictionary of them, see `normalize_predictions_response`
+            predictions_response (dict): The parsed response `cleaned` comes from
+            now (datetime): The time of the reuse, defaults to the current time
 
-        return ss_payload
+        Returns:
+            `cleaned` itself when no status changed, otherwise a new board
+            sharing the predictions that didn't change.
+        """
+
+        if now is None:
+            now = datetime.datetime.now(self.timezone)
+        statuses = dict((prediction["id"], prediction["attributes"]["status"]) for prediction in predictions_response["data"])
+
+        def refreshed(station_board):
+            if station_board is None:
+                return None
+            changed = False
+            predictions = []
+            for prediction in station_board:
+                status = self.prediction_status(statuses.get(prediction.prediction_id, prediction.status),prediction.departure_time,now)
+                if status != prediction.status:
+                    prediction = prediction.replace(status=status)
+                    changed = True
+                predictions.append(prediction)
+            return StationBoard(predictions) if changed else station_board
+
+        if not isinstance(cleaned, dict):
+            return refreshed(cleaned)
+
+        boards = OrderedDict((board, refreshed(station_board)) for board, station_board in cleaned.items())
+        if all(boards[board] is cleaned[board] for board in cleaned):
+            return cleaned
+        return boards
+
+    def related_fields(self,related):
+        """Function to pick the board fields out of a related stop or trip
+
+        Args:
+            related (dict): The stop or trip resource a prediction points at
+
+        Returns:
+            The Dictionary of `Prediction` fields it provides.
+        """
+
+        fields = {}
+        related_type = related["type"]
+        if related_type == "stop":
+            if "platform_code" in related["attributes"]:
+                fields["platform_code"] = related["attributes"]["platform_code"] #Sets the platform_code if available
+        elif related_type == "trip":
+            if "headsign" in related["attributes"]:
+                fields["headsign"] = related["attributes"]["headsign"] #Sets the headsign for the UI
+            else:
+                fields["headsign"] = "Ended"
+            if "name" in related["attributes"]:
+                fields["train_number"] = related["attributes"]["name"]
+
+        return fields
+
+    def join_related(self,prediction,related):
+        """Function to copy the board fields of a related
+        stop or trip into a normalized prediction.
+
+        Args:
+            prediction (Prediction): A record from `normalize_prediction`
+            related (dict): The stop or trip resource the prediction points at
+
+        Returns:
+            A new `Prediction` with the related fields, records are never modified.
+        """
+
+        return prediction.replace(**self.related_fields(related))
 
-    def fetch_commuter_rail_predictions(self,params):
+    def clean_predictions(self,predictions,stops,trips,now=None):
+        """Function to normalize raw predictions and join
+        their headsign/platform data from the included relations.
+
+        Args:
+            predictions (list of dict): The `data` from the MBTA API, in departure order
+            stops (dict of str: dict): Included stops by id, see `index_related`
+            trips (dict of str: dict): Included trips by id, see `index_related`
+            now (datetime): The time of the batch, defaults to the current time
+
+        Returns:
+            The `StationBoard`, or None if there are no predictions.
+        """
+
+        if not predictions: #Handle those pesky late night commuters wanting that sweet,sweet info
+            return None #Sorry, try again in a few hours
+
+        if now is None:
+            now = datetime.datetime.now(self.timezone) #Evaluated once for the whole batch
+
+        return StationBoard(self.normalize_prediction(prediction,stops,trips,now) for prediction in predictions) #The API already sorted by departure_time
+
+    def fetch_commuter_rail_predictions(self,params,stations=None):
         """Function to fetch commuter rail predictions
         for a given station payload.
 
-        The Dictionary returned contains each prediction
-        organized by keys.
+        The board returned holds each prediction as a
+        `Prediction` record in departure order. When `stations` is given
+        the payload is expected to cover several stations (see
+        `create_combined_payload`) and the response is split into one
+        board per station.
 
         Args:
             params (dict of str: str): Parameters to filter/include 
+            stations (dict of str: str): Board name to station id, optional
 
         Returns:
-            The Dictionary of:
-                ROUTE_ID-ISO8601 TIMESTAMP = {
-                    prediction_id,
-                    departure_time,
-                    status,
-                    route_id,
-                    trip_id,
-                    stop_id,
-                    headsign,
-                    train_number,
-                    platform_code
-                }
+            The `StationBoard`, or None if there are no predictions,
+            or, with `stations`, the OrderedDictionary of board name = the above.
         """
         endpoint = self.predictions_endpoint
 
         predictions_response = self.fetch_data_from_mbta(params,endpoint)
+
+        cache_key = self.conditional_cache.key(endpoint,params)
+        variant = tuple(stations.items()) if stations is not None else None
+        cleaned = self.conditional_cache.get_normalized(cache_key,predictions_response,variant)
+        if cleaned is not None: #304 Not Modified, the board computed last time is still current but for the statuses
+            refreshed = self.refresh_statuses(cleaned,predictions_response)
+            if refreshed is not cleaned:
+                self.conditional_cache.set_normalized(cache_key,predictions_response,refreshed,variant)
+            return refreshed
+
+        with timed("normalize"):
+            cleaned = self.normalize_predictions_response(predictions_response,stations)
+        self.conditional_cache.set_normalized(cache_key,predictions_response,cleaned,variant)
+
+        return cleaned
+
+    def normalize_predictions_response(self,predictions_response,stations=None):
+        """Function to normalize a parsed `/predictions` response,
+        see `fetch_commuter_rail_predictions`.
+        """
+
         predictions = predictions_response["data"] #Commuter rail departures
-        if not predictions: #Handle those pesky late night commuters wanting that sweet,sweet info
-            return None #Sorry, try again in a few hours
-        related_data = predictions_response["included"] #Separate relational data from include parameter
+        related_data = predictions_response.get("included", []) #Separate relational data from include parameter
+        stops, trips = self.index_related(related_data)
+        now = datetime.datetime.now(self.timezone)
 
-        cleaned_predictions = {
-            "predictions": OrderedDict(), #Retain sorting in order to keep conssitency 
-            "stop": {}, #Using this in order to retrieve platform_code
-            "trip": {}, #Using this in order to retrieve headsign data
-            "route": {} #Using this to store route ids
-        }
+        if stations is None:
+            return self.clean_predictions(predictions,stops,trips,now)
 
+        stop_boards = self.map_stops_to_stations(related_data,stations)
+        station_predictions = OrderedDict((board, []) for board in stations)
         for prediction in predictions:
-            prediction_order_id = prediction["relationships"]["route"]["data"]["id"]+"-"+prediction["attributes"]["departure_time"]+"-"+prediction["id"] #Created a unique key for each, could have used just prediction_id, however, increased readability 
-            departure_time = dateutil.parser.parse(prediction["attributes"]["departure_time"])
-            status = prediction["attributes"]["status"]
-            if status == "Departed" and departure_time > datetime.datetime.now(self.timezone): #Noticed that API sometimes shows `departed` even though train is late, this helps handle those scenarios
-                status = "Delayed"
-
-            cleaned_predictions["predictions"][prediction_order_id] = {
-                "prediction_id": prediction["id"],
-                "departure_time": departure_time,
-                "status": status,
-                "route_id": prediction["relationships"]["route"]["data"]["id"],
-                "trip_id": prediction["relationships"]["trip"]["data"]["id"],
-                "stop_id": prediction["relationships"]["stop"]["data"]["id"],
-                "headsign": self.missing_data,
-                "train_number": self.missing_data,
-                "platform_code": self.unknown_platform #This value will be replaced later
-            }
-
-            """
-            These lines below create a mapping between the prediction 
-            and stop,trip,route ids. This helps efficiently lookup the 
-            prediction that matches a specific stop,trip, or route id.
-            """
-            
-            cleaned_predictions["stop"][prediction["relationships"]["stop"]["data"]["id"]] = prediction_order_id
-            cleaned_predictions["trip"][prediction["relationships"]["trip"]["data"]["id"]] = prediction_order_id
-            cleaned_predictions["route"][prediction["relationships"]["route"]["data"]["id"]] = prediction_order_id
+            board = stop_boards.get(prediction["relationships"]["stop"]["data"]["id"])
+            if board is not None:
+                station_predictions[board].append(prediction) #Appending keeps the departure_time sort from the API
 
-        for related in related_data:
-            related_type = related["type"]
-            if related_type in cleaned_predictions:
-                prediction = cleaned_predictions["predictions"][cleaned_predictions[related_type][related["id"]]] #Lookup based on type happens here, would break if a relation doesn't match a prediction
-                if related_type == "stop":
-                    if "platform_code" in related["attributes"]:
-                        prediction["platform_code"] = related["attributes"]["platform_code"] #Sets the platform_code if available
-                elif related_type == "trip":
-                    if "headsign" in related["attributes"]:
-                        prediction["headsign"] = related["attributes"]["headsign"] #Sets the headsign for the UI
-                    else:
-                        prediction["headsign"] = "Ended"
-                    if "name" in related["attributes"]:
-                        prediction["train_number"] = related["attributes"]["name"]
-
-        return cleaned_predictions
+        return OrderedDict(
+            (board, self.clean_predictions(board_predictions,stops,trips,now))
+            for board, board_predictions in station_predictions.items()
+        )
 
-    def fetch_north_station_departures(self):
+    def fetch_station_departures(self, station):
         """Function to fetch commuter rail departures
-        for North Station
+        for one station
 
-        The Dictionary returned contains each prediction
-        organized by keys.
+        The board returned holds each prediction as a
+        `Prediction` record in departure order.
         
+        Args:
+            station (str): The station id, e.g. place-north
+
         Returns:
-            The Dictionary of:
-                ROUTE_ID-ISO8601 TIMESTAMP = {
-                    prediction_id,
-                    departure_time,
-                    status,
-                    route_id,
-                    trip_id,
-                    stop_id,
-                    headsign,
-                    train_number,
-                    platform_code
-                }
+            The `StationBoard`, or None if there are no predictions.
         """
 
-        return self.fetch_commuter_rail_predictions(self.create_north_station_payload())
+        return self.fetch_commuter_rail_predictions(self.create_station_payload(station))
+
+    def fetch_north_station_departures(self):
+        """Function to fetch commuter rail departures
+        for North Station, see `fetch_station_departures`"""
+        return self.fetch_station_departures(self.north_station)
 
     def fetch_south_station_departures(self):
         """Function to fetch commuter rail departures
-        for South Station
+        for South Station, see `fetch_station_departures`"""
+        return self.fetch_station_departures(self.south_station)
+    
+    def fan_out_departures(self, executor, deadline=None, stale=None):
+        """Function to fetch every station at the same time
+
+        Each station (its route lookup and its `/predictions` call) runs on
+        `executor`, so the refresh takes as long as the slowest station
+        instead of the sum of all of them. A station that fails or misses
+        the deadline keeps its `stale` board and doesn't hold the others up.
+
+        The seconds each station took are left in `self.station_timings`
+        (None for stations that missed the deadline), and the stages timed
+        on the pool threads are merged into the calling thread's timings
+        (see `collect`), so they show up in the refresh's Server-Timing.
+
+        Args:
+            executor (Executor): Bounds how many stations are fetched at once
+            deadline (float): Seconds to wait for every station, or None to wait for all of them
+            stale (dict): Board name to the board to keep when a station is late, e.g. the previous departures
 
-        The Dictionary returned contains each prediction
-        organized by keys.
-        
         Returns:
-            The Dictionary of:
-                ROUTE_ID-ISO8601 TIMESTAMP = {
-                    prediction_id,
-                    departure_time,
-                    status,
-                    route_id,
-                    trip_id,
-                    stop_id,
-                    headsign,
-                    train_number,
-                    platform_code
-                }
+            The OrderedDictionary of board name = `StationBoard` or None.
         """
 
-        return self.fetch_commuter_rail_predictions(self.create_south_station_payload())
+        def fetch(station): #Runs on the pool, its timings are handed back with the result
+            started = time.time()
+            with collect() as stages:
+                try:
+                    return self.fetch_station_departures(station), None, stages, time.time() - started
+                except Exception as error:
+                    return None, error, stages, time.time() - started
+
+        pending = OrderedDict(
+            (board, executor.submit(fetch, station)) for board, station in self.stations.items()
+        )
+        futures.wait(list(pending.values()), timeout=deadline)
+
+        departures = OrderedDict()
+        timings = {}
+        answered = 0
+        for board, future in pending.items():
+            if future.done():
+                station_board, error, stages, timings[board] = future.result()
+                merge(stages)
+                if error is None:
+                    departures[board] = station_board
+                    answered += 1
+                    continue
+                logger.warning("Fetching %s failed: %r", board, error)
+            else:
+                future.cancel() #Only cancels if it didn't start, a running fetch finishes in the background
+                logger.warning("Fetching %s missed the %ss deadline", board, deadline)
+            departures[board] = (stale or {}).get(board)
+
+        self.station_timings = dict((board, timings.get(board)) for board in pending)
+
+        if not answered:
+            raise Exception("None of the stations answered in time: {}".format(", ".join(pending)))
+
+        return departures
     
-    def fetch_commuter_rail_departures(self):
+    def fetch_commuter_rail_departures(self,combined=False,executor=None,deadline=None,stale=None):
         """Function to fetch commuter rail departures
-        for both North & South Station
+        for every configured station
 
         The Dictionary returned contains each set of
-        departures organized by North & South Station.
+        departures organized by board name, e.g. North & South Station.
+
+        Args:
+            combined (bool): Fetch every station with a single `/predictions`
+                request (see `create_combined_payload`) instead of one per station
+            executor (Executor): Fetch the stations concurrently, see `fan_out_departures`
+            deadline (float): Seconds to wait for the stations when using an executor
+            stale (dict): Boards kept for stations missing the deadline
         
         Returns:
-            The Dictionary of:
+            The OrderedDictionary of board name = `StationBoard` or None, e.g.:
                 north_station = `fetch_north_station_departures()`
                 south_station = `fetch_south_station_departures()`
         """
 
-        return {
-            "north_station":self.fetch_north_station_departures(),
-            "south_station":self.fetch_south_station_departures()
-        }
+        if combined:
+            return self.fetch_commuter_rail_predictions(self.create_combined_payload(),self.stations)
+
+        if executor is not None:
+            return self.fan_out_departures(executor,deadline,stale)
 
-        
\ No newline at end of file
+        return OrderedDict(
+            (board, self.fetch_station_departures(station)) for board, station in self.stations.items()
+        )
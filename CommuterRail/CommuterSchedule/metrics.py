@@ -0,0 +1,216 @@
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) #Seconds
+
+class Histogram(object):
+    """Cumulative histogram in the shape Prometheus expects
+
+    Args:
+        buckets (tuple of float): Upper bounds of the buckets, ascending
+
+    """
+
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Function to add one observation"""
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def cumulative(self):
+        """Function to return the (upper bound, observations at or below it) pairs, +Inf last"""
+
+        running = 0
+        pairs = []
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            pairs.append((bound, running))
+        pairs.append(("+Inf", self.count))
+        return pairs
+
+class MetricsRegistry(object):
+    """Process-level stage histograms and event counters
+
+    Stages are the hot-path steps of building the board (upstream calls,
+    JSON decode, normalization, rendering...), timed with `timed`.
+    Counters are plain events, e.g. MBTA responses that were 304s.
+
+    """
+
+    def __init__(self):
+        self._stages = OrderedDict() #stage -> Histogram
+        self._counters = OrderedDict() #(name, labels) -> value
+        self._gauges = OrderedDict() #name -> callable returning the value
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        """Function to record how long a stage took"""
+
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, value=1, **labels):
+        """Function to increase a counter, e.g. count("mbta_responses", status="304")"""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, read):
+        """Function to register a gauge read when the metrics are scraped
+
+        Args:
+            name (str): The metric name, without the commuter_ prefix
+            read (callable): Returns the current value, or None to leave it out
+        """
+
+        with self._lock:
+            self._gauges[name] = read
+
+    def render(self):
+        """Function to write every metric in the Prometheus text format
+
+        Returns:
+            The exposition text, version 0.0.4.
+        """
+
+        with self._lock:
+            stages = [(stage, histogram.cumulative(), histogram.total, histogram.count) for stage, histogram in self._stages.items()]
+            counters = list(self._counters.items())
+            gauges = list(self._gauges.items())
+
+        lines = [
+            "# HELP commuter_stage_seconds Seconds spent in each stage of building the board",
+            "# TYPE commuter_stage_seconds histogram"
+        ]
+        for stage, buckets, total, count in stages:
+            for bound, observations in buckets:
+                lines.append('commuter_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, observations))
+            lines.append('commuter_stage_seconds_sum{stage="%s"} %r' % (stage, float(total)))
+            lines.append('commuter_stage_seconds_count{stage="%s"} %d' % (stage, count))
+
+        described = set()
+        for (name, labels), value in counters:
+            if name not in described:
+                lines.append("# TYPE commuter_%s_total counter" % name)
+                described.add(name)
+            label_text = ",".join('%s="%s"' % label for label in labels)
+            lines.append("commuter_%s_total%s %r" % (name, "{%s}" % label_text if label_text else "", float(value)))
+
+        for name, read in gauges:
+            value = read()
+            if value is not None:
+                lines.append("# TYPE commuter_%s gauge" % name)
+                lines.append("commuter_%s %r" % (name, float(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Function to drop every histogram and counter, gauges are kept"""
+
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+registry = MetricsRegistry()
+_local = threading.local()
+
+@contextmanager
+def timed(stage):
+    """
+    Times the enclosed block as `stage` in the registry, and in the
+    timings being collected by the current thread, see `collect`.
+    """
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        registry.observe(stage, elapsed)
+        timings = getattr(_local, "timings", None)
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+@contextmanager
+def collect():
+    """
+    Collects the (stage, seconds) of every `timed` block of the current
+    thread into the yielded list, e.g. the stages of one request.
+    """
+
+    previous = getattr(_local, "timings", None)
+    _local.timings = []
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
+
+def merge(timings):
+    """
+    Adds (stage, seconds) pairs timed on another thread, e.g. by a pool
+    task, to the timings being collected by the current thread. They're
+    already in the registry, `timed` recorded them where they ran.
+    """
+
+    collected = getattr(_local, "timings", None)
+    if collected is not None:
+        collected.extend(timings)
+
+def server_timing(timings, prefix="", description=None):
+    """
+    Formats (stage, seconds) pairs as Server-Timing metrics, repeated
+    stages are added up.
+
+    Returns:
+        The list of metrics, e.g. ['render;dur=2.1'].
+    """
+
+    totals = OrderedDict()
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+
+    metrics = []
+    for stage, seconds in totals.items():
+        metric = "%s%s;dur=%.1f" % (prefix, stage, seconds * 1000)
+        if description:
+            metric += ';desc="%s"' % description
+        metrics.append(metric)
+    return metrics
+
+def with_server_timing(view):
+    """
+    Decorator adding the stages timed while the view ran as a
+    Server-Timing header. Views may add more with `request.server_timing`.
+    """
+
+    @wraps(view)
+    def timed_view(request, *args, **kwargs):
+        with collect() as timings:
+            request.server_timing = []
+            with timed("view_" + view.__name__):
+                response = view(request, *args, **kwargs)
+        metrics = server_timing(timings) + request.server_timing
+        if metrics:
+            response["Server-Timing"] = ", ".join(metrics)
+        return response
+
+    return timed_view
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.16 on 2026-10-18 16:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledDeparture',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('station_id', models.CharField(max_length=64, verbose_name='Parent Station ID')),
+                ('stop_id', models.CharField(max_length=64, verbose_name='Stop ID')),
+                ('direction_id', models.PositiveSmallIntegerField(verbose_name='Direction')),
+                ('departure_seconds', models.PositiveIntegerField(verbose_name='Departure (seconds into the service day)')),
+                ('service_id', models.CharField(max_length=128, verbose_name='Service ID')),
+                ('trip_id', models.CharField(max_length=128, verbose_name='Trip ID')),
+                ('route_id', models.CharField(max_length=64, verbose_name='Route ID')),
+                ('headsign', models.CharField(blank=True, max_length=255, verbose_name='Headsign')),
+                ('train_number', models.CharField(blank=True, max_length=16, verbose_name='Train #')),
+                ('platform_code', models.CharField(blank=True, max_length=16, verbose_name='Track #')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScheduledStop',
+            fields=[
+                ('stop_id', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Stop ID')),
+                ('name', models.CharField(db_index=True, max_length=255, verbose_name='Name')),
+                ('station_id', models.CharField(db_index=True, max_length=64, verbose_name='Parent Station ID')),
+                ('platform_code', models.CharField(blank=True, max_length=16, verbose_name='Track #')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ServiceDate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_id', models.CharField(max_length=128, verbose_name='Service ID')),
+                ('date', models.DateField(verbose_name='Date')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='servicedate',
+            unique_together=set([('date', 'service_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='scheduleddeparture',
+            index_together=set([('station_id', 'direction_id', 'departure_seconds')]),
+        ),
+    ]
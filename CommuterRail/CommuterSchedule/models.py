@@ -2,5 +2,53 @@
 from __future__ import unicode_literals
 
 from django.db import models
+from django.utils.encoding import smart_text
 
-# Create your models here.
+class ScheduledStop(models.Model):
+    """A stop of the GTFS schedule, loaded by `manage.py load_gtfs_schedule`"""
+
+    stop_id = models.CharField(verbose_name='Stop ID', primary_key=True, max_length=64)
+    name = models.CharField(verbose_name='Name', db_index=True, max_length=255)
+    station_id = models.CharField(verbose_name='Parent Station ID', db_index=True, max_length=64)
+    platform_code = models.CharField(verbose_name='Track #', blank=True, max_length=16)
+
+    def __unicode__(self):
+        return smart_text(self.name)
+
+class ServiceDate(models.Model):
+    """A date on which a GTFS service runs, calendar.txt expanded with calendar_dates.txt"""
+
+    service_id = models.CharField(verbose_name='Service ID', max_length=128)
+    date = models.DateField(verbose_name='Date')
+
+    class Meta:
+        unique_together = (("date", "service_id"),)
+
+    def __unicode__(self):
+        return smart_text("%s %s" % (self.service_id, self.date))
+
+class ScheduledDeparture(models.Model):
+    """One scheduled commuter rail departure from a station
+
+    Rows are denormalized (headsign, train number, track) so the next
+    departures of a station are a single index range scan.
+    `departure_seconds` counts from the start of the service day and
+    goes past 24 hours for trips running after midnight, like in GTFS.
+    """
+
+    station_id = models.CharField(verbose_name='Parent Station ID', max_length=64)
+    stop_id = models.CharField(verbose_name='Stop ID', max_length=64)
+    direction_id = models.PositiveSmallIntegerField(verbose_name='Direction')
+    departure_seconds = models.PositiveIntegerField(verbose_name='Departure (seconds into the service day)')
+    service_id = models.CharField(verbose_name='Service ID', max_length=128)
+    trip_id = models.CharField(verbose_name='Trip ID', max_length=128)
+    route_id = models.CharField(verbose_name='Route ID', max_length=64)
+    headsign = models.CharField(verbose_name='Headsign', blank=True, max_length=255)
+    train_number = models.CharField(verbose_name='Train #', blank=True, max_length=16)
+    platform_code = models.CharField(verbose_name='Track #', blank=True, max_length=16)
+
+    class Meta:
+        index_together = (("station_id", "direction_id", "departure_seconds"),)
+
+    def __unicode__(self):
+        return smart_text("%s %s %s" % (self.station_id, self.trip_id, self.departure_seconds))
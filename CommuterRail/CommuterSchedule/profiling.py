@@ -0,0 +1,173 @@
+import os
+import time
+import pstats
+import random
+import logging
+import cProfile
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "HTTP_X_PROFILE" #X-Profile, see `profile_token`
+PROFILE_SALT = "CommuterSchedule.profiling"
+
+def profile_token():
+    """
+    Returns a signed X-Profile header value, valid for PROFILING_TOKEN_MAX_AGE
+    seconds, that forces the profiling of a request, e.g.
+
+        python manage.py shell -c "from CommuterSchedule.profiling import profile_token; print(profile_token())"
+    """
+
+    return signing.TimestampSigner(salt=PROFILE_SALT).sign("profile")
+
+def collapsed_stacks(stats):
+    """
+    Converts cProfile statistics into collapsed stacks (one
+    "caller;callee;... microseconds" line per stack) for flame graph tools.
+
+    cProfile only records caller -> callee edges, so the time of a
+    function called from several places is split between its stacks
+    in proportion to the time each caller spent in it.
+
+    Args:
+        stats (pstats.Stats): The statistics of one profile
+
+    Returns:
+        The list of collapsed stack lines.
+    """
+
+    def label(function):
+        filename, line, name = function
+        return "%s:%d:%s" % (os.path.basename(filename), line, name)
+
+    callees = {}
+    for function, (calls, primitive, inline, cumulative, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((function, edge[3]))
+
+    lines = {}
+
+    def visit(function, path, budget):
+        if len(path) > 64 or budget <= 0:
+            return
+        calls, primitive, inline, cumulative, callers = stats.stats[function]
+        ratio = budget / cumulative if cumulative else 0
+        own = int(inline * ratio * 1e6)
+        if own:
+            stack = ";".join(label(frame) for frame in path)
+            lines[stack] = lines.get(stack, 0) + own
+        for callee, edge_cumulative in callees.get(function, ()):
+            if callee not in path: #Recursion is folded into the first call
+                visit(callee, path + (callee,), edge_cumulative * ratio)
+
+    for function, entry in stats.stats.items():
+        if not entry[4]: #No caller, the top of a stack
+            visit(function, (function,), entry[3])
+
+    return ["%s %d" % (stack, microseconds) for stack, microseconds in sorted(lines.items())]
+
+def rotate(directory, max_files, max_bytes):
+    """
+    Deletes the oldest profiles until `directory` holds at most
+    `max_files` files and `max_bytes` bytes.
+    """
+
+    profiles = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            status = os.stat(path)
+        except OSError: #Rotated by another worker
+            continue
+        profiles.append((status.st_mtime, name, status.st_size, path))
+    profiles.sort()
+
+    total = sum(profile[2] for profile in profiles)
+    while profiles and (len(profiles) > max_files or total > max_bytes):
+        mtime, name, size, path = profiles.pop(0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+class ProfilingMiddleware(object):
+    """Profiles a sample of the board requests with cProfile
+
+    Every PROFILING_SAMPLE_RATE-th request on average to one of
+    PROFILING_URL_NAMES is profiled, and so is any request sending a valid
+    X-Profile header (see `profile_token`). Each profile is written to
+    PROFILING_DIR as .pstats (python -m pstats) and .collapsed (flame
+    graphs), the oldest profiles are deleted past PROFILING_MAX_FILES or
+    PROFILING_MAX_BYTES.
+
+    The middleware removes itself when PROFILING_ENABLED is off, and an
+    unsampled request only costs a random number and a dictionary lookup.
+
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+        self.url_names = frozenset(settings.PROFILING_URL_NAMES)
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE
+        self.directory = settings.PROFILING_DIR
+        self.profiles = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if match is None or match.url_name not in self.url_names:
+            return None
+
+        forced = PROFILE_HEADER in request.META and self.valid_token(request.META[PROFILE_HEADER])
+        if not forced and (not self.sample_rate or random.random() * self.sample_rate >= 1): #1 in sample_rate, 0 only profiles on demand
+            return None
+
+        profile = cProfile.Profile()
+        response = profile.runcall(view_func, request, *view_args, **view_kwargs)
+
+        name = self.dump(profile, match.url_name)
+        if forced and name:
+            response["X-Profile-Id"] = name
+        return response
+
+    def valid_token(self, token):
+        try:
+            signing.TimestampSigner(salt=PROFILE_SALT).unsign(token, max_age=settings.PROFILING_TOKEN_MAX_AGE)
+        except signing.BadSignature: #Also raised for expired tokens
+            return False
+        return True
+
+    def dump(self, profile, url_name):
+        """
+        Writes one profile and rotates the directory.
+
+        Returns:
+            The name the profile files share, or None if they couldn't be written.
+        """
+
+        now = time.time()
+        name = "%s.%03d-%d-%s" % (time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)), int(now * 1000) % 1000, os.getpid(), url_name)
+        path = os.path.join(self.directory, name)
+
+        try:
+            profile.dump_stats(path + ".pstats")
+            with open(path + ".collapsed", "w") as collapsed:
+                collapsed.write("\n".join(collapsed_stacks(pstats.Stats(profile))) + "\n")
+            rotate(self.directory, settings.PROFILING_MAX_FILES, settings.PROFILING_MAX_BYTES)
+        except (IOError, OSError):
+            logger.exception("Couldn't write the profile %s", path)
+            return None
+
+        self.profiles += 1
+        return name
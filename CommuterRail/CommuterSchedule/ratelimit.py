@@ -0,0 +1,195 @@
+import os
+import time
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError: #Windows, the bucket is then only shared by the threads of a process
+    fcntl = None
+
+class RateLimited(Exception):
+    """Raised when no token frees up within the wait allowed for a call"""
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key into one
+
+    The first caller runs the call, callers arriving while it's in flight
+    wait for it and get the same result (or exception) instead of
+    sending their own request upstream.
+
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {} #key -> (Event, result holder)
+        self._lock = threading.Lock()
+
+    def do(self, key, call):
+        """Function to run `call` once for every concurrent caller of `key`
+
+        Args:
+            key (hashable): Identifies identical calls, e.g. (endpoint, params)
+            call (callable): Called with no arguments by the first caller
+
+        Returns:
+            The result of the call shared by everyone who waited for it.
+        """
+
+        with self._lock:
+            flight = self._in_flight.get(key)
+            if flight is None:
+                flight = self._in_flight[key] = (threading.Event(), {})
+                leader = True
+                self.calls += 1
+            else:
+                leader = False
+                self.coalesced += 1
+
+        done, outcome = flight
+        if not leader:
+            done.wait()
+            if "error" in outcome:
+                raise outcome["error"]
+            return outcome["result"]
+
+        try:
+            outcome["result"] = call()
+            return outcome["result"]
+        except Exception as error:
+            outcome["error"] = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            done.set()
+
+    def stats(self):
+        """Function to report how many calls were sent and how many were coalesced"""
+
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._in_flight)}
+
+class SharedTokenBucket(object):
+    """Token bucket shared by every process using the same state file
+
+    Gunicorn workers each refresh the board, so the bucket lives in a
+    small file locked with `fcntl.flock` rather than in memory. Tokens
+    refill at `rate` per second up to `burst`. When the API reports how
+    many calls are left before its window resets (`update`), the refill
+    slows down to spread the remaining calls over the rest of the window.
+
+    Args:
+        path (str): State file shared by the processes, created if missing
+        rate (float): Tokens added per second, the steady request rate
+        burst (int): Maximum tokens kept, the largest burst allowed
+        max_wait (float): Seconds `acquire` may sleep before raising `RateLimited`
+
+    """
+
+    STATE = struct.Struct("<dddd") #tokens, updated_at, paced_rate, paced_until
+
+    def __init__(self, path, rate, burst, max_wait=10):
+        self.path = path
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_wait = max_wait
+        self.sleep = time.sleep
+        self.clock = time.time
+        self.waited = 0.0
+        self._lock = threading.Lock() #flock is per open file, threads of a process need their own lock
+
+    def _transaction(self, change):
+        """Function to read, change and write the state under the locks
+
+        Args:
+            change (callable): Called with (tokens, now, paced_rate, paced_until)
+                and returns (new state tuple, result)
+
+        Returns:
+            The result of `change`.
+        """
+
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                raw = os.read(fd, self.STATE.size)
+                now = self.clock()
+                if len(raw) == self.STATE.size:
+                    tokens, updated_at, paced_rate, paced_until = self.STATE.unpack(raw)
+                else: #New file, start full
+                    tokens, updated_at, paced_rate, paced_until = self.burst, now, 0.0, 0.0
+
+                rate = paced_rate if now < paced_until else self.rate
+                tokens = min(self.burst, tokens + max(0.0, now - updated_at) * rate)
+
+                state, result = change(tokens, now, paced_rate, paced_until)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, self.STATE.pack(*state))
+                return result
+            finally:
+                os.close(fd) #Also releases the flock
+
+    def try_acquire(self):
+        """Function to take a token without waiting
+
+        Returns:
+            0 when a token was taken, otherwise the seconds until one is available.
+        """
+
+        def change(tokens, now, paced_rate, paced_until):
+            if tokens >= 1:
+                return (tokens - 1, now, paced_rate, paced_until), 0.0
+            rate = paced_rate if now < paced_until else self.rate
+            if rate <= 0: #No calls left in this window
+                return (tokens, now, paced_rate, paced_until), max(0.0, paced_until - now)
+            return (tokens, now, paced_rate, paced_until), (1 - tokens) / rate
+
+        return self._transaction(change)
+
+    def acquire(self):
+        """Function to take a token, sleeping until one is available
+
+        Raises:
+            RateLimited: When a token wouldn't free up within `max_wait`.
+        """
+
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            if waited + delay > self.max_wait:
+                raise RateLimited("No MBTA API call available for {:.1f}s".format(delay))
+            self.sleep(delay)
+            waited += delay
+            self.waited += delay
+
+    def update(self, remaining, reset):
+        """Function to pace the bucket with the limits reported by the API
+
+        Args:
+            remaining (int): Calls left in the current window, x-ratelimit-remaining
+            reset (float): Unix timestamp the window resets at, x-ratelimit-reset
+        """
+
+        def change(tokens, now, paced_rate, paced_until):
+            if reset <= now:
+                return (tokens, now, paced_rate, paced_until), None
+            pace = min(self.rate, max(0.0, remaining - tokens) / (reset - now)) #Tokens in hand are already part of what's left
+            return (min(tokens, remaining), now, pace, reset), None
+
+        self._transaction(change)
+
+    def update_from_headers(self, headers):
+        """Function to call `update` with the x-ratelimit headers of a response, if present"""
+
+        try:
+            remaining = int(headers["x-ratelimit-remaining"])
+            reset = float(headers["x-ratelimit-reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+        self.update(remaining, reset)
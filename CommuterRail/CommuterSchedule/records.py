@@ -0,0 +1,140 @@
+class Prediction(object):
+    """One departure on the board
+
+    A slotted record instead of a per-prediction dictionary, several
+    snapshots of every station's board are held in memory at once.
+    Records are shared between snapshots, so they're never modified
+    once built, `replace()` returns a changed copy instead.
+
+    Args:
+        prediction_id (str): The MBTA prediction id
+        departure_time (datetime): Predicted departure, timezone aware
+        status (str): Boarding status, e.g. All aboard, Delayed
+        route_id (str): The MBTA route id, e.g. CR-Lowell
+        trip_id (str): The MBTA trip id
+        stop_id (str): The platform stop id, e.g. North Station-04
+        headsign (str): The destination shown on the board
+        train_number (str): The train number shown on the board
+        platform_code (str): The track number, or None when not assigned yet
+
+    """
+
+    __slots__ = ("prediction_id", "departure_time", "status", "route_id", "trip_id",
+                 "stop_id", "headsign", "train_number", "platform_code")
+
+    def __init__(self, prediction_id, departure_time, status, route_id, trip_id,
+                 stop_id, headsign, train_number, platform_code):
+        self.prediction_id = prediction_id
+        self.departure_time = departure_time
+        self.status = status
+        self.route_id = route_id
+        self.trip_id = trip_id
+        self.stop_id = stop_id
+        self.headsign = headsign
+        self.train_number = train_number
+        self.platform_code = platform_code
+
+    def astuple(self):
+        """Function to return the fields in `__slots__` order"""
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def replace(self, **changes):
+        """Function to return a copy with some fields changed
+
+        Returns:
+            A new `Prediction`.
+        """
+
+        fields = dict(zip(self.__slots__, self.astuple()))
+        fields.update(changes)
+        return Prediction(**fields)
+
+    def as_dict(self, **overrides):
+        """Function to serialize the record for JSON
+
+        Args:
+            overrides: Fields to replace in the output, e.g. a formatted departure_time
+
+        Returns:
+            The Dictionary of every field.
+        """
+
+        fields = dict(zip(self.__slots__, self.astuple()))
+        fields.update(overrides)
+        return fields
+
+    def __eq__(self, other):
+        return isinstance(other, Prediction) and self.astuple() == other.astuple()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<Prediction %s %s %s>" % (self.prediction_id, self.departure_time, self.status)
+
+class StationBoard(object):
+    """The predictions of one station in departure order
+
+    Iterating yields `Prediction` records earliest first, the order the
+    board is shown in, so templates and serializers never sort.
+
+    Args:
+        predictions (iterable of Prediction): Already in departure order, see `sorted`
+
+    """
+
+    __slots__ = ("predictions", "_by_id")
+
+    def __init__(self, predictions):
+        self.predictions = tuple(predictions)
+        self._by_id = None
+
+    @classmethod
+    def sorted(cls, predictions):
+        """Function to build a board from predictions in any order
+
+        Returns:
+            A `StationBoard` sorted by departure time, then prediction id.
+        """
+
+        return cls(sorted(predictions, key=lambda prediction: (prediction.departure_time, prediction.prediction_id)))
+
+    def by_id(self):
+        """Function to look predictions up by id
+
+        Returns:
+            The Dictionary of prediction_id = `Prediction`, built on first use.
+        """
+
+        if self._by_id is None:
+            self._by_id = dict((prediction.prediction_id, prediction) for prediction in self.predictions)
+        return self._by_id
+
+    def __getstate__(self):
+        return (self.predictions,) #The id index is rebuilt on demand
+
+    def __setstate__(self, state):
+        self.predictions = state[0]
+        self._by_id = None
+
+    def __iter__(self):
+        return iter(self.predictions)
+
+    def __len__(self):
+        return len(self.predictions)
+
+    def __getitem__(self, index):
+        return self.predictions[index]
+
+    def __eq__(self, other):
+        return isinstance(other, StationBoard) and self.predictions == other.predictions
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<StationBoard %d predictions>" % len(self.predictions)
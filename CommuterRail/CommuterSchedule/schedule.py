@@ -0,0 +1,94 @@
+import datetime
+from django.utils import timezone
+from CommuterSchedule.models import ScheduledDeparture, ScheduledStop, ServiceDate
+from CommuterSchedule.records import Prediction, StationBoard
+
+SCHEDULED_STATUS = "Scheduled"
+
+def service_day_start(day, tz):
+    """Function to find the origin of GTFS times on a service day
+
+    GTFS measures times from noon minus 12 hours, which is midnight
+    except on the days the clocks change.
+
+    Args:
+        day (datetime.date): The service day
+        tz (tzinfo): The timezone of the feed
+
+    Returns:
+        The timezone aware datetime of 00:00:00 on that service day.
+    """
+
+    noon = tz.localize(datetime.datetime.combine(day, datetime.time(12)))
+    return noon - datetime.timedelta(hours=12)
+
+def resolve_scheduled_station(station):
+    """Function to find the parent station id of a configured station
+
+    Args:
+        station (str): A parent station id, platform id or stop name, e.g. South Station
+
+    Returns:
+        The parent station id, or `station` unchanged if it isn't a scheduled stop.
+    """
+
+    stop = ScheduledStop.objects.filter(stop_id=station).values_list("station_id", flat=True).first()
+    if stop is None:
+        stop = ScheduledStop.objects.filter(name=station).values_list("station_id", flat=True).first()
+    return stop or station
+
+def next_scheduled_departures(station, limit=10, now=None, direction_id=0):
+    """Function to read the next departures of a station from the GTFS schedule
+
+    Trips of yesterday's service still running after midnight, today's
+    and tomorrow's are each a single range scan on the
+    (station_id, direction_id, departure_seconds) index.
+
+    Args:
+        station (str): The station id or name, e.g. place-north
+        limit (int): Maximum number of departures
+        now (datetime): Timezone aware current time, defaults to now
+        direction_id (int): 0 for trains leaving Boston, like the board
+
+    Returns:
+        The `StationBoard` of `Prediction` records with a Scheduled status,
+        or None if nothing is scheduled.
+    """
+
+    tz = timezone.get_default_timezone()
+    now = timezone.localtime(now or timezone.now(), tz)
+    station = resolve_scheduled_station(station)
+
+    predictions = []
+    for offset in (-1, 0, 1):
+        day = now.date() + datetime.timedelta(days=offset)
+        start = service_day_start(day, tz)
+        services = list(ServiceDate.objects.filter(date=day).values_list("service_id", flat=True))
+        if not services:
+            continue
+
+        elapsed = int((now - start).total_seconds())
+        departures = ScheduledDeparture.objects.filter(
+            station_id=station,
+            direction_id=direction_id,
+            departure_seconds__gte=max(0, elapsed),
+            service_id__in=services
+        ).order_by("departure_seconds")[:limit]
+
+        for departure in departures:
+            predictions.append(Prediction(
+                prediction_id="schedule-%s-%s" % (departure.trip_id, day.isoformat()),
+                departure_time=start + datetime.timedelta(seconds=departure.departure_seconds),
+                status=SCHEDULED_STATUS,
+                route_id=departure.route_id,
+                trip_id=departure.trip_id,
+                stop_id=departure.stop_id,
+                headsign=departure.headsign,
+                train_number=departure.train_number,
+                platform_code=departure.platform_code or None #Most tracks are only assigned shortly before departure
+            ))
+
+    if not predictions:
+        return None
+
+    return StationBoard(StationBoard.sorted(predictions)[:limit])
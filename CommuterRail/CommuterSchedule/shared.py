@@ -0,0 +1,184 @@
+import os
+import mmap
+import time
+import struct
+from six.moves import cPickle as pickle
+
+try:
+    import fcntl
+except ImportError: #Without flock every process is its own writer
+    fcntl = None
+
+class SharedBoardTooLarge(Exception):
+    """Raised when a serialized board doesn't fit in the shared segment"""
+
+class SharedBoard(object):
+    """The current board published in a memory-mapped file for every worker
+
+    One process (the one holding the writer lock, see `acquire_writer`)
+    refreshes the board and publishes it, the other workers map the same
+    pages and only deserialize a board when its version changed.
+
+    The segment starts with a seqlock header: the writer makes the
+    sequence odd, writes the board, then makes it even again. Readers
+    retry whenever the sequence was odd or moved while they were copying,
+    so they never see half a board and never block the writer.
+
+    Args:
+        path (str): The shared file, created with `size` bytes if missing
+        size (int): Bytes mapped, header included, the largest board that can be published
+
+    """
+
+    SEQUENCE = struct.Struct("<Q")
+    HEADER = struct.Struct("<QdI8s") #version, fetched_at, length, epoch, after the sequence
+    PAYLOAD_OFFSET = SEQUENCE.size + HEADER.size
+    READ_ATTEMPTS = 100
+
+    def __init__(self, path, size=1024 * 1024):
+        self.path = path
+        self.size = size
+        self.publishes = 0
+        self.reads = 0
+        self.retries = 0
+        self._lock_fd = None
+        self._lock_pid = None
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size) #Zero filled: sequence 0, version 0, nothing published yet
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd) #The mapping stays valid
+
+    @property
+    def capacity(self):
+        """Largest serialized board that fits in the segment"""
+        return self.size - self.PAYLOAD_OFFSET
+
+    def acquire_writer(self):
+        """Function to become the process publishing the board
+
+        The lock is an flock on `path`.lock held as long as the process
+        lives, so another worker takes over when the writer dies. A
+        writer killed in the middle of a publish leaves the sequence odd,
+        the new writer then clears the segment, see `recover`.
+
+        Returns:
+            True if this process is (now) the writer.
+        """
+
+        if fcntl is None:
+            self.recover()
+            return True
+        if self._lock_pid == os.getpid():
+            return True
+
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600) #Forked children need their own open file, flock is shared across fork
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            return False
+
+        self._lock_fd, self._lock_pid = fd, os.getpid()
+        self.recover()
+        return True
+
+    def recover(self):
+        """Function to clear a publish the previous writer didn't finish
+
+        Only called by the writer, so an odd sequence can't be a publish
+        in progress. The half-written board is dropped: the header is
+        zeroed (nothing published) and the sequence made even again.
+
+        Returns:
+            True if the segment had to be cleared.
+        """
+
+        sequence = self.SEQUENCE.unpack_from(self._map, 0)[0]
+        if not sequence & 1:
+            return False
+        self.HEADER.pack_into(self._map, self.SEQUENCE.size, 0, 0.0, 0, b"")
+        self.SEQUENCE.pack_into(self._map, 0, sequence + 1)
+        return True
+
+    def publish(self, version, fetched_at, departures, epoch=""):
+        """Function to write a board into the segment
+
+        Args:
+            version (int): The board version, readers adopt it as is
+            fetched_at (float): Unix timestamp of the refresh
+            departures (dict): Board name to `StationBoard` or None
+            epoch (str): The series of versions, up to 8 ASCII characters, see `BoardRefresher.epoch`
+
+        Raises:
+            SharedBoardTooLarge: When the serialized board exceeds `capacity`.
+        """
+
+        payload = pickle.dumps(departures, pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.capacity:
+            raise SharedBoardTooLarge("The board takes {} bytes, BOARD_SHARED_SIZE only fits {}".format(len(payload), self.capacity))
+
+        sequence = self.SEQUENCE.unpack_from(self._map, 0)[0] | 1
+        self.SEQUENCE.pack_into(self._map, 0, sequence) #Odd, readers retry
+        self._map[self.PAYLOAD_OFFSET:self.PAYLOAD_OFFSET + len(payload)] = payload
+        self.HEADER.pack_into(self._map, self.SEQUENCE.size, version, fetched_at, len(payload), epoch.encode("ascii"))
+        self.SEQUENCE.pack_into(self._map, 0, sequence + 1) #Even again, the board is complete
+        self.publishes += 1
+
+    def version(self):
+        """Function to read the published version without copying the board
+
+        Returns:
+            The version, 0 when nothing was published yet.
+        """
+
+        return self.HEADER.unpack_from(self._map, self.SEQUENCE.size)[0]
+
+    def read(self, known_version=None, known_epoch=None):
+        """Function to read the published board
+
+        Args:
+            known_version (int): Version the caller already has, its board isn't copied again
+            known_epoch (str): Epoch of `known_version`, any epoch when None
+
+        Returns:
+            The Tuple of (version, fetched_at, epoch, departures),
+            departures being None when the version is the known one.
+            None when nothing was published yet.
+        """
+
+        for attempt in range(self.READ_ATTEMPTS):
+            sequence = self.SEQUENCE.unpack_from(self._map, 0)[0]
+            if sequence & 1: #The writer is in the middle of a publish
+                self.retries += 1
+                time.sleep(0)
+                continue
+
+            version, fetched_at, length, epoch = self.HEADER.unpack_from(self._map, self.SEQUENCE.size)
+            epoch = epoch.rstrip(b"\x00").decode("ascii")
+            known = version == known_version and known_epoch in (None, epoch)
+            payload = None
+            if not known and 0 < length <= self.capacity:
+                payload = self._map[self.PAYLOAD_OFFSET:self.PAYLOAD_OFFSET + length]
+
+            if self.SEQUENCE.unpack_from(self._map, 0)[0] != sequence: #Overwritten while copying
+                self.retries += 1
+                continue
+
+            self.reads += 1
+            if not version:
+                return None
+            return version, fetched_at, epoch, pickle.loads(payload) if payload is not None else None
+
+        raise RuntimeError("The shared board kept changing while it was read")
+
+    def close(self):
+        """Function to unmap the segment and give up the writer lock"""
+
+        self._map.close()
+        if self._lock_fd is not None and self._lock_pid == os.getpid():
+            os.close(self._lock_fd)
+        self._lock_fd = self._lock_pid = None
@@ -0,0 +1,282 @@
+import json
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from CommuterSchedule.records import StationBoard
+from CommuterSchedule.ratelimit import RateLimited
+
+logger = logging.getLogger(__name__)
+
+class StreamNotReady(Exception):
+    """Raised when a board is read before the stream sent its first `reset`"""
+
+class StreamRefused(Exception):
+    """Raised when the API answers the stream with a status worth backing off from, e.g. 429"""
+
+def parse_event_stream(lines):
+    """Generator that turns the lines of a text/event-stream into events
+
+    Args:
+        lines (iterable of str): The response lines, without line endings
+
+    Yields:
+        The Tuple of (event name, data) for each complete event.
+    """
+
+    event = None
+    data = []
+
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.rstrip("\r")
+
+        if not line: #A blank line dispatches the event
+            if data:
+                yield event or "message", "\n".join(data)
+            event = None
+            data = []
+            continue
+
+        if line.startswith(":"): #Comments are only keep-alives
+            continue
+
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "event":
+            event = value
+        elif field == "data":
+            data.append(value)
+
+    if data: #The server closed the stream right after an event
+        yield event or "message", "\n".join(data)
+
+class StreamingBoard(object):
+    """In-memory departure board maintained from MBTA streaming events
+
+    Instead of re-parsing the whole `/predictions` document, the board
+    applies `reset`/`add`/`update`/`remove` events as they arrive. Each
+    event only touches the predictions it names, or the predictions
+    pointing at the stop/trip it names, using the same normalization as
+    `MBTACommuterRail.fetch_commuter_rail_predictions`.
+
+    `Prediction` records are never modified, a changed join stores a new
+    copy, so `departures()` can hand them out without copying. Statuses
+    depend on the time (see `MBTACommuterRail.prediction_status`), so
+    they're evaluated again each time the board is read.
+
+    Args:
+        mbta (MBTACommuterRail): Used for the normalization and stop matching
+        stations (dict of str: str): Board name to station id, e.g. `mbta.stations`
+
+    """
+
+    def __init__(self, mbta, stations):
+        self.mbta = mbta
+        self.stations = stations
+        self.events = 0
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._predictions = {} #prediction_id -> Prediction
+        self._statuses = {} #prediction_id -> status sent by the API
+        self._related = {"stop": {}, "trip": {}} #type -> id -> resource
+        self._stop_boards = {} #stop_id -> board name
+        self._dependents = {} #(type, id) -> set of prediction ids that join it
+
+    def apply(self, event, data):
+        """Function to apply one streaming event
+
+        Args:
+            event (str): reset, add, update or remove
+            data (str): The JSON data of the event
+        """
+
+        payload = json.loads(data)
+
+        with self._lock:
+            if event == "reset":
+                self._clear()
+                for resource in payload: #Relations first so predictions can join them right away
+                    if resource["type"] != "prediction":
+                        self._store_related(resource)
+                now = datetime.datetime.now(self.mbta.timezone) #Evaluated once for the whole batch
+                for resource in payload:
+                    if resource["type"] == "prediction":
+                        self._store_prediction(resource, now)
+                self.ready.set()
+            elif event in ("add", "update"):
+                if payload["type"] == "prediction":
+                    self._store_prediction(payload)
+                else:
+                    self._store_related(payload)
+            elif event == "remove":
+                if payload["type"] == "prediction":
+                    self._forget_prediction(payload["id"])
+                elif payload["type"] in self._related:
+                    self._related[payload["type"]].pop(payload["id"], None)
+            self.events += 1
+
+    def _store_related(self, resource):
+        if resource["type"] not in self._related: #Routes aren't shown on the board
+            return
+        self._related[resource["type"]][resource["id"]] = resource
+
+        if resource["type"] == "stop":
+            self._stop_boards.update(self.mbta.map_stops_to_stations([resource], self.stations))
+
+        for prediction_id in self._dependents.get((resource["type"], resource["id"]), ()):
+            self._predictions[prediction_id] = self.mbta.join_related(self._predictions[prediction_id], resource)
+
+    def _store_prediction(self, resource, now=None):
+        self._forget_prediction(resource["id"])
+
+        prediction = self.mbta.normalize_prediction(resource, self._related["stop"], self._related["trip"], now)
+        for key in (("stop", prediction.stop_id), ("trip", prediction.trip_id)):
+            self._dependents.setdefault(key, set()).add(prediction.prediction_id)
+
+        self._predictions[prediction.prediction_id] = prediction
+        self._statuses[prediction.prediction_id] = resource["attributes"]["status"]
+
+    def _forget_prediction(self, prediction_id):
+        stored = self._predictions.pop(prediction_id, None)
+        if stored is None:
+            return
+        del self._statuses[prediction_id]
+        for key in (("stop", stored.stop_id), ("trip", stored.trip_id)):
+            dependents = self._dependents.get(key)
+            if dependents is not None:
+                dependents.discard(prediction_id)
+                if not dependents:
+                    del self._dependents[key]
+
+    def departures(self, wait=None):
+        """Function to read the board in the shape of
+        `MBTACommuterRail.fetch_commuter_rail_departures(combined=True)`
+
+        Args:
+            wait (float): Seconds to wait for the first `reset`
+
+        Returns:
+            The OrderedDictionary of board name = `StationBoard` or None.
+        """
+
+        if not self.ready.wait(wait):
+            raise StreamNotReady("The predictions stream hasn't sent a reset yet")
+
+        now = datetime.datetime.now(self.mbta.timezone)
+        with self._lock:
+            for prediction_id, prediction in self._predictions.items():
+                status = self.mbta.prediction_status(self._statuses[prediction_id], prediction.departure_time, now)
+                if status != prediction.status: #e.g. Delayed turned Departed once its departure time passed
+                    self._predictions[prediction_id] = prediction.replace(status=status)
+            predictions = list(self._predictions.values())
+            stop_boards = dict(self._stop_boards)
+
+        boards = OrderedDict((board, []) for board in self.stations)
+        for prediction in predictions:
+            board = stop_boards.get(prediction.stop_id)
+            if board is not None:
+                boards[board].append(prediction)
+
+        return OrderedDict(
+            (board, StationBoard.sorted(board_predictions) if board_predictions else None)
+            for board, board_predictions in boards.items()
+        )
+
+class PredictionStream(object):
+    """Holds a streaming `/predictions` connection open and feeds a `StreamingBoard`
+
+    Every connect takes a token from the transport's rate limiter, like
+    any other MBTA call. When the API refuses the stream (429 or 5xx, see
+    `MBTATransport.RETRY_STATUSES`) or the limiter has no token, the
+    reconnects back off with the transport's jittered exponential delay
+    until a connection is accepted again.
+
+    Args:
+        mbta (MBTACommuterRail): Provides the key, url and pooled transport
+        board (StreamingBoard): The board the events are applied to
+        params (callable): Returns the `/predictions` parameters, called on every (re)connect
+        read_timeout (float): Seconds without any bytes before the connection is considered dead
+        reconnect_delay (float): Seconds to wait before reconnecting after an error
+        max_backoff (float): Upper bound of the backoff added to `reconnect_delay` after refusals
+
+    """
+
+    def __init__(self, mbta, board, params, read_timeout=60, reconnect_delay=5, max_backoff=300):
+        self.mbta = mbta
+        self.board = board
+        self.params = params
+        self.read_timeout = read_timeout
+        self.reconnect_delay = reconnect_delay
+        self.max_backoff = max_backoff
+        self.connections = 0
+        self.refusals = 0 #In a row, reset by an accepted connection
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def consume(self):
+        """Function to open one streaming connection and apply its events until it closes
+
+        Raises:
+            StreamRefused: When the API answered with a status in `MBTATransport.RETRY_STATUSES`
+            RateLimited: When the rate limiter had no token for the connect
+        """
+
+        transport = self.mbta.transport
+        if transport.limiter is not None:
+            transport.limiter.acquire() #The stream shares the budget of the polled calls
+        response = transport.session.get(
+            self.mbta.mbta_url + self.mbta.predictions_endpoint,
+            params=self.params(),
+            headers={"x-api-key": self.mbta.mbta_key, "Accept": "text/event-stream"},
+            stream=True,
+            timeout=(transport.timeout[0], self.read_timeout)
+        )
+        self.connections += 1
+
+        try:
+            if transport.limiter is not None:
+                transport.limiter.update_from_headers(response.headers)
+            if response.status_code in transport.RETRY_STATUSES:
+                raise StreamRefused("The predictions stream was answered with %d" % response.status_code)
+            response.raise_for_status()
+            self.refusals = 0
+            for event, data in parse_event_stream(response.iter_lines(decode_unicode=True)): #The API sends chunked responses, so each event arrives as soon as it's written
+                if self._stopped.is_set():
+                    break
+                self.board.apply(event, data)
+        finally:
+            response.close()
+
+    def run(self):
+        """Reconnect loop, runs until `stop()` is called"""
+
+        while not self._stopped.is_set():
+            delay = self.reconnect_delay
+            try:
+                self.consume()
+            except (StreamRefused, RateLimited) as error:
+                delay += self.mbta.transport.backoff_delay(self.refusals, self.max_backoff)
+                self.refusals += 1
+                logger.warning("%s, reconnecting in %.1fs", error, delay)
+            except Exception:
+                logger.exception("Predictions stream failed")
+            self._stopped.wait(delay)
+
+    def start(self):
+        """Function to start consuming from a background thread"""
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="predictions-stream")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Function to stop consuming once the current event is applied"""
+
+        self._stopped.set()
@@ -3,6 +3,55 @@ from __future__ import unicode_literals
 
 from django.test import TestCase
 
+def make_prediction(prediction_id, route_id, trip_id, stop_id, departure_time, status=None):
+    """
+    Builds a JSON:API prediction the way `/predictions` returns it.
+    """
+    return {
+        "type": "prediction",
+        "id": prediction_id,
+        "attributes": {"departure_time": departure_time, "status": status},
+        "relationships": {
+            "route": {"data": {"type": "route", "id": route_id}},
+            "trip": {"data": {"type": "trip", "id": trip_id}},
+            "stop": {"data": {"type": "stop", "id": stop_id}}
+        }
+    }
+
+def make_stop(stop_id, name, parent_station, platform_code):
+    return {
+        "type": "stop",
+        "id": stop_id,
+        "attributes": {"name": name, "platform_code": platform_code},
+        "relationships": {"parent_station": {"data": {"type": "stop", "id": parent_station}}}
+    }
+
+def make_trip(trip_id, headsign, name):
+    return {"type": "trip", "id": trip_id, "attributes": {"headsign": headsign, "name": name}}
+
+def make_predictions_response():
+    """
+    A combined North & South Station `/predictions` response.
+    """
+    return {
+        "data": [
+            make_prediction("prediction-1", "CR-Lowell", "trip-1", "North Station-04", "2030-10-23T21:35:00-04:00", "On time"),
+            make_prediction("prediction-2", "CR-Providence", "trip-2", "South Station-09", "2030-10-23T21:40:00-04:00", "All aboard"),
+            make_prediction("prediction-3", "CR-Fitchburg", "trip-3", "North Station-07", "2030-10-23T21:45:00-04:00", "Departed"),
+        ],
+        "included": [
+            make_stop("North Station-04", "North Station", "place-north", "4"),
+            make_stop("South Station-09", "South Station", "place-sstat", "9"),
+            make_stop("North Station-07", "North Station", "place-north", "7"),
+            make_trip("trip-1", "Lowell", "349"),
+            make_trip("trip-2", "Providence", "829"),
+            make_trip("trip-3", "Wachusett", "431"),
+            {"type": "route", "id": "CR-Lowell", "attributes": {}},
+            {"type": "route", "id": "CR-Providence", "attributes": {}},
+            {"type": "route", "id": "CR-Fitchburg", "attributes": {}},
+        ]
+    }
+
 class RetrieveRoutes(TestCase):
     def setUp(self):
         pass
@@ -164,3 +213,1681 @@ class RetrieveRoutes(TestCase):
 
         self.assertIn("north_station", departures)
         self.assertIn("south_station", departures)
+
+class RouteCacheTests(TestCase):
+    def setUp(self):
+        from CommuterSchedule.mbta import MBTACommuterRail, RouteCache
+
+        self.mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        self.mbta.route_cache = RouteCache()
+        self.route_calls = []
+
+        def fetch_routes(station):
+            self.route_calls.append(station)
+            return ["CR-Fitchburg", "CR-Lowell"]
+
+        self.mbta.fetch_station_routes = fetch_routes
+
+    def test_payload_reuses_cached_routes(self):
+        """
+        Building the North Station payload twice should only hit `/routes` once.
+        """
+        first = self.mbta.create_north_station_payload()
+        second = self.mbta.create_north_station_payload()
+
+        self.assertEqual(len(self.route_calls), 1)
+        self.assertEqual(first["filter[route]"], "CR-Fitchburg,CR-Lowell")
+        self.assertEqual(first, second)
+        self.assertEqual(self.mbta.route_cache.stats(), {"hits": 1, "misses": 1, "stations": 1})
+
+    def test_expired_routes_are_refetched(self):
+        """
+        A route list older than its ttl should be fetched again.
+        """
+        self.mbta.route_cache_ttl = -1
+        self.mbta.create_north_station_payload()
+        self.mbta.create_north_station_payload()
+
+        self.assertEqual(len(self.route_calls), 2)
+
+    def test_invalidate(self):
+        """
+        Invalidating a station should force the next payload to refetch its routes.
+        """
+        self.mbta.create_north_station_payload()
+        self.mbta.route_cache.invalidate(self.mbta.north_station)
+        self.mbta.create_north_station_payload()
+
+        self.assertEqual(len(self.route_calls), 2)
+
+    def test_empty_routes_are_not_cached(self):
+        """
+        An empty route list should not be cached so the next request tries again.
+        """
+        self.mbta.fetch_station_routes = lambda station: []
+        self.mbta.create_north_station_payload()
+
+        self.assertEqual(self.mbta.route_cache.stats()["stations"], 0)
+
+class CombinedPredictionsTests(TestCase):
+    def setUp(self):
+        from CommuterSchedule.mbta import MBTACommuterRail, RouteCache
+
+        self.mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        self.mbta.route_cache = RouteCache()
+        station_routes = {"place-north": ["CR-Lowell", "CR-Fitchburg"], "South Station": ["CR-Providence"]}
+        self.mbta.fetch_station_routes = lambda station: station_routes[station]
+        self.requests = []
+
+        def fetch_data_from_mbta(params, endpoint):
+            self.requests.append((endpoint, params))
+            return make_predictions_response()
+
+        self.mbta.fetch_data_from_mbta = fetch_data_from_mbta
+
+    def test_combined_payload(self):
+        """
+        The combined payload should ask for both stations and the union of their routes.
+        """
+        payload = self.mbta.create_combined_payload()
+
+        self.assertEqual(payload["filter[stop]"], "place-north,South Station")
+        self.assertEqual(payload["filter[route]"], "CR-Lowell,CR-Fitchburg,CR-Providence")
+
+    def test_combined_departures_are_split_by_station(self):
+        """
+        One `/predictions` request should come back as separate North & South Station boards.
+        """
+        departures = self.mbta.fetch_commuter_rail_departures(combined=True)
+
+        self.assertEqual(len(self.requests), 1)
+        north_station = departures["north_station"]
+        south_station = departures["south_station"]
+        self.assertEqual([p.prediction_id for p in north_station], ["prediction-1", "prediction-3"])
+        self.assertEqual([p.prediction_id for p in south_station], ["prediction-2"])
+        self.assertEqual(north_station[0].platform_code, "4")
+        self.assertEqual(north_station[1].headsign, "Wachusett")
+        self.assertEqual(north_station[1].status, "Delayed")
+        self.assertEqual(south_station[0].train_number, "829")
+
+    def test_combined_departures_empty_station(self):
+        """
+        A station without predictions in the combined response should still be None.
+        """
+        response = make_predictions_response()
+        response["data"] = response["data"][:1]
+        self.mbta.fetch_data_from_mbta = lambda params, endpoint: response
+
+        departures = self.mbta.fetch_commuter_rail_departures(combined=True)
+
+        self.assertIsNone(departures["south_station"])
+        self.assertEqual(len(departures["north_station"]), 1)
+
+class BoardRefresherTests(TestCase):
+    def setUp(self):
+        from CommuterSchedule.board import BoardRefresher
+
+        self.departures = {"north_station": None, "south_station": None}
+        self.refresher = BoardRefresher(lambda: self.departures, 60)
+
+    def test_no_snapshot_before_first_refresh(self):
+        self.assertIsNone(self.refresher.latest())
+
+    def test_version_only_changes_with_departures(self):
+        """
+        Refreshing identical departures should keep the version, new departures should bump it.
+        """
+        first = self.refresher.refresh_once()
+        second = self.refresher.refresh_once()
+        self.departures = {"north_station": [], "south_station": None}
+        third = self.refresher.refresh_once()
+
+        self.assertEqual((first.version, second.version, third.version), (1, 1, 2))
+        self.assertGreaterEqual(second.fetched_at, first.fetched_at)
+        self.assertIs(self.refresher.latest(), third)
+
+    def test_failed_refresh_keeps_previous_snapshot(self):
+        """
+        The background loop should survive a failing fetch and keep serving the last board.
+        """
+        snapshot = self.refresher.refresh_once()
+
+        def fail():
+            self.refresher.stop()
+            raise ValueError("MBTA is down")
+
+        self.refresher.fetch = fail
+        self.refresher._stopped.clear()
+        self.refresher.run()
+
+        self.assertEqual(self.refresher.failures, 1)
+        self.assertIs(self.refresher.latest(), snapshot)
+
+class MBTATransportTests(TestCase):
+    class FakeResponse(object):
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+        def close(self):
+            pass
+
+    def setUp(self):
+        from CommuterSchedule.transport import MBTATransport
+
+        self.transport = MBTATransport(pool_size=4, retries=2)
+        self.transport.sleep = lambda seconds: None
+        self.outcomes = []
+
+        def get(url, params=None, headers=None, timeout=None):
+            self.assertEqual(timeout, self.transport.timeout)
+            outcome = self.outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        self.transport.session.get = get
+
+    def test_retries_transient_failures(self):
+        """
+        A connection error and a 503 should be retried until the call succeeds.
+        """
+        import requests
+
+        self.outcomes = [requests.ConnectionError(), self.FakeResponse(503), self.FakeResponse(200)]
+
+        response = self.transport.get("https://api-v3.mbta.com/routes")
+
+        stats = self.transport.stats()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((stats["requests"], stats["retries"], stats["failures"]), (3, 2, 0))
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertIsNotNone(stats["latency_p95_ms"])
+
+    def test_retry_budget_is_bounded(self):
+        """
+        Once the retries are used up the last error should surface.
+        """
+        import requests
+
+        self.outcomes = [requests.Timeout(), requests.Timeout(), requests.Timeout(), self.FakeResponse(200)]
+
+        self.assertRaises(requests.Timeout, self.transport.get, "https://api-v3.mbta.com/routes")
+        self.assertEqual(self.transport.stats()["failures"], 1)
+
+    def test_backoff_is_capped(self):
+        for attempt in range(10):
+            self.assertLessEqual(self.transport.backoff_delay(attempt), self.transport.backoff_max)
+
+class BoardTestCase(TestCase):
+    """
+    Installs a process refresher that never starts its thread, views read the
+    board returned by `departures()`.
+    """
+    def departures(self):
+        return {"north_station": None, "south_station": None}
+
+    def setUp(self):
+        import os
+        from CommuterSchedule import board
+
+        self.board = board
+        self.previous = (board._refresher, board._refresher_pid)
+        self.refresher = board.BoardRefresher(self.departures, 60)
+        board._refresher, board._refresher_pid = self.refresher, os.getpid()
+        self.refresher.refresh_once()
+
+    def tearDown(self):
+        self.board._refresher, self.board._refresher_pid = self.previous
+
+    def tag(self, version):
+        """The version a client of this refresher sees, e.g. 3f9a61c2:1"""
+        return "%s:%d" % (self.refresher.epoch, version)
+
+class BoardStreamTests(BoardTestCase):
+
+    def test_stream_sends_board(self):
+        """
+        A new client should get the current board right away, tagged with its version.
+        """
+        from django.test.utils import override_settings
+
+        with override_settings(BOARD_STREAM_HEARTBEAT=0.01, BOARD_STREAM_MAX_AGE=1):
+            response = self.client.get("/board-stream/")
+            events = iter(response.streaming_content)
+            retry = next(events)
+            board = next(events)
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertIn(b"retry:", retry)
+        self.assertTrue(board.startswith(("id: %s\nevent: board\n" % self.tag(1)).encode("ascii")))
+
+    def test_stream_resumes_from_last_event_id(self):
+        """
+        A client that already saw the current version should only get heartbeats.
+        """
+        from django.test.utils import override_settings
+
+        with override_settings(BOARD_STREAM_HEARTBEAT=0.01, BOARD_STREAM_MAX_AGE=1):
+            response = self.client.get("/board-stream/", HTTP_LAST_EVENT_ID=self.tag(1))
+            events = iter(response.streaming_content)
+            next(events)
+            heartbeat = next(events)
+            restarted = self.client.get("/board-stream/", HTTP_LAST_EVENT_ID="0badf00d:1") #Same number before a restart
+            restarted_events = iter(restarted.streaming_content)
+            next(restarted_events)
+            board = next(restarted_events)
+
+        self.assertTrue(heartbeat.startswith(b"event: heartbeat\n"))
+        self.assertTrue(board.startswith(("id: %s\nevent: board\n" % self.tag(1)).encode("ascii")))
+
+def make_recorded_stream():
+    """
+    Events as sent by `/predictions` with `Accept: text/event-stream`.
+    """
+    import json
+
+    response = make_predictions_response()
+    updated = make_prediction("prediction-1", "CR-Lowell", "trip-1", "North Station-04", "2030-10-23T21:39:00-04:00", "Delayed")
+    added = make_prediction("prediction-4", "CR-Haverhill", "trip-4", "North Station-02", "2030-10-23T21:50:00-04:00")
+
+    events = [
+        ("reset", response["data"] + response["included"]),
+        ("update", updated),
+        ("add", make_stop("North Station-02", "North Station", "place-north", None)),
+        ("add", added),
+        ("add", make_trip("trip-4", "Haverhill", "215")),
+        ("update", make_stop("North Station-02", "North Station", "place-north", "2")),
+        ("remove", {"type": "prediction", "id": "prediction-2"}),
+    ]
+
+    return ": keep-alive\n\n" + "".join(
+        "event: %s\ndata: %s\n\n" % (event, json.dumps(data)) for event, data in events
+    )
+
+class StreamingBoardTests(TestCase):
+    def setUp(self):
+        from six.moves import BaseHTTPServer
+        import threading
+        from CommuterSchedule.mbta import MBTACommuterRail
+        from CommuterSchedule.transport import MBTATransport
+
+        recorded = make_recorded_stream().encode("utf-8")
+        self.requests = []
+        requests = self.requests
+
+        class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append((self.path, self.headers.get("Accept")))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                self.wfile.write(recorded)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), ReplayHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.mbta = MBTACommuterRail("", "https://api-v3.mbta.com", transport=MBTATransport())
+        self.mbta.mbta_url = "http://127.0.0.1:%d" % self.server.server_address[1] #Point the client at the stand-in server
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_replayed_stream_builds_board(self):
+        """
+        Replaying a recorded stream should leave the board in its final state.
+        """
+        from CommuterSchedule.streaming import PredictionStream, StreamingBoard
+
+        board = StreamingBoard(self.mbta, self.mbta.stations)
+        stream = PredictionStream(self.mbta, board, lambda: {"filter[stop]": "place-north,South Station"})
+        stream.consume()
+
+        departures = board.departures(wait=0)
+        north_station = departures["north_station"]
+
+        self.assertEqual(self.requests[0][1], "text/event-stream")
+        self.assertEqual(board.events, 7)
+        self.assertEqual([p.prediction_id for p in north_station], ["prediction-1", "prediction-3", "prediction-4"])
+        self.assertEqual(north_station[0].status, "Delayed")
+        self.assertEqual(north_station[0].platform_code, "4")
+        self.assertEqual(north_station[2].headsign, "Haverhill")
+        self.assertEqual(north_station[2].platform_code, "2")
+        self.assertIsNone(departures["south_station"])
+
+    def test_statuses_follow_the_clock(self):
+        """
+        A Departed prediction shown as Delayed while its departure is ahead should read Departed once it's passed.
+        """
+        import json
+        import time
+        import datetime
+        from CommuterSchedule.utils import UTC
+        from CommuterSchedule.streaming import StreamingBoard
+
+        board = StreamingBoard(self.mbta, self.mbta.stations)
+        departure_time = (datetime.datetime.now(UTC()) + datetime.timedelta(seconds=0.5)).isoformat()
+        board.apply("reset", json.dumps([
+            make_stop("North Station-04", "North Station", "place-north", "4"),
+            make_prediction("prediction-1", "CR-Lowell", "trip-1", "North Station-04", departure_time, "Departed")
+        ]))
+
+        self.assertEqual(board.departures(wait=0)["north_station"][0].status, "Delayed")
+        time.sleep(0.6)
+        self.assertEqual(board.departures(wait=0)["north_station"][0].status, "Departed")
+
+    def test_refused_stream_backs_off(self):
+        """
+        Every reconnect should take a limiter token, and 429s should back off exponentially instead of waiting a fixed delay.
+        """
+        from CommuterSchedule.streaming import PredictionStream, StreamingBoard
+
+        acquired, delays = [], []
+
+        class Limiter(object):
+            def acquire(self):
+                acquired.append(True)
+
+            def update_from_headers(self, headers):
+                pass
+
+        class Throttled(object):
+            status_code = 429
+            headers = {}
+
+            def close(self):
+                pass
+
+        class Stopped(object): #Stands in for the threading.Event, stops after three reconnects
+            def is_set(self):
+                return len(delays) >= 3
+
+            def wait(self, delay):
+                delays.append(delay)
+
+        transport = self.mbta.transport
+        transport.limiter = Limiter()
+        transport.session.get = lambda *args, **kwargs: Throttled()
+        transport.backoff_delay = lambda attempt, cap=None: min(cap, 2 ** attempt)
+        stream = PredictionStream(self.mbta, StreamingBoard(self.mbta, self.mbta.stations), dict, reconnect_delay=5, max_backoff=3)
+        stream._stopped = Stopped()
+        stream.run()
+
+        self.assertEqual(len(acquired), 3)
+        self.assertEqual(delays, [6, 7, 8])
+        self.assertEqual(stream.refusals, 3)
+
+    def test_board_not_ready_before_reset(self):
+        from CommuterSchedule.streaming import StreamingBoard, StreamNotReady
+
+        board = StreamingBoard(self.mbta, self.mbta.stations)
+
+        self.assertRaises(StreamNotReady, board.departures, 0)
+
+    def test_parse_event_stream(self):
+        from CommuterSchedule.streaming import parse_event_stream
+
+        lines = [": ping", "", "event: add", "data: {\"a\":", "data: 1}", "", "data: 2"]
+
+        self.assertEqual(list(parse_event_stream(lines)), [("add", "{\"a\":\n1}"), ("message", "2")])
+
+class ConditionalRequestTests(TestCase):
+    class FakeResponse(object):
+        def __init__(self, status_code, data=None, headers=None):
+            self.status_code = status_code
+            self.data = data
+            self.headers = headers or {}
+            self.parsed = 0
+
+        def json(self):
+            self.parsed += 1
+            return self.data
+
+    def setUp(self):
+        from CommuterSchedule.mbta import MBTACommuterRail, ConditionalCache
+
+        self.mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        self.mbta.conditional_cache = ConditionalCache()
+        self.sent_headers = []
+        self.responses = []
+        test = self
+
+        class FakeTransport(object):
+            def get(self, url, params=None, headers=None):
+                test.sent_headers.append(dict(headers))
+                response = test.responses.pop(0)
+                return response() if callable(response) else response #A callable runs while the request is in flight
+
+        self.mbta.transport = FakeTransport()
+        self.params = {"filter[stop]": "place-north,South Station"}
+        self.stations = self.mbta.stations
+
+    def test_not_modified_reuses_normalized_board(self):
+        """
+        A 304 should send the validator back and reuse the board normalized from the first response.
+        """
+        last_modified = "Tue, 23 Oct 2018 21:30:00 GMT"
+        self.responses = [
+            self.FakeResponse(200, make_predictions_response(), {"Last-Modified": last_modified}),
+            self.FakeResponse(304),
+        ]
+
+        first = self.mbta.fetch_commuter_rail_predictions(self.params, self.stations)
+        second = self.mbta.fetch_commuter_rail_predictions(self.params, self.stations)
+
+        self.assertNotIn("If-Modified-Since", self.sent_headers[0])
+        self.assertEqual(self.sent_headers[1]["If-Modified-Since"], last_modified)
+        self.assertIs(first, second)
+        stats = self.mbta.conditional_cache.stats()
+        self.assertEqual((stats["not_modified"], stats["parses_saved"]), (1, 1))
+
+    def test_modified_response_is_parsed(self):
+        """
+        A 200 after a validator was sent should be parsed and normalized again.
+        """
+        self.responses = [
+            self.FakeResponse(200, make_predictions_response(), {"Last-Modified": "Tue, 23 Oct 2018 21:30:00 GMT"}),
+            self.FakeResponse(200, make_predictions_response(), {"Last-Modified": "Tue, 23 Oct 2018 21:31:00 GMT"}),
+        ]
+
+        first = self.mbta.fetch_commuter_rail_predictions(self.params, self.stations)
+        second = self.mbta.fetch_commuter_rail_predictions(self.params, self.stations)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(first, second)
+        self.assertEqual(self.mbta.conditional_cache.stats()["parses_saved"], 0)
+
+    def test_reused_board_statuses_follow_the_clock(self):
+        """
+        A board reused after a 304 should show Departed once the departure time it was Delayed for has passed.
+        """
+        import datetime
+        from CommuterSchedule.utils import UTC
+
+        response = make_predictions_response()
+        board = self.mbta.normalize_predictions_response(response, self.stations)
+        before = datetime.datetime(2030, 10, 24, 1, 40, tzinfo=UTC()) #21:40 in Boston
+        after = datetime.datetime(2030, 10, 24, 1, 50, tzinfo=UTC())
+
+        self.assertIs(self.mbta.refresh_statuses(board, response, before), board)
+        refreshed = self.mbta.refresh_statuses(board, response, after)
+        self.assertEqual([prediction.status for prediction in refreshed["north_station"]], ["On time", "Departed"])
+        self.assertIs(refreshed["north_station"][0], board["north_station"][0])
+        self.assertIs(refreshed["south_station"], board["south_station"])
+
+    def test_evicted_response_is_requested_again(self):
+        """
+        A 304 for a response evicted since its validator was sent should be fetched again without the validator.
+        """
+        from CommuterSchedule.mbta import ConditionalCache
+
+        cache = self.mbta.conditional_cache = ConditionalCache(max_entries=1)
+        last_modified = "Tue, 23 Oct 2018 21:30:00 GMT"
+
+        def evicted_meanwhile():
+            cache.store(("/routes", ()), last_modified, {}) #Another request pushes ours out
+            return self.FakeResponse(304)
+
+        self.responses = [
+            self.FakeResponse(200, make_predictions_response(), {"Last-Modified": last_modified}),
+            evicted_meanwhile,
+            self.FakeResponse(200, make_predictions_response(), {"Last-Modified": last_modified}),
+        ]
+
+        first = self.mbta.fetch_commuter_rail_predictions(self.params, self.stations)
+        second = self.mbta.fetch_commuter_rail_predictions(self.params, self.stations)
+
+        self.assertEqual(self.sent_headers[1]["If-Modified-Since"], last_modified)
+        self.assertNotIn("If-Modified-Since", self.sent_headers[2])
+        self.assertEqual(first, second)
+        self.assertEqual(cache.stats()["evicted"], 1)
+
+class PageInfoDeltaTests(BoardTestCase):
+    def departures(self):
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        return mbta.normalize_predictions_response(self.response, mbta.stations)
+
+    def setUp(self):
+        self.response = make_predictions_response()
+        super(PageInfoDeltaTests, self).setUp()
+
+    def page_info(self, version=None):
+        import json
+
+        data = {} if version is None else {"version": version}
+        response = self.client.post("/page-info/", data, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        return json.loads(response.content.decode("utf-8"))
+
+    def test_full_board_without_version(self):
+        info = self.page_info()
+
+        self.assertEqual(info["version"], self.tag(1))
+        self.assertEqual(len(info["north_station"]), 2)
+
+    def test_not_modified(self):
+        info = self.page_info(self.tag(1))
+
+        self.assertTrue(info["not_modified"])
+        self.assertNotIn("north_station", info)
+
+    def test_delta_from_recent_version(self):
+        """
+        A client on an older version should only get the predictions that changed.
+        """
+        self.response["data"][0]["attributes"]["status"] = "Boarding"
+        del self.response["data"][1]
+        self.response["data"].append(make_prediction("prediction-4", "CR-Lowell", "trip-1", "North Station-04", "2030-10-23T22:35:00-04:00"))
+        self.refresher.refresh_once()
+
+        info = self.page_info(self.tag(1))
+
+        north_station = info["delta"]["north_station"]
+        south_station = info["delta"]["south_station"]
+        self.assertEqual((info["base_version"], info["version"]), (self.tag(1), self.tag(2)))
+        self.assertEqual([p["prediction_id"] for p in north_station["changed"]], ["prediction-1"])
+        self.assertEqual(north_station["changed"][0]["status"], "Boarding")
+        self.assertEqual([p["prediction_id"] for p in north_station["added"]], ["prediction-4"])
+        self.assertEqual(north_station["order"], ["prediction-1", "prediction-3", "prediction-4"])
+        self.assertEqual(south_station["removed"], ["prediction-2"])
+        self.assertEqual(south_station["order"], [])
+
+    def test_unknown_version_gets_full_board(self):
+        info = self.page_info(self.tag(42))
+
+        self.assertNotIn("delta", info)
+        self.assertEqual(info["version"], self.tag(1))
+
+    def test_version_of_another_process_gets_full_board(self):
+        """
+        Version numbers restart in every process, only the epoch tells them apart.
+        """
+        self.refresher.refresh_once()
+        other = self.page_info("0badf00d:1")
+        legacy = self.page_info(1)
+
+        self.assertNotIn("not_modified", other)
+        self.assertNotIn("delta", other)
+        self.assertEqual(len(other["north_station"]), 2)
+        self.assertNotIn("not_modified", legacy)
+
+    def test_payload_prepared_once_and_gzipped(self):
+        """
+        Polls of the same version should share the prepared bytes, gzipped for clients that accept it.
+        """
+        import zlib
+        from CommuterSchedule import views
+
+        built = []
+        page_info = views.page_info
+        views.page_info = lambda *args: built.append(args) or page_info(*args)
+        self.addCleanup(setattr, views, "page_info", page_info)
+
+        plain = self.client.post("/page-info/", HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        gzipped = self.client.post("/page-info/", HTTP_X_REQUESTED_WITH="XMLHttpRequest", HTTP_ACCEPT_ENCODING="gzip, br")
+        refused = self.client.post("/page-info/", HTTP_X_REQUESTED_WITH="XMLHttpRequest", HTTP_ACCEPT_ENCODING="gzip;q=0, br")
+
+        self.assertEqual(len(built), 1)
+        self.assertEqual(gzipped["Content-Encoding"], "gzip")
+        self.assertEqual(zlib.decompress(gzipped.content, 16 + zlib.MAX_WBITS), plain.content)
+        self.assertEqual(int(gzipped["Content-Length"]), len(gzipped.content))
+        self.assertEqual(int(plain["Content-Length"]), len(plain.content))
+        self.assertFalse(plain.has_header("Content-Encoding") or refused.has_header("Content-Encoding"))
+        self.assertEqual(plain["Vary"], "Accept-Encoding")
+
+class PredictionRecordTests(TestCase):
+    def setUp(self):
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        self.mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        self.board = self.mbta.normalize_predictions_response(make_predictions_response(), self.mbta.stations)["north_station"]
+
+    def test_records_are_slotted(self):
+        prediction = self.board[0]
+
+        self.assertFalse(hasattr(prediction, "__dict__"))
+        self.assertRaises(AttributeError, setattr, prediction, "color", "purple")
+
+    def test_replace_returns_copy(self):
+        prediction = self.board[0]
+        boarding = prediction.replace(status="Boarding")
+
+        self.assertEqual(prediction.status, "On time")
+        self.assertEqual(boarding.status, "Boarding")
+        self.assertNotEqual(prediction, boarding)
+        self.assertEqual(prediction, boarding.replace(status="On time"))
+
+    def test_shared_stop_joins_every_prediction(self):
+        """
+        Every prediction leaving from a platform should get its track number, not only the last one.
+        """
+        response = make_predictions_response()
+        response["data"][2]["relationships"]["stop"]["data"]["id"] = "North Station-04"
+
+        board = self.mbta.normalize_predictions_response(response, self.mbta.stations)["north_station"]
+
+        self.assertEqual([p.platform_code for p in board], ["4", "4"])
+
+    def test_sorted_board(self):
+        from CommuterSchedule.records import StationBoard
+
+        board = StationBoard.sorted(reversed(self.board.predictions))
+
+        self.assertEqual(board, self.board)
+        self.assertEqual(board.by_id()["prediction-3"].headsign, "Wachusett")
+        self.assertEqual(board[0].as_dict()["train_number"], "349")
+
+class IndexTests(BoardTestCase):
+    def departures(self):
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        return mbta.normalize_predictions_response(make_predictions_response(), mbta.stations)
+
+    def test_index_renders_board(self):
+        response = self.client.get("/")
+
+        self.assertContains(response, "<td>Wachusett</td>", html=False)
+        self.assertContains(response, "<td>829</td>", html=False)
+
+    def test_rows_are_rendered_once_per_version(self):
+        """
+        Pages of the same board version should reuse the rendered station rows,
+        a new version should render them again.
+        """
+        from CommuterSchedule import views
+
+        rendered = []
+        render_to_string = views.render_to_string
+
+        def counting_render_to_string(template_name, context):
+            rendered.append(template_name)
+            return render_to_string(template_name, context)
+
+        views.render_to_string = counting_render_to_string
+        self.addCleanup(setattr, views, "render_to_string", render_to_string)
+
+        self.client.get("/")
+        self.client.get("/")
+        self.assertEqual(rendered, ["station_rows.html", "station_rows.html"])
+
+        self.refresher.fetch = lambda: {"north_station": None, "south_station": None}
+        self.refresher.refresh_once()
+        response = self.client.get("/")
+        self.assertEqual(len(rendered), 4)
+        self.assertContains(response, "No more commuter rails for the night!", count=2)
+
+class TimestampParsingTests(TestCase):
+    def test_matches_dateutil(self):
+        import dateutil.parser
+        from CommuterSchedule.utils import parse_iso8601
+
+        for value in ("2018-10-23T21:35:00-04:00", "2018-03-11T02:05:09+05:30", "2018-10-23T21:35:00.125Z"):
+            parsed = parse_iso8601(value)
+            self.assertEqual(parsed, dateutil.parser.parse(value))
+            self.assertEqual(parsed.utcoffset(), dateutil.parser.parse(value).utcoffset())
+
+    def test_rejects_other_formats(self):
+        from CommuterSchedule.utils import parse_iso8601
+
+        for value in ("2018-10-23 21:35:00-04:00", "2018-10-23T21:35:00", "2018-10-23T21:35:00-0400", "tomorrow"):
+            self.assertRaises(ValueError, parse_iso8601, value)
+
+    def test_other_formats_fall_back_to_dateutil(self):
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+
+        self.assertEqual(mbta.parse_timestamp("2018-10-23 21:35:00-04:00"), mbta.parse_timestamp("2018-10-23T21:35:00-04:00"))
+
+def make_gtfs_feed(path):
+    """
+    Writes a tiny GTFS zip: Back Bay and South Station on CR-Providence,
+    Back Bay also on the Orange Line which isn't commuter rail. Weekday
+    service runs the week of 2030-10-21, except on Friday.
+    """
+    import zipfile
+
+    tables = {
+        "stops.txt": "﻿stop_id,stop_name,parent_station\n"
+                     "place-bbsta,Back Bay,\n"
+                     "BNT-0000-02,Back Bay,place-bbsta\n"
+                     "70014,Back Bay,place-bbsta\n"
+                     "place-sstat,South Station,\n"
+                     "NEC-2287-03,South Station,place-sstat\n",
+        "routes.txt": "route_id,route_type\nCR-Providence,2\nOrange,1\n",
+        "trips.txt": "route_id,service_id,trip_id,trip_headsign,trip_short_name,direction_id\n"
+                     "CR-Providence,weekday,trip-1,Providence,821,0\n"
+                     "CR-Providence,weekday,trip-3,Wickford Junction,825,0\n"
+                     "Orange,weekday,trip-2,Oak Grove,,1\n",
+        "stop_times.txt": "trip_id,arrival_time,departure_time,stop_id,stop_sequence,pickup_type\n"
+                          "trip-1,06:10:00,06:10:00,NEC-2287-03,1,0\n"
+                          "trip-1,06:15:00,06:15:00,BNT-0000-02,2,0\n"
+                          "trip-3,24:20:00,24:20:00,NEC-2287-03,1,0\n"
+                          "trip-3,24:25:00,24:25:00,BNT-0000-02,2,1\n"
+                          "trip-2,06:00:00,06:00:00,70014,1,0\n",
+        "calendar.txt": "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+                        "weekday,1,1,1,1,1,0,0,20301021,20301027\n",
+        "calendar_dates.txt": "service_id,date,exception_type\nweekday,20301025,2\n",
+    }
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, content in tables.items():
+            archive.writestr(name, content.encode("utf-8"))
+
+class StationRegistryTests(TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        from CommuterSchedule.gtfs import StationRegistry
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "MBTA_GTFS.zip")
+        make_gtfs_feed(path)
+        self.registry = StationRegistry.from_gtfs(path)
+
+    def test_index(self):
+        self.assertEqual(self.registry.routes_for("place-bbsta"), ["CR-Providence"])
+        self.assertEqual(self.registry.routes_for("Back Bay"), ["CR-Providence"])
+        self.assertEqual(self.registry.resolve("South Station"), "place-sstat")
+        self.assertEqual(self.registry.parent_of("BNT-0000-02"), "place-bbsta")
+        self.assertEqual(self.registry.name_of("NEC-2287-03"), "South Station")
+        self.assertIsNone(self.registry.routes_for("place-north"))
+
+    def test_board_without_routes_endpoint(self):
+        """
+        Stations known to the registry should never ask `/routes`, and their
+        platforms should be matched to the board through the index.
+        """
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com", stations=[("back_bay", "Back Bay")], registry=self.registry)
+
+        def fetch_data_from_mbta(params, endpoint):
+            self.assertEqual(endpoint, "/predictions")
+            return {
+                "data": [make_prediction("prediction-1", "CR-Providence", "trip-1", "BNT-0000-02", "2030-10-23T21:35:00-04:00")],
+                "included": [make_stop("BNT-0000-02", "Back Bay", None, "2"), make_trip("trip-1", "Providence", "821")]
+            }
+
+        mbta.fetch_data_from_mbta = fetch_data_from_mbta
+        payload = mbta.create_combined_payload()
+        departures = mbta.fetch_commuter_rail_departures(combined=True)
+
+        self.assertEqual(payload["filter[stop]"], "place-bbsta")
+        self.assertEqual(payload["filter[route]"], "CR-Providence")
+        self.assertEqual([p.train_number for p in departures["back_bay"]], ["821"])
+
+class ScheduledDeparturesTests(TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        from django.core.management import call_command
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "MBTA_GTFS.zip")
+        make_gtfs_feed(path)
+        call_command("load_gtfs_schedule", path, batch_size=2, stdout=open(os.devnull, "w"))
+
+    def local(self, *args):
+        from django.utils import timezone
+        import datetime
+
+        return timezone.get_default_timezone().localize(datetime.datetime(*args))
+
+    def test_load(self):
+        from CommuterSchedule.models import ScheduledDeparture, ServiceDate
+
+        self.assertEqual(ScheduledDeparture.objects.count(), 3) #No Orange Line, no drop off only stop
+        self.assertEqual(ServiceDate.objects.count(), 4)
+
+    def test_next_departures(self):
+        """
+        Monday night should list the train leaving after midnight, then Tuesday's trains.
+        """
+        from CommuterSchedule.schedule import next_scheduled_departures
+
+        board = next_scheduled_departures("South Station", limit=5, now=self.local(2030, 10, 21, 23, 0))
+
+        self.assertEqual([p.train_number for p in board], ["825", "821", "825"])
+        self.assertEqual(board[0].departure_time, self.local(2030, 10, 22, 0, 20))
+        self.assertEqual(board[1].departure_time, self.local(2030, 10, 22, 6, 10))
+        self.assertEqual(board[0].status, "Scheduled")
+        self.assertIsNone(next_scheduled_departures("South Station", now=self.local(2030, 10, 25, 23, 0))) #No service on Friday or the weekend
+
+    def test_board_falls_back_to_schedule(self):
+        from CommuterSchedule.board import with_scheduled_departures
+        from CommuterSchedule.records import StationBoard
+
+        realtime = StationBoard([])
+        fetch = with_scheduled_departures(lambda: {"north_station": realtime, "south_station": None}, 10)
+        departures = fetch()
+
+        self.assertIs(departures["north_station"], realtime)
+        self.assertIsNone(departures["south_station"]) #Nothing scheduled in the current week
+
+class FanOutTests(TestCase):
+    def setUp(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from CommuterSchedule.mbta import MBTACommuterRail
+        from CommuterSchedule.records import StationBoard
+
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.executor.shutdown)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.mbta = MBTACommuterRail("", "https://api-v3.mbta.com", stations=[
+            ("north_station", "place-north"), ("south_station", "South Station"), ("back_bay", "place-bbsta")
+        ])
+        self.boards = dict((station, StationBoard([])) for station in self.mbta.stations.values())
+
+    def test_stations_are_fetched_concurrently(self):
+        """
+        Every station should be in flight at the same time.
+        """
+        in_flight = []
+
+        def fetch_station_departures(station):
+            in_flight.append(station)
+            while len(in_flight) < len(self.mbta.stations): #Only returns once every station started
+                if self.release.wait(0.01):
+                    raise AssertionError("Stations were fetched one after another")
+            return self.boards[station]
+
+        self.mbta.fetch_station_departures = fetch_station_departures
+        departures = self.mbta.fetch_commuter_rail_departures(executor=self.executor, deadline=5)
+
+        self.assertEqual(list(departures), ["north_station", "south_station", "back_bay"])
+        self.assertIs(departures["back_bay"], self.boards["place-bbsta"])
+        self.assertEqual(sorted(self.mbta.station_timings), ["back_bay", "north_station", "south_station"])
+
+    def test_station_stages_reach_the_calling_thread(self):
+        """
+        Stages timed on the pool threads should be collected by the thread that fanned out.
+        """
+        from CommuterSchedule.metrics import collect, timed
+
+        def fetch_station_departures(station):
+            with timed("predictions"):
+                if station == "place-bbsta":
+                    raise ValueError(station)
+                return self.boards[station]
+
+        self.mbta.fetch_station_departures = fetch_station_departures
+        with collect() as timings:
+            self.mbta.fetch_commuter_rail_departures(executor=self.executor, deadline=5)
+
+        self.assertEqual([stage for stage, seconds in timings], ["predictions"] * 3) #Failed stations too
+        self.assertIsNotNone(self.mbta.station_timings["back_bay"])
+
+    def test_late_station_keeps_stale_board(self):
+        """
+        A station missing the deadline should keep its previous board without holding the others up.
+        """
+        stale = object()
+
+        def fetch_station_departures(station):
+            if station == "South Station":
+                self.release.wait(5)
+            return self.boards[station]
+
+        self.mbta.fetch_station_departures = fetch_station_departures
+        departures = self.mbta.fetch_commuter_rail_departures(
+            executor=self.executor, deadline=0.2, stale={"south_station": stale}
+        )
+
+        self.assertIs(departures["south_station"], stale)
+        self.assertIs(departures["north_station"], self.boards["place-north"])
+        self.assertIsNone(self.mbta.station_timings["south_station"])
+        self.assertIsNotNone(self.mbta.station_timings["north_station"])
+
+    def test_all_stations_failing_raises(self):
+        def fetch_station_departures(station):
+            raise ValueError(station)
+
+        self.mbta.fetch_station_departures = fetch_station_departures
+
+        self.assertRaises(Exception, self.mbta.fetch_commuter_rail_departures, executor=self.executor, deadline=1)
+
+class SingleFlightTests(TestCase):
+    def test_concurrent_calls_are_coalesced(self):
+        """
+        Callers arriving while a fetch is in flight should get its result instead of fetching again.
+        """
+        import threading
+        from CommuterSchedule.mbta import MBTACommuterRail
+        from CommuterSchedule.ratelimit import SingleFlight
+
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        mbta.single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        fetches = []
+
+        def fetch(params, endpoint, cache_key):
+            fetches.append(cache_key)
+            started.set()
+            release.wait(5)
+            return {"data": []}
+
+        mbta._fetch_data_from_mbta = fetch
+        results = []
+        first = threading.Thread(target=lambda: results.append(mbta.fetch_data_from_mbta({"filter[stop]": "place-north"}, "/routes")))
+        first.start()
+        started.wait(5)
+        others = [
+            threading.Thread(target=lambda: results.append(mbta.fetch_data_from_mbta({"filter[stop]": "place-north"}, "/routes")))
+            for _ in range(3)
+        ]
+        for thread in others:
+            thread.start()
+        while mbta.single_flight.stats()["coalesced"] < 3:
+            release.wait(0.01)
+        release.set()
+        for thread in [first] + others:
+            thread.join()
+
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_errors_are_shared(self):
+        from CommuterSchedule.ratelimit import SingleFlight
+
+        def fail():
+            raise ValueError("upstream")
+
+        self.assertRaises(ValueError, SingleFlight().do, "key", fail)
+
+class SharedTokenBucketTests(TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "ratelimit")
+        self.now = [1000.0]
+        self.sleeps = []
+
+    def bucket(self, rate=2, burst=3, max_wait=10):
+        from CommuterSchedule.ratelimit import SharedTokenBucket
+
+        bucket = SharedTokenBucket(self.path, rate, burst, max_wait)
+        bucket.clock = lambda: self.now[0]
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now[0] += seconds
+
+        bucket.sleep = sleep
+        return bucket
+
+    def test_buckets_share_tokens(self):
+        """
+        Two processes (two buckets on the same file) should share one burst.
+        """
+        first, second = self.bucket(), self.bucket()
+
+        first.acquire()
+        second.acquire()
+        first.acquire()
+        self.assertEqual(self.sleeps, [])
+
+        second.acquire()
+        self.assertEqual(self.sleeps, [0.5]) #2 tokens per second
+
+    def test_remaining_calls_slow_the_rate(self):
+        """
+        With 2 calls left for the next 10 seconds, calls should be spread over the window.
+        """
+        from CommuterSchedule.ratelimit import RateLimited
+
+        bucket = self.bucket(max_wait=30)
+        bucket.update_from_headers({"x-ratelimit-remaining": "2", "x-ratelimit-reset": str(self.now[0] + 10)})
+
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(self.sleeps, [])
+        self.assertRaises(RateLimited, self.bucket(max_wait=5).acquire) #Nothing left until the reset
+
+    def test_transport_takes_tokens(self):
+        from CommuterSchedule.transport import MBTATransport
+
+        limiter = self.bucket(burst=1)
+        transport = MBTATransport(limiter=limiter)
+        response = MBTATransportTests.FakeResponse(200)
+        response.headers = {"x-ratelimit-remaining": "900", "x-ratelimit-reset": str(self.now[0] + 60)}
+        transport.session.get = lambda *args, **kwargs: response
+
+        transport.get("https://api-v3.mbta.com/routes")
+        transport.get("https://api-v3.mbta.com/routes")
+
+        self.assertEqual(self.sleeps, [0.5])
+        self.assertEqual(transport.stats()["rate_limit_wait_s"], 0.5)
+
+class SharedBoardTests(TestCase):
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "board")
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        self.departures = mbta.normalize_predictions_response(make_predictions_response(), mbta.stations)
+
+    def shared(self):
+        from CommuterSchedule.shared import SharedBoard
+
+        shared = SharedBoard(self.path, 64 * 1024)
+        self.addCleanup(shared.close)
+        return shared
+
+    def test_publish_and_read(self):
+        writer, reader = self.shared(), self.shared()
+
+        self.assertIsNone(reader.read())
+        writer.publish(3, 1000.0, self.departures, "3f9a61c2")
+
+        version, fetched_at, epoch, departures = reader.read()
+        self.assertEqual((version, fetched_at), (3, 1000.0))
+        self.assertEqual(departures, self.departures)
+        self.assertEqual(departures["north_station"].by_id()["prediction-3"].headsign, "Wachusett")
+        self.assertEqual(epoch, "3f9a61c2")
+        self.assertEqual(reader.read(known_version=3, known_epoch="3f9a61c2"), (3, 1000.0, "3f9a61c2", None)) #Nothing copied for a known version
+        self.assertEqual(reader.read(known_version=3, known_epoch="0badf00d")[3], self.departures) #Same number, another board
+
+    def test_reader_retries_during_publish(self):
+        writer, reader = self.shared(), self.shared()
+        writer.publish(1, 1000.0, self.departures)
+        writer.SEQUENCE.pack_into(writer._map, 0, 3) #A publish in progress
+
+        self.assertRaises(RuntimeError, reader.read)
+        self.assertEqual(reader.retries, reader.READ_ATTEMPTS)
+
+    def test_too_large(self):
+        from CommuterSchedule.shared import SharedBoard, SharedBoardTooLarge
+
+        shared = SharedBoard(self.path + "-small", 64)
+        self.addCleanup(shared.close)
+
+        self.assertRaises(SharedBoardTooLarge, shared.publish, 1, 1000.0, self.departures)
+
+    def test_only_the_writer_fetches(self):
+        """
+        Two workers on the same shared board should fetch once and agree on the version.
+        """
+        from CommuterSchedule.board import SharedBoardRefresher
+
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            return self.departures
+
+        writer = SharedBoardRefresher(fetch, 60, self.shared())
+        follower = SharedBoardRefresher(fetch, 60, self.shared())
+
+        written = writer.refresh_once()
+        followed = follower.refresh_once()
+        writer.refresh_once() #Not due yet
+
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(followed.tag, written.tag)
+        self.assertEqual(followed.departures, written.departures)
+        self.assertIs(follower.snapshot(written.tag), followed)
+
+    def test_next_writer_recovers_from_interrupted_publish(self):
+        """
+        A writer killed halfway through a publish shouldn't leave the board unreadable for good.
+        """
+        from CommuterSchedule.board import SharedBoardRefresher
+
+        dead = self.shared()
+        dead.publish(4, 1000.0, self.departures)
+        dead.SEQUENCE.pack_into(dead._map, 0, 5) #Killed between the odd and the even sequence
+        dead._map[dead.PAYLOAD_OFFSET:dead.PAYLOAD_OFFSET + 8] = b"\x00" * 8 #Board half overwritten
+
+        shared = self.shared()
+        self.assertTrue(shared.acquire_writer())
+        self.assertIsNone(shared.read()) #The half-written board is dropped, not read
+
+        writer = SharedBoardRefresher(lambda: self.departures, 60, shared)
+        written = writer.refresh_once()
+        reader = self.shared()
+
+        version, fetched_at, epoch, departures = reader.read()
+        self.assertEqual((version, epoch), (written.version, written.epoch))
+        self.assertEqual(departures, self.departures)
+        self.assertEqual(reader.SEQUENCE.unpack_from(reader._map, 0)[0] % 2, 0)
+
+class BenchmarkFixtureTests(TestCase):
+    def test_scaled_payload_normalizes(self):
+        """
+        A scaled payload should keep every prediction joined and on its station's board.
+        """
+        from CommuterSchedule.benchmarks import load_payload
+        from CommuterSchedule.benchmarks.pipeline import scale_payload
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        response = scale_payload(load_payload("predictions.json"), 200)
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        departures = mbta.normalize_predictions_response(response, mbta.stations)
+
+        self.assertEqual(len(set(prediction["id"] for prediction in response["data"])), 200)
+        self.assertEqual(sum(len(board) for board in departures.values()), 200)
+        self.assertTrue(all(prediction.train_number for board in departures.values() for prediction in board))
+
+class MetricsTests(BoardTestCase):
+    def departures(self):
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        mbta.fetch_data_from_mbta = lambda params, endpoint: make_predictions_response()
+        return mbta.fetch_commuter_rail_predictions({"filter[stop]": "metrics"}, mbta.stations)
+
+    def test_server_timing(self):
+        """
+        Pages should report their own stages and the stages of the refresh behind the board.
+        """
+        response = self.client.get("/")
+        stages = [metric.split(";")[0] for metric in response["Server-Timing"].split(", ")]
+
+        self.assertIn("snapshot", stages)
+        self.assertIn("render", stages)
+        self.assertIn("view_index", stages)
+        self.assertIn("refresh-fetch", stages)
+        self.assertIn("refresh-normalize", stages)
+
+        response = self.client.post("/page-info/", HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertIn("serialize;dur=", response["Server-Timing"])
+
+    def test_metrics_endpoint(self):
+        self.client.get("/")
+        response = self.client.get("/metrics", REMOTE_ADDR="127.0.0.1")
+        text = response.content.decode("utf-8")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('commuter_stage_seconds_bucket{stage="render",le="+Inf"}', text)
+        self.assertIn('commuter_stage_seconds_count{stage="normalize"}', text)
+        self.assertIn("commuter_board_version 1.0", text)
+
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="203.0.113.9").status_code, 403)
+
+    def test_histogram_buckets(self):
+        from CommuterSchedule.metrics import MetricsRegistry
+
+        registry = MetricsRegistry()
+        for seconds in (0.0001, 0.003, 0.003, 20):
+            registry.observe("predictions", seconds)
+        registry.count("mbta_responses", endpoint="/predictions", status=304)
+        text = registry.render()
+
+        self.assertIn('commuter_stage_seconds_bucket{stage="predictions",le="0.0005"} 1', text)
+        self.assertIn('commuter_stage_seconds_bucket{stage="predictions",le="0.005"} 3', text)
+        self.assertIn('commuter_stage_seconds_bucket{stage="predictions",le="10"} 3', text)
+        self.assertIn('commuter_stage_seconds_bucket{stage="predictions",le="+Inf"} 4', text)
+        self.assertIn('commuter_mbta_responses_total{endpoint="/predictions",status="304"} 1.0', text)
+
+class ProfilingTests(BoardTestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from django.test.utils import override_settings
+
+        super(ProfilingTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        overridden = override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0, PROFILING_DIR=self.directory, PROFILING_MAX_FILES=4)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def test_signed_requests_are_profiled(self):
+        import os
+        import pstats
+        from CommuterSchedule.profiling import profile_token
+
+        self.assertNotIn("X-Profile-Id", self.client.get("/"))
+        self.assertNotIn("X-Profile-Id", self.client.get("/", HTTP_X_PROFILE="profile:forged"))
+        self.assertEqual(os.listdir(self.directory), [])
+
+        response = self.client.get("/", HTTP_X_PROFILE=profile_token())
+        name = response["X-Profile-Id"]
+
+        self.assertEqual(sorted(os.listdir(self.directory)), [name + ".collapsed", name + ".pstats"])
+        self.assertTrue(pstats.Stats(os.path.join(self.directory, name + ".pstats")).total_calls)
+        with open(os.path.join(self.directory, name + ".collapsed")) as collapsed:
+            self.assertIn(":index;", collapsed.read())
+
+    def test_directory_is_rotated(self):
+        import os
+        from CommuterSchedule.profiling import profile_token
+
+        for _ in range(3):
+            self.client.get("/", HTTP_X_PROFILE=profile_token())
+
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from CommuterSchedule.mbta import MBTACommuterRail
+        from CommuterSchedule.history import HistoryRecorder, HistoryStore
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = HistoryStore(self.directory, retention_days=2)
+        self.recorder = HistoryRecorder(self.store)
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        self.departures = mbta.normalize_predictions_response(make_predictions_response(), mbta.stations)
+        self.observed_at = 1919036100.0 #2030-10-23 21:35 in Boston
+
+    def test_only_changes_are_written(self):
+        import datetime
+        from collections import OrderedDict
+        from CommuterSchedule.records import StationBoard
+
+        north = self.departures["north_station"]
+        delayed = StationBoard([north[0].replace(status="Delayed")])
+        self.recorder.record(self.departures, self.observed_at)
+        self.recorder.record(self.departures, self.observed_at + 10) #Unchanged
+        self.recorder.record(OrderedDict([("north_station", delayed), ("south_station", self.departures["south_station"])]), self.observed_at + 20)
+
+        self.assertEqual(self.recorder.flush(), len(north) + len(self.departures["south_station"]) + len(north))
+
+        rows = list(self.store.read(datetime.date(2030, 10, 23)))
+        changed = [row for row in rows if row["t"] == self.observed_at + 20]
+        self.assertEqual([(row["op"], row["prediction_id"]) for row in changed],
+                         [("upsert", north[0].prediction_id)] + [("remove", prediction.prediction_id) for prediction in north[1:]])
+        self.assertEqual(changed[0]["status"], "Delayed")
+        self.assertEqual(changed[0]["departure_time"], north[0].departure_time.isoformat())
+        self.assertEqual(self.recorder.flush(), 0)
+
+    def test_appends_and_expires_days(self):
+        import datetime
+
+        for day in (datetime.date(2030, 10, 20), datetime.date(2030, 10, 23)):
+            self.store.append(day, [{"op": "upsert", "day": day.isoformat()}])
+        self.store.append(datetime.date(2030, 10, 23), [{"op": "remove"}])
+
+        with open(self.store.partition(datetime.date(2030, 10, 23)), "rb") as day_file:
+            self.assertEqual(day_file.read(2), b"\x1f\x8b")
+        self.assertEqual([row["op"] for row in self.store.read(datetime.date(2030, 10, 23))], ["upsert", "remove"]) #Two gzip members read as one stream
+        self.assertEqual(self.store.expire(datetime.date(2030, 10, 23)), [datetime.date(2030, 10, 20)])
+        self.assertEqual(self.store.days(), [datetime.date(2030, 10, 23)])
+
+    def test_record_never_blocks(self):
+        from CommuterSchedule.history import HistoryRecorder
+
+        recorder = HistoryRecorder(self.store, max_pending=1)
+        recorder.record(self.departures)
+        recorder.record(self.departures)
+
+        self.assertEqual(recorder.dropped, 1)
+
+class DelayAnalyticsTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        self.departures = mbta.normalize_predictions_response(make_predictions_response(), mbta.stations)
+
+    def boards(self, *predictions):
+        from collections import OrderedDict
+        from CommuterSchedule.records import StationBoard
+
+        return OrderedDict([("north_station", StationBoard(predictions)), ("south_station", None)])
+
+    def test_sketch_quantiles_and_merge(self):
+        from CommuterSchedule.analytics import DelaySketch
+
+        first, second = DelaySketch(), DelaySketch()
+        for delay in range(1, 1001):
+            (first if delay % 2 else second).add(delay)
+        first.merge(second)
+        first.add(-120)
+        first.add(0.5)
+
+        self.assertEqual(first.count, 1002)
+        self.assertAlmostEqual(first.quantile(0.5), 500, delta=500 * 0.01)
+        self.assertAlmostEqual(first.quantile(0.9), 900, delta=900 * 0.01)
+        self.assertEqual(first.quantile(0), -120)
+        self.assertEqual(first.quantile(1), 1000)
+        self.assertEqual(DelaySketch.from_dict(first.as_dict()).quantile(0.9), first.quantile(0.9))
+
+    def test_delay_recorded_once_per_departure(self):
+        import datetime
+        from CommuterSchedule.analytics import DelayAnalytics
+
+        analytics = DelayAnalytics()
+        prediction = self.departures["north_station"][0] #CR-Lowell, Wednesday 21:35
+        late = prediction.replace(departure_time=prediction.departure_time + datetime.timedelta(minutes=6), status="Delayed")
+
+        analytics.observe(self.boards(prediction))
+        analytics.observe(self.boards(late))
+        analytics.observe(self.boards(late.replace(status="Departed")))
+        analytics.observe(self.boards(late)) #The feed flips back and forth
+        analytics.observe(self.boards(late.replace(status="Departed")))
+        analytics.observe(self.boards())
+
+        summary = analytics.summary(route="CR-Lowell", station="north_station", weekday=2, hour=21)
+        self.assertEqual(summary["departures"], 1)
+        self.assertAlmostEqual(summary["delay_seconds"]["p90"], 360, delta=360 * 0.01)
+        self.assertEqual(summary["statuses"], {"On time": 1, "Delayed": 2, "Departed": 2})
+        self.assertEqual(analytics.summary(hour=17)["departures"], 0)
+        self.assertIs(analytics.summary(route="CR-Lowell"), analytics.summary(route="CR-Lowell")) #Cached until the next board
+
+    def test_state_survives_restarts(self):
+        import os
+        from CommuterSchedule.analytics import DelayAnalytics
+
+        path = os.path.join(self.directory, "analytics.json")
+        analytics = DelayAnalytics(path, save_interval=0)
+        analytics.observe(self.boards(*self.departures["north_station"]))
+        analytics.observe(self.boards())
+
+        restarted = DelayAnalytics(path)
+        self.assertEqual(restarted.summary(station="north_station")["departures"], len(self.departures["north_station"]))
+        self.assertEqual(restarted.summary()["statuses"], analytics.summary()["statuses"])
+        self.assertEqual(restarted.summary()["delay_seconds"], analytics.summary()["delay_seconds"])
+
+    def test_restart_keeps_following_the_board(self):
+        """
+        A process started while a train is on the board shouldn't count it again nor measure its delay from the restart.
+        """
+        import os
+        import datetime
+        from CommuterSchedule.analytics import DelayAnalytics
+
+        path = os.path.join(self.directory, "analytics.json")
+        prediction = self.departures["north_station"][0]
+        departed = prediction.replace(departure_time=prediction.departure_time + datetime.timedelta(minutes=5), status="Departed")
+        analytics = DelayAnalytics(path, save_interval=0)
+        analytics.observe(self.boards(prediction))
+        analytics.observe(self.boards(departed))
+
+        restarted = DelayAnalytics(path, save_interval=0)
+        restarted.observe(self.boards(departed)) #Same board on both sides of the restart
+        restarted.observe(self.boards())
+        summary = restarted.summary(route="CR-Lowell")
+
+        self.assertEqual(summary["departures"], 1)
+        self.assertAlmostEqual(summary["delay_seconds"]["p50"], 300, delta=300 * 0.01)
+        self.assertEqual(summary["statuses"], {"On time": 1, "Departed": 1})
+
+    def test_first_seen_departed_adds_no_delay(self):
+        from CommuterSchedule.analytics import DelayAnalytics
+
+        analytics = DelayAnalytics()
+        analytics.observe(self.boards(self.departures["north_station"][0].replace(status="Departed")))
+        analytics.observe(self.boards())
+
+        self.assertEqual(analytics.summary()["departures"], 0)
+
+    def test_observing_process_doesnt_reload(self):
+        """
+        The process recording the statistics shouldn't take another process's save for its own.
+        """
+        import os
+        from CommuterSchedule.analytics import DelayAnalytics
+
+        path = os.path.join(self.directory, "analytics.json")
+        writer = DelayAnalytics(path, save_interval=0)
+        other = DelayAnalytics(path, save_interval=0) #e.g. a second worker without BOARD_SHARED_PATH
+        writer.observe(self.boards(*self.departures["north_station"]))
+        writer.observe(self.boards())
+        other.observe(self.boards()) #Saves its own, empty, statistics over the writer's
+        reader = DelayAnalytics(path)
+
+        self.assertEqual(writer.summary()["departures"], len(self.departures["north_station"]))
+        self.assertFalse(writer.reload())
+        self.assertEqual(reader.summary()["departures"], 0) #Read-only processes take the last save
+
+    def test_endpoint(self):
+        import json
+        from django.test.utils import override_settings
+        from CommuterSchedule import board
+        from CommuterSchedule.analytics import DelayAnalytics
+
+        self.assertEqual(self.client.get("/delays/").status_code, 404) #Off without BOARD_SHARED_PATH
+        overridden = override_settings(ANALYTICS_ENABLED=True)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        previous = board._analytics
+        board._analytics = DelayAnalytics()
+        self.addCleanup(setattr, board, "_analytics", previous)
+        board._analytics.observe(self.boards(*self.departures["north_station"]))
+        board._analytics.observe(self.boards())
+
+        response = self.client.get("/delays/", {"station": "north_station", "weekday": "2"})
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(json.loads(response.content.decode("utf-8"))["departures"], len(self.departures["north_station"]))
+        self.assertEqual(self.client.get("/delays/", {"hour": "24"}).status_code, 400)
+        self.assertEqual(self.client.get("/delays/", {"weekday": "monday"}).status_code, 400)
+
+class ExportTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from django.test.utils import override_settings
+        from CommuterSchedule.mbta import MBTACommuterRail
+        from CommuterSchedule.history import HistoryRecorder, HistoryStore
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        overridden = override_settings(HISTORY_DIR=directory)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        self.departures = mbta.normalize_predictions_response(make_predictions_response(), mbta.stations)
+        recorder = HistoryRecorder(HistoryStore(directory))
+        recorder.record(self.departures, 1919036100.0) #2030-10-23 21:35 in Boston
+        recorder.flush()
+
+    def export(self, meta=None, **params):
+        params.setdefault("start", "2030-10-23")
+        params.setdefault("end", "2030-10-24")
+        return self.client.get("/export/", params, **(meta or {}))
+
+    def test_ndjson(self):
+        import json
+
+        response = self.export(station="north_station")
+        lines = b"".join(response.streaming_content).decode("utf-8").splitlines()
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(len(lines), len(self.departures["north_station"]))
+        first = json.loads(lines[0])
+        self.assertEqual(first["route_id"], "CR-Lowell")
+        self.assertEqual(first["observed_at"], "2030-10-23T21:35:00-04:00")
+        self.assertEqual(len(b"".join(self.export(end="2030-10-23T21:35:00").streaming_content)), 0) #End excluded
+
+    def test_gzipped_csv(self):
+        import zlib
+
+        response = self.export({"HTTP_ACCEPT_ENCODING": "gzip, deflate"}, format="csv", route="CR-Providence")
+        lines = zlib.decompress(b"".join(response.streaming_content), 16 + zlib.MAX_WBITS).decode("utf-8").splitlines()
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(lines[0], "observed_at,board,route_id,trip_id,train_number,platform_code,status,departure_time,prediction_id")
+        self.assertTrue(lines[1].startswith("2030-10-23T21:35:00-04:00,south_station,CR-Providence,"))
+
+    def test_rejected(self):
+        from django.test.utils import override_settings
+
+        self.assertEqual(self.export(start="yesterday").status_code, 400)
+        self.assertEqual(self.export(start="2030-10-24", end="2030-10-23").status_code, 400)
+        self.assertEqual(self.export(format="xml").status_code, 400)
+        self.assertEqual(self.export(start="2030-02-30").status_code, 400)
+        self.assertEqual(self.export(start="2030-10-23T25:00:00").status_code, 400)
+        self.assertEqual(self.export(start="2030-11-03T01:30:00", end="2030-11-04").status_code, 400) #Happens twice
+        self.assertEqual(self.export(start="2030-03-10T02:30:00", end="2030-03-11").status_code, 400) #Never happens
+        offset_given = self.export(start="2030-11-03T01:30:00-05:00", end="2030-11-04")
+        offset_given.close() #Gives the export slot back
+        self.assertEqual(offset_given.status_code, 200)
+        self.assertEqual(self.export({"REMOTE_ADDR": "10.0.0.1"}).status_code, 403)
+        with override_settings(HISTORY_DIR=None):
+            self.assertEqual(self.export().status_code, 404)
+
+    def test_concurrent_exports_are_capped(self):
+        from CommuterSchedule import views
+        from CommuterSchedule.export import ExportSlots
+
+        previous = views._export_slots
+        views._export_slots = ExportSlots(1)
+        self.addCleanup(setattr, views, "_export_slots", previous)
+
+        running = self.export()
+        self.assertEqual(self.export().status_code, 503)
+        running.close()
+        self.assertEqual(self.export().status_code, 200)
+
+class BroadcastHubTests(TestCase):
+    def test_delta_or_board_per_subscriber(self):
+        """
+        Subscribers with the previous version get the delta, the others the board, as the same bytes.
+        """
+        from CommuterSchedule.broadcast import BroadcastHub
+
+        hub = BroadcastHub()
+        hub.publish(1, b"board-1")
+        current, behind, fresh = hub.subscribe(1), hub.subscribe(), hub.subscribe(1)
+        self.assertEqual(behind.next(0), b"board-1")
+        behind.version = None #Pretend it missed version 1
+
+        board, delta = b"board-2", b"delta-1-2"
+        hub.publish(2, board, delta, 1)
+
+        self.assertIs(current.next(0), delta)
+        self.assertIs(fresh.next(0), delta)
+        self.assertIs(behind.next(0), board)
+        self.assertEqual(current.next(0), b"") #Nothing more, heartbeat time
+        self.assertIs(hub.subscribe(1).next(0), delta) #Late subscribers catch up too
+
+    def test_slow_consumers_are_evicted(self):
+        from CommuterSchedule.broadcast import BroadcastHub
+
+        hub = BroadcastHub(max_queue=2)
+        slow, reader = hub.subscribe(), hub.subscribe()
+        for version in range(1, 4):
+            hub.publish(version, b"board")
+            reader.next(0)
+
+        self.assertIsNone(slow.next(0))
+        self.assertEqual(reader.next(0), b"")
+        self.assertEqual(hub.stats(), {"subscribers": 1, "published": 3, "evicted": 1})
+
+    def test_load(self):
+        """
+        Every update should be encoded once and shared by thousands of subscribers.
+        """
+        from CommuterSchedule.benchmarks.broadcast import run
+
+        results = run(subscribers=2000, updates=5, slow=0.05, predictions=50)
+
+        self.assertEqual(results["max_distinct_messages"], 1)
+        self.assertEqual(results["stats"]["published"], 6)
+        self.assertEqual(results["stats"]["subscribers"] + results["stats"]["evicted"], 2000)
+
+class BoardStreamDeltaTests(BoardTestCase):
+    def departures(self):
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        departures = mbta.normalize_predictions_response(make_predictions_response(), mbta.stations)
+        if self.refresher.latest() is not None: #Second refresh, the first train is delayed
+            board = departures["north_station"]
+            departures["north_station"] = board.sorted([board[0].replace(status="Delayed")] + list(board[1:]))
+        return departures
+
+    def test_stream_sends_delta(self):
+        import json
+        from django.test.utils import override_settings
+
+        with override_settings(BOARD_STREAM_HEARTBEAT=0.01, BOARD_STREAM_MAX_AGE=5):
+            response = self.client.get("/board-stream/", HTTP_LAST_EVENT_ID=self.tag(1))
+            events = iter(response.streaming_content)
+            next(events)
+            self.refresher.refresh_once()
+            event = next(event for event in events if not event.startswith(b"event: heartbeat"))
+            response.close()
+
+        self.assertTrue(event.startswith(("id: %s\nevent: delta\n" % self.tag(2)).encode("ascii")))
+        data = json.loads(event.decode("utf-8").split("data: ", 1)[1])
+        self.assertEqual(data["base_version"], self.tag(1))
+        self.assertEqual([prediction["status"] for prediction in data["delta"]["north_station"]["changed"]], ["Delayed"])
+
+class BoardApiTests(BoardTestCase):
+    def departures(self):
+        from CommuterSchedule.mbta import MBTACommuterRail
+
+        mbta = MBTACommuterRail("", "https://api-v3.mbta.com")
+        departures = mbta.normalize_predictions_response(make_predictions_response(), mbta.stations)
+        if getattr(self, "delayed", False):
+            board = departures["south_station"]
+            departures["south_station"] = board.sorted([board[0].replace(status="Delayed")])
+        return departures
+
+    def test_station_board(self):
+        import json
+
+        response = self.client.get("/api/board/north_station/")
+        info = json.loads(response.content.decode("utf-8"))
+
+        self.assertEqual(info["station"], "north_station")
+        self.assertEqual([prediction["prediction_id"] for prediction in info["predictions"]], ["prediction-1", "prediction-3"])
+        self.assertTrue(response["ETag"].startswith('W/"'))
+        self.assertIn("Last-Modified", response)
+        self.assertIn("public", response["Cache-Control"])
+        self.assertIn("max-age=5", response["Cache-Control"])
+        self.assertIn("stale-while-revalidate=", response["Cache-Control"])
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(set(json.loads(self.client.get("/api/board/").content.decode("utf-8"))["stations"]), {"north_station", "south_station"})
+        self.assertEqual(self.client.get("/api/board/back_bay/").status_code, 404)
+        self.assertEqual(self.client.post("/api/board/").status_code, 405)
+
+    def test_not_modified_until_station_changes(self):
+        etags = dict((board, self.client.get("/api/board/%s/" % board)["ETag"]) for board in ("north_station", "south_station"))
+
+        not_modified = self.client.get("/api/board/north_station/", HTTP_IF_NONE_MATCH=etags["north_station"])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b"")
+        self.assertIn("max-age=5", not_modified["Cache-Control"])
+
+        self.delayed = True
+        self.refresher.refresh_once()
+
+        self.assertEqual(self.client.get("/api/board/north_station/", HTTP_IF_NONE_MATCH=etags["north_station"]).status_code, 304)
+        changed = self.client.get("/api/board/south_station/", HTTP_IF_NONE_MATCH=etags["south_station"])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed["ETag"], etags["south_station"])
+
+    def test_gzipped(self):
+        import zlib
+
+        plain = self.client.get("/api/board/")
+        gzipped = self.client.get("/api/board/", HTTP_ACCEPT_ENCODING="gzip")
+
+        self.assertEqual(gzipped["Content-Encoding"], "gzip")
+        self.assertEqual(zlib.decompress(gzipped.content, 16 + zlib.MAX_WBITS), plain.content)
+        self.assertEqual(gzipped["ETag"], plain["ETag"])
@@ -0,0 +1,148 @@
+import time
+import random
+import threading
+import requests
+from collections import deque
+from requests.adapters import HTTPAdapter
+
+class MBTATransport(object):
+    """Shared HTTP transport for the MBTA API
+
+    Wraps a single `requests.Session` so every call reuses pooled
+    keep-alive connections instead of paying a new TCP+TLS handshake,
+    bounds each call with connect/read timeouts, and retries transient
+    failures with jittered exponential backoff. The session is only used
+    for plain GETs, which is safe to share between threads.
+
+    Args:
+        pool_size (int): Maximum number of connections kept open to the API
+        connect_timeout (float): Seconds to wait for a connection
+        read_timeout (float): Seconds to wait between bytes of the response
+        retries (int): Retries allowed per call after the first attempt
+        backoff (float): Base seconds of the exponential backoff
+        backoff_max (float): Upper bound of a single backoff sleep
+        limiter (SharedTokenBucket): Rate limiter every attempt takes a token from, see `CommuterSchedule.ratelimit`
+
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    LATENCY_WINDOW = 512 #Number of recent calls used for the latency percentiles
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.5, backoff_max=4, limiter=None):
+        self.pool_size = pool_size
+        self.limiter = limiter
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.sleep = time.sleep
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True) #Block instead of opening throwaway connections past the pool size
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._requests = 0
+        self._retried = 0
+        self._failures = 0
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+
+    def backoff_delay(self, attempt, cap=None):
+        """Function to compute the sleep before a retry
+
+        Uses "full jitter" so workers that failed together don't retry together.
+
+        Args:
+            attempt (int): The retry number, starting at 0
+            cap (float): Upper bound of the sleep, defaults to `backoff_max`
+
+        Returns:
+            The seconds to sleep.
+        """
+
+        return random.uniform(0, min(self.backoff_max if cap is None else cap, self.backoff * (2 ** attempt)))
+
+    def get(self, url, params=None, headers=None):
+        """Function to GET a url through the pool
+
+        Args:
+            url (str): The full url requested
+            params (dict of str: str): Query parameters
+            headers (dict of str: str): Request headers
+
+        Returns:
+            The `requests.Response` of the last attempt. Connection errors
+            and timeouts are raised once the retries are used up.
+        """
+
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire() #Retries spend the budget too
+
+            with self._lock:
+                self._in_flight += 1
+                self._requests += 1
+                self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+
+            started = time.time()
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                response = None
+                if attempt >= self.retries:
+                    with self._lock:
+                        self._failures += 1
+                    raise
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._latencies.append(time.time() - started)
+
+            if response is not None:
+                if self.limiter is not None:
+                    self.limiter.update_from_headers(response.headers)
+                if response.status_code not in self.RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                response.close() #Hand the connection back to the pool before sleeping
+
+            with self._lock:
+                self._retried += 1
+            self.sleep(self.backoff_delay(attempt))
+            attempt += 1
+
+    def stats(self):
+        """Function to report pool utilization and upstream latency
+
+        Returns:
+            The Dictionary of request counters, in-flight connections
+            and latency percentiles in milliseconds over the recent window.
+        """
+
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                "requests": self._requests,
+                "retries": self._retried,
+                "failures": self._failures,
+                "pool_size": self.pool_size,
+                "in_flight": self._in_flight,
+                "peak_in_flight": self._peak_in_flight,
+                "pool_utilization": float(self._in_flight) / self.pool_size
+            }
+
+        if self.limiter is not None:
+            stats["rate_limit_wait_s"] = round(self.limiter.waited, 2)
+
+        for name, quantile in (("latency_p50_ms", 0.5), ("latency_p95_ms", 0.95), ("latency_max_ms", 1.0)):
+            if latencies:
+                stats[name] = round(latencies[min(len(latencies) - 1, int(quantile * len(latencies)))] * 1000, 1)
+            else:
+                stats[name] = None
+
+        return stats
+
+default_transport = MBTATransport()
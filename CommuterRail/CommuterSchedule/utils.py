@@ -10,4 +10,91 @@ class UTC(tzinfo):
         return "UTC"
 
     def dst(self, dt):
-        return timedelta(0)
\ No newline at end of file
+        return timedelta(0)
+
+class FixedOffset(tzinfo):
+    """Fixed offset from UTC, e.g. -04:00 in an MBTA timestamp"""
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.offset = timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def tzname(self, dt):
+        sign = "-" if self.minutes < 0 else "+"
+        return "%s%02d:%02d" % (sign, abs(self.minutes) // 60, abs(self.minutes) % 60)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def __reduce__(self):
+        return FixedOffset, (self.minutes,)
+
+    def __repr__(self):
+        return "FixedOffset(%d)" % self.minutes
+
+_offsets = {0: UTC()}
+_timestamps = {}
+TIMESTAMP_MEMO_SIZE = 4096
+
+def parse_iso8601(value):
+    """Function to parse the fixed-format timestamps of the MBTA API
+
+    Only accepts YYYY-MM-DDTHH:MM:SS with optional fractional seconds,
+    followed by Z or a +HH:MM/-HH:MM offset, which is all the API sends.
+    Boards repeat the same timestamps refresh after refresh, so parsed
+    values are memoized.
+
+    Args:
+        value (str): The timestamp, e.g. 2018-10-23T21:35:00-04:00
+
+    Returns:
+        The timezone aware datetime.
+
+    Raises:
+        ValueError: When the timestamp isn't in that format.
+    """
+
+    parsed = _timestamps.get(value)
+    if parsed is not None:
+        return parsed
+
+    try:
+        if value[4] != "-" or value[7] != "-" or value[10] != "T" or value[13] != ":" or value[16] != ":":
+            raise ValueError
+        year, month, day = int(value[0:4]), int(value[5:7]), int(value[8:10])
+        hour, minute, second = int(value[11:13]), int(value[14:16]), int(value[17:19])
+
+        position = 19
+        microsecond = 0
+        if value[position] == ".":
+            end = position + 1
+            while value[end].isdigit():
+                end += 1
+            microsecond = int(value[position + 1:end][:6].ljust(6, "0"))
+            position = end
+
+        zone = value[position:]
+        if zone == "Z":
+            minutes = 0
+        elif len(zone) == 6 and zone[0] in "+-" and zone[3] == ":":
+            minutes = int(zone[1:3]) * 60 + int(zone[4:6])
+            if zone[0] == "-":
+                minutes = -minutes
+        else:
+            raise ValueError
+    except (IndexError, ValueError):
+        raise ValueError("Not an MBTA ISO-8601 timestamp: %r" % (value,))
+
+    offset = _offsets.get(minutes)
+    if offset is None:
+        offset = _offsets[minutes] = FixedOffset(minutes)
+
+    parsed = datetime(year, month, day, hour, minute, second, microsecond, offset)
+    if len(_timestamps) >= TIMESTAMP_MEMO_SIZE: #Old boards' timestamps never come back, start over
+        _timestamps.clear()
+    _timestamps[value] = parsed
+
+    return parsed
@@ -1,30 +1,52 @@
+import os
+import re
 import json
-import requests
+import hashlib
+import time
+import threading
 import datetime
+import pytz
+from collections import OrderedDict
 from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.shortcuts import render
-from django.http.response import HttpResponse
-from CommuterSchedule.mbta import MBTACommuterRail
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition, require_http_methods
+from django.http.response import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, StreamingHttpResponse
+from CommuterSchedule.board import diff_predictions, get_board_refresher, get_board_snapshot, get_delay_analytics
+from CommuterSchedule.broadcast import BroadcastHub
+from CommuterSchedule.export import ExportSlots, export_chunks, gzip_chunks
+from CommuterSchedule.history import HistoryStore
+from CommuterSchedule.metrics import registry, server_timing, timed, with_server_timing
 
-def index(request):
+ACCEPTS_GZIP = re.compile(r"\bgzip\b(?!\s*;\s*q=0(\.0*)?\s*(,|$))")
+
+def refresh_timing(request, snapshot):
     """
-    View function for home page of site.
+    Adds the stages of the refresh that produced the snapshot (the MBTA
+    calls, normalization...) to the Server-Timing header of the request.
     """
 
-    MBTA_URL = settings.MBTA_URL
-    MBTA_KEY = settings.MBTA_KEY
+    request.server_timing.extend(server_timing(snapshot.timings, prefix="refresh-", description="last board refresh"))
 
-    mbta = MBTACommuterRail(MBTA_KEY,MBTA_URL)
+@with_server_timing
+def index(request):
+    """
+    View function for home page of site.
+    """
 
-    departures = mbta.fetch_commuter_rail_departures()
-    
-    north_station = departures["north_station"]
-    if north_station:
-        north_station = departures["north_station"]["predictions"]
+    with timed("snapshot"):
+        snapshot = get_board_snapshot()
+    refresh_timing(request, snapshot)
 
-    south_station = departures["south_station"]
-    if south_station:
-        south_station = departures["south_station"]["predictions"]
+    stations = [
+        {"board": board, "title": title, "rows": station_rows(snapshot, board)}
+        for board, station, title in settings.COMMUTER_STATIONS
+    ]
+    board_version = snapshot.tag
+    board_age = snapshot.age
 
     now = datetime.datetime.now()
     today = now.strftime("%A")
@@ -33,56 +55,114 @@ def index(request):
 
     current_page = 'home'
 
-    return render(request, 
-                  "index.html", 
-                  locals(), 
-                  )
+    with timed("render"):
+        return render(request, 
+                      "index.html", 
+                      locals(), 
+                      )
+
+def station_rows(snapshot, board):
+    """
+    The table rows of one station, rendered once per board version and
+    shared by every page showing that version. The snapshot's cache
+    goes away with the snapshot, so a new version renders fresh rows.
+    """
+
+    def render_rows():
+        with timed("render_rows"):
+            return render_to_string("station_rows.html", {"departures": snapshot.station(board)})
+
+    return snapshot.cached(("station_rows", board), render_rows)
+
+def format_departure_time(departure_time):
+    return departure_time.strftime("%-I:%M %p").replace("AM","a.m.").replace("PM", "p.m.")
+
+def serialize_predictions(predictions):
+    """
+    Serializes a station's board, or a list of its predictions, in departure
+    order with the departure time formatted for display.
+    """
+
+    if predictions is None:
+        return None
+
+    return [prediction.as_dict(departure_time=format_departure_time(prediction.departure_time)) for prediction in predictions]
+
+def clock_info():
+    """
+    The current day, date and time as shown at the top of the board.
+    """
+
+    now = datetime.datetime.now()
+
+    return {
+        "today": now.strftime("%A"),
+        "date": now.strftime("%Y-%-m-%-d"),
+        "time": now.strftime("%-I:%M %p")
+    }
+
+def board_info(snapshot, clock=None):
+    """
+    The JSON document sent to the browser for a board snapshot.
+    """
+
+    info = {
+        "version": snapshot.tag,
+        "age": round(snapshot.age, 1)
+    }
+    for board, station, title in settings.COMMUTER_STATIONS:
+        info[board] = serialize_predictions(snapshot.station(board))
+    info.update(clock or clock_info())
+
+    return info
+
+def board_delta(base, snapshot):
+    """
+    The changes between two snapshots for every station, see `diff_predictions`.
+    """
+
+    delta = {}
+    for station, station_id, title in settings.COMMUTER_STATIONS:
+        station_delta = diff_predictions(base.station(station), snapshot.station(station))
+        station_delta["added"] = serialize_predictions(station_delta["added"])
+        station_delta["changed"] = serialize_predictions(station_delta["changed"])
+        delta[station] = station_delta
+
+    return delta
 
+@with_server_timing
 def get_page_info(request):
     """
     This API endpoint allows for a simple polling solutions
-    Normally, would opt for sockets or MBTA's event streaming
-    but for a simple project, this solution works
+    for browsers without EventSource support, see `board_stream`
+
+    Clients send the last `version` they saw. They get back a
+    `not_modified` answer when the board didn't change, a `delta`
+    when that version is still in the recent history, and the
+    full board otherwise. Answers are prepared once per board version,
+    see `page_info_payload`, and sent gzipped when the client accepts it.
     """
     if request.is_ajax():
         if request.method == 'POST':
-            MBTA_URL = settings.MBTA_URL
-            MBTA_KEY = settings.MBTA_KEY
-
-            mbta = MBTACommuterRail(MBTA_KEY,MBTA_URL)
-
-            departures = mbta.fetch_commuter_rail_departures()
-
-            north_station = departures["north_station"]
-            if north_station:
-                north_station = departures["north_station"]["predictions"]
-
-                for key,value in north_station.items():
-                    value["departure_time"] = value["departure_time"].strftime("%-I:%M %p").replace("AM","a.m.").replace("PM", "p.m.")
-                
-            south_station = departures["south_station"]
-            if south_station:
-                south_station = departures["south_station"]["predictions"]
-
-                for key,value in south_station.items():
-                    value["departure_time"] = value["departure_time"].strftime("%-I:%M %p").replace("AM","a.m.").replace("PM", "p.m.")
-            
-            now = datetime.datetime.now()
-            today = now.strftime("%A")
-            date = now.strftime("%Y-%-m-%-d")
-            time = now.strftime("%-I:%M %p")
-            
-            return HttpResponse(
-                json.dumps(
-                    {
-                        "north_station": north_station,
-                        "south_station": south_station,
-                        "today": today,
-                        "date": date,
-                        "time": time
-                    }
-                ), content_type="application/json"
+            with timed("snapshot"):
+                refresher = get_board_refresher()
+                snapshot = get_board_snapshot()
+            refresh_timing(request, snapshot)
+
+            client_version = request.POST.get("version") or None #A `BoardSnapshot.tag`
+
+            with timed("serialize"):
+                body, compressed = page_info_payload(refresher, snapshot, client_version)
+
+            gzipped = accepts_gzip(request)
+            response = HttpResponse(
+                compressed if gzipped else body, content_type="application/json"
             )
+            if gzipped:
+                response["Content-Encoding"] = "gzip"
+            response["Content-Length"] = str(len(response.content))
+            response["Vary"] = "Accept-Encoding"
+            return response
     
     return HttpResponse(
                 {
@@ -90,3 +170,345 @@ def get_page_info(request):
                 }, content_type="application/json"
             )
 
+def page_info(refresher, snapshot, client_version, clock=None):
+    """
+    The answer of `get_page_info` to a client that last saw `client_version`.
+    """
+
+    if client_version == snapshot.tag:
+        info = {"not_modified": True, "version": snapshot.tag}
+        info.update(clock or clock_info())
+        return info
+
+    base = refresher.snapshot(client_version) if client_version else None
+    if base is None: #Unknown, too old or from another process: start over
+        return board_info(snapshot, clock)
+
+    info = {
+        "delta": snapshot.cached(("delta", base.tag), lambda: board_delta(base, snapshot)),
+        "base_version": base.tag,
+        "version": snapshot.tag
+    }
+    info.update(clock or clock_info())
+    return info
+
+def page_info_payload(refresher, snapshot, client_version):
+    """
+    The body of `page_info` as JSON bytes and gzipped, built once per
+    snapshot, kind of answer (not modified, delta from a version, full
+    board) and minute of the clock it shows, then shared by every poll.
+    Only the latest minute is kept, so a board that doesn't change
+    overnight doesn't pile up payloads.
+
+    Returns:
+        The Tuple of (identity bytes, gzip bytes).
+    """
+
+    clock = clock_info()
+    if client_version == snapshot.tag:
+        kind = ("not_modified",)
+    else:
+        base = refresher.snapshot(client_version) if client_version else None
+        kind = ("delta", base.tag) if base is not None else ("board",)
+
+    key = ("page_info",) + kind
+    entry = snapshot.cache.get(key)
+    if entry is None or entry[0] != clock:
+        body = json.dumps(page_info(refresher, snapshot, client_version, clock)).encode("utf-8")
+        entry = snapshot.cache[key] = (clock, body, b"".join(gzip_chunks([body])))
+
+    return entry[1], entry[2]
+
+def accepts_gzip(request):
+    """
+    Whether the client's Accept-Encoding allows a gzipped answer.
+    """
+
+    return bool(ACCEPTS_GZIP.search(request.META.get("HTTP_ACCEPT_ENCODING", "")))
+
+def board_event(snapshot):
+    """
+    The `board` Server-Sent Event of a snapshot, encoded once for every client.
+    """
+
+    return ("id: %s\nevent: board\ndata: %s\n\n" % (snapshot.tag, json.dumps(board_info(snapshot)))).encode("utf-8")
+
+def delta_event(base, snapshot):
+    """
+    The `delta` Server-Sent Event from `base` to `snapshot`, shaped like
+    the delta answers of `page_info`.
+    """
+
+    info = {
+        "delta": snapshot.cached(("delta", base.tag), lambda: board_delta(base, snapshot)),
+        "base_version": base.tag,
+        "version": snapshot.tag
+    }
+    info.update(clock_info())
+
+    return ("id: %s\nevent: delta\ndata: %s\n\n" % (snapshot.tag, json.dumps(info))).encode("utf-8")
+
+_heartbeat = (None, None) #(second, event)
+
+def heartbeat_event():
+    """
+    The `heartbeat` Server-Sent Event, shared by every client for a second.
+    """
+
+    global _heartbeat
+
+    second = int(time.time())
+    if _heartbeat[0] != second:
+        _heartbeat = (second, ("event: heartbeat\ndata: %s\n\n" % json.dumps(clock_info())).encode("utf-8"))
+    return _heartbeat[1]
+
+_hub = None
+_hub_pid = None
+_hub_lock = threading.Lock()
+
+def get_board_hub():
+    """
+    Returns the process-wide `BroadcastHub` publishing the board to the
+    /board-stream/ clients, following the current board refresher.
+    """
+
+    global _hub, _hub_pid
+
+    refresher = get_board_refresher()
+    with _hub_lock:
+        if _hub is None or _hub_pid != os.getpid() or _hub.refresher is not refresher:
+            if _hub is not None and _hub_pid == os.getpid():
+                _hub.stop()
+            _hub = BroadcastHub(settings.BOARD_STREAM_QUEUE_SIZE)
+            _hub.follow(refresher, board_event, delta_event)
+            _hub_pid = os.getpid()
+        return _hub
+
+def board_events(last_version, heartbeat, max_age):
+    """
+    Generates the Server-Sent Events of `board_stream`.
+
+    The board is encoded once per version by the hub (see
+    `get_board_hub`) and shared by every client: a `delta` event when
+    the client has the previous version, a `board` event otherwise.
+    In between, a `heartbeat` event keeps the connection alive through
+    proxies and keeps the clock ticking. The stream ends after `max_age`
+    seconds, or as soon as the client falls too far behind, and the
+    browser reconnects with its Last-Event-ID, which keeps a worker from
+    being held forever.
+    """
+
+    hub = get_board_hub()
+    subscriber = hub.subscribe(last_version)
+    closes_at = time.time() + max_age
+
+    try:
+        yield "retry: %d\n\n" % (heartbeat * 1000) #Reconnect delay used by EventSource
+
+        while time.time() < closes_at:
+            message = subscriber.next(min(heartbeat, max(0, closes_at - time.time())))
+            if message is None: #Evicted as a slow consumer
+                return
+            yield message or heartbeat_event()
+    finally:
+        hub.unsubscribe(subscriber)
+
+def board_stream(request):
+    """
+    Server-Sent Events endpoint that pushes the board to the browser
+    whenever it changes. Browsers resume with the Last-Event-ID header,
+    so they only get the full board again if they missed a version.
+    """
+
+    last_version = request.META.get("HTTP_LAST_EVENT_ID") or None #A `BoardSnapshot.tag`
+
+    response = StreamingHttpResponse(
+        board_events(last_version, settings.BOARD_STREAM_HEARTBEAT, settings.BOARD_STREAM_MAX_AGE),
+        content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no" #Keep nginx from buffering the stream
+
+    return response
+
+def metrics(request):
+    """
+    Prometheus endpoint with the stage latencies and counters of this
+    worker process, only answered to METRICS_ALLOWED_IPS.
+    """
+
+    if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4")
+
+def delays(request):
+    """
+    JSON endpoint with the delay quantiles and status counts of the
+    departures matching the optional `route`, `station` (board name),
+    `weekday` (0 for Monday) and `hour` (0-23) query parameters, e.g.
+    /delays/?route=CR-Providence&hour=17
+    """
+
+    if not settings.ANALYTICS_ENABLED:
+        raise Http404("The delays aren't recorded, see ANALYTICS_ENABLED")
+    try:
+        weekday, hour = [int(request.GET[name]) if request.GET.get(name) else None for name in ("weekday", "hour")]
+    except ValueError:
+        return HttpResponseBadRequest("weekday and hour must be numbers")
+    if (weekday is not None and not 0 <= weekday <= 6) or (hour is not None and not 0 <= hour <= 23):
+        return HttpResponseBadRequest("weekday must be 0-6 and hour 0-23")
+
+    summary = get_delay_analytics().summary(request.GET.get("route") or None, request.GET.get("station") or None, weekday, hour)
+    return HttpResponse(json.dumps(summary), content_type="application/json")
+
+def parse_export_time(value):
+    """
+    Parses an export bound, a date (midnight) or a datetime, naive
+    values being in the project time zone.
+
+    Returns:
+        The Unix timestamp, or None when the value isn't a date, isn't a
+        real one (2030-02-30) or is a local time the DST change skips or
+        repeats (ambiguous).
+    """
+
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                return None
+            moment = datetime.datetime.combine(day, datetime.time())
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+    except (ValueError, pytz.InvalidTimeError):
+        return None
+    return (moment - datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)).total_seconds()
+
+_export_slots = None
+
+def export(request):
+    """
+    Streams the recorded predictions (see HISTORY_DIR) as CSV or NDJSON,
+    only answered to EXPORT_ALLOWED_IPS. Query parameters:
+
+        start, end  Dates or datetimes, the last day by default, end excluded
+        route       MBTA route id, e.g. CR-Providence
+        station     Board name, e.g. south_station
+        format      ndjson (default) or csv
+
+    Rows are read from disk as they're sent, gzipped on the fly when the
+    client accepts it, so any range streams in constant memory. At most
+    EXPORT_MAX_CONCURRENT exports run per process, a 503 is sent past it.
+    """
+
+    global _export_slots
+
+    if request.META.get("REMOTE_ADDR") not in settings.EXPORT_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    if not settings.HISTORY_DIR:
+        raise Http404("The prediction history isn't recorded, see HISTORY_DIR")
+
+    export_format = request.GET.get("format", "ndjson")
+    if export_format not in ("ndjson", "csv"):
+        return HttpResponseBadRequest("format must be ndjson or csv")
+
+    end = parse_export_time(request.GET["end"]) if request.GET.get("end") else time.time()
+    start = parse_export_time(request.GET["start"]) if request.GET.get("start") else end and end - 24 * 60 * 60
+    if start is None or end is None or start >= end:
+        return HttpResponseBadRequest("start and end must be dates or datetimes, start before end")
+
+    store = HistoryStore(settings.HISTORY_DIR, settings.HISTORY_RETENTION_DAYS)
+    chunks = export_chunks(store.rows(start, end, request.GET.get("route") or None, request.GET.get("station") or None), export_format)
+    compressed = accepts_gzip(request)
+    if compressed:
+        chunks = gzip_chunks(chunks)
+
+    if _export_slots is None:
+        _export_slots = ExportSlots(settings.EXPORT_MAX_CONCURRENT)
+    stream = _export_slots.stream(chunks)
+    if stream is None:
+        response = HttpResponse("Too many exports running, try again later", status=503)
+        response["Retry-After"] = "30"
+        return response
+
+    response = StreamingHttpResponse(stream, content_type="text/csv; charset=utf-8" if export_format == "csv" else "application/x-ndjson")
+    response["Content-Disposition"] = 'attachment; filename="departures.%s"' % export_format
+    response["Vary"] = "Accept-Encoding"
+    if compressed:
+        response["Content-Encoding"] = "gzip"
+    response["X-Accel-Buffering"] = "no"
+
+    return response
+
+def board_resource(request, board):
+    """
+    The snapshot and prepared payload of a /api/board/ resource, looked
+    up once per request so the validators and the body always match.
+
+    Returns:
+        The Tuple of (snapshot, (etag, identity bytes, gzip bytes)).
+
+    Raises:
+        Http404: When `board` isn't one of COMMUTER_STATIONS.
+    """
+
+    resource = getattr(request, "board_resource", None)
+    if resource is None:
+        titles = OrderedDict((name, title) for name, station, title in settings.COMMUTER_STATIONS)
+        if board is not None and board not in titles:
+            raise Http404("Unknown station %s" % board)
+
+        snapshot = get_board_snapshot()
+
+        def build():
+            if board is None:
+                info = {"stations": dict(
+                    (name, {"title": title, "predictions": serialize_predictions(snapshot.station(name))}) for name, title in titles.items()
+                )}
+            else:
+                info = {"station": board, "title": titles[board], "predictions": serialize_predictions(snapshot.station(board))}
+            body = json.dumps(info, sort_keys=True).encode("utf-8") #Same bytes, same ETag, in every worker
+            return 'W/"%s"' % hashlib.sha1(body).hexdigest()[:20], body, b"".join(gzip_chunks([body]))
+
+        resource = request.board_resource = (snapshot, snapshot.cached(("board_api", board), build))
+    return resource
+
+def board_last_modified(request, board=None):
+    """
+    When the board took its current version, the first refresh that
+    fetched it rather than the latest one.
+    """
+
+    snapshot = board_resource(request, board)[0]
+    first = get_board_refresher().snapshot(snapshot.tag) or snapshot
+    return datetime.datetime.fromtimestamp(first.fetched_at, timezone.utc)
+
+@condition(etag_func=lambda request, board=None: board_resource(request, board)[1][0], last_modified_func=board_last_modified)
+def conditional_board_api(request, board=None):
+    etag, body, compressed = board_resource(request, board)[1]
+    gzipped = accepts_gzip(request)
+
+    response = HttpResponse(compressed if gzipped else body, content_type="application/json")
+    if gzipped:
+        response["Content-Encoding"] = "gzip"
+    response["Content-Length"] = str(len(response.content))
+    return response
+
+@require_http_methods(["GET", "HEAD"])
+def board_api(request, board=None):
+    """
+    Read-only board of one station (/api/board/north_station/) or of
+    every station (/api/board/), identical for every client so browsers,
+    nginx or a CDN can cache it: Cache-Control allows BOARD_API_MAX_AGE
+    seconds of reuse plus BOARD_API_STALE_WHILE_REVALIDATE seconds of
+    stale answers, and If-None-Match / If-Modified-Since are answered
+    with a 304 until the station's predictions change.
+    """
+
+    response = conditional_board_api(request, board)
+    patch_cache_control(response, public=True, max_age=settings.BOARD_API_MAX_AGE,
+                        stale_while_revalidate=settings.BOARD_API_STALE_WHILE_REVALIDATE)
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
@@ -19,98 +19,216 @@ function getCookie(c_name)
     return "";
  }
 
+/**
+ * Update the day, date and time at the top of the board
+ * @param {object} data 
+ */
+function renderClock(data)
+{
+    document.getElementById('time').innerHTML = data["time"]
+    document.getElementById('date').innerHTML = data["date"]
+    document.getElementById('today').innerHTML = data["today"]
+}
+
+/**
+ * Board as last received from the server, kept so deltas can be applied.
+ * Each station is {order: [prediction_id, ...], predictions: {prediction_id: prediction}}
+ */
+var board = {
+    version: null,
+    stations: {}
+};
+
+/**
+ * Table body of every station on the page, keyed by board name (e.g. north_station)
+ */
+var stationBodies = {};
+
 $(document).ready(function() {
-    /*** Live Polling of Data
-     * This function will poll every minute and update the page every 15 seconds
-     * A proper implementation would be to add proper sockets, subscribe to alerts, or to use MBTA's own even streaming
-     * In order to keep the complexity of the project relatively simple, opted for a simple 1 minute polling solution
-     */
-    var cookie = getCookie("csrftoken");
-    if (cookie.length === 0) {
-        // M.toast({html: "No cookies!"});
-        cookie = document.getElementById('cookieToken').innerHTML; //Handle weird situations where people don't have cookies enabled
+    $("tbody[data-station]").each(function() {
+        var station = this.getAttribute("data-station");
+        stationBodies[station] = this;
+        board.stations[station] = {order: [], predictions: {}};
+    });
+});
+
+/**
+ * Render the rows of one station from the board state
+ * @param {string} station The board name, e.g. north_station
+ */
+function renderStation(station)
+{
+    var state = board.stations[station];
+    var endOfTrains = "<tr><td>No more commuter rails for the night!</th><td></td><td></td><td></td><td></td></tr>";
+    var station_innerHTML = "";
+
+    state.order.forEach(function(predictionId) {
+        var prediction = state.predictions[predictionId];
+        var td_beg = "<td>";
+        var td_end = "</td>";
+        if (prediction.headsign === "" || prediction.headsign === null) {
+            return;
+        }
+        if (prediction.platform_code === null) {
+            prediction.platform_code = "TBD"
+        }
+        var departure_time = td_beg + prediction.departure_time + td_end;
+        var headsign = td_beg + prediction.headsign + td_end;
+        var train_number = td_beg + prediction.train_number + td_end;
+        var platform_code = td_beg + prediction.platform_code + td_end;
+        var status = td_beg + prediction.status + td_end;
+        station_innerHTML += "<tr>" + departure_time + headsign + train_number + platform_code + status + "</tr>";
+    });
+
+    stationBodies[station].innerHTML = station_innerHTML || endOfTrains;
+}
+
+/**
+ * Replace every station table with a full board sent by the server
+ * @param {object} data 
+ */
+function renderBoard(data)
+{
+    renderClock(data);
+    board.version = data["version"];
+
+    Object.keys(stationBodies).forEach(function(station) {
+        var state = {order: [], predictions: {}};
+        var predictions = data[station];
+        if (predictions !== null && predictions !== undefined) {
+            predictions.forEach(function(prediction) { //Already in departure order
+                state.order.push(prediction.prediction_id);
+                state.predictions[prediction.prediction_id] = prediction;
+            });
+        }
+        board.stations[station] = state;
+        renderStation(station);
+    });
+}
+
+/**
+ * Whether a delta can be applied to the board we have: it must start from our
+ * version, and every prediction it orders must be one we have or it sends
+ * @param {object} data 
+ */
+function deltaApplies(data)
+{
+    if (data["base_version"] !== board.version) {
+        return false;
     }
+    return Object.keys(stationBodies).every(function(station) {
+        var delta = data["delta"][station];
+        var state = board.stations[station];
+        if (delta === undefined) {
+            return false;
+        }
+        var known = {};
+        Object.keys(state.predictions).forEach(function(predictionId) { known[predictionId] = true; });
+        delta.removed.forEach(function(predictionId) { delete known[predictionId]; });
+        delta.added.concat(delta.changed).forEach(function(prediction) { known[prediction.prediction_id] = true; });
+        return delta.order.every(function(predictionId) { return known[predictionId]; });
+    });
+}
 
-    setInterval(function() {
+/**
+ * Apply the changes since the version we last saw, or ask for the full board
+ * when they don't apply to what we have
+ * @param {object} data 
+ */
+function applyDelta(data)
+{
+    if (!deltaApplies(data)) {
+        board.version = null;
+        fetchPageInfo();
+        return;
+    }
+
+    renderClock(data);
+    board.version = data["version"];
+
+    Object.keys(stationBodies).forEach(function(station) {
+        var delta = data["delta"][station];
+        var state = board.stations[station];
+        delta.removed.forEach(function(predictionId) {
+            delete state.predictions[predictionId];
+        });
+        delta.added.concat(delta.changed).forEach(function(prediction) {
+            state.predictions[prediction.prediction_id] = prediction;
+        });
+        state.order = delta.order;
+        renderStation(station);
+    });
+}
+
+/**
+ * CSRF token sent with the /page-info/ requests
+ */
+var csrfToken = "";
+
+/**
+ * Ask /page-info/ for what changed since board.version, the full board when we have none
+ */
+function fetchPageInfo()
+{
     $.ajax({
-        headers: { "X-CSRFToken": cookie},
+        headers: { "X-CSRFToken": csrfToken},
         url: "/page-info/",
         type:"POST",
+        data: board.version === null ? {} : {version: board.version},
         success: function( data ) {
-            //console.log("yay")
-            document.getElementById('time').innerHTML = data["time"]
-            document.getElementById('date').innerHTML = data["date"]
-            document.getElementById('today').innerHTML = data["today"]
-            var predictionsNorth = data["north_station"];
-            var predictionsSouth = data["south_station"];
-            var endOfTrains = "<tr><td>No more commuter rails for the night!</th><td></td><td></td><td></td><td></td></tr>";
-
-            if ("north_station" in data && predictionsNorth !== null) {
-                var north_station_innerHTML = "";
-
-                Object.keys(predictionsNorth).forEach(function(key) {
-                    var prediction = predictionsNorth[key];
-                    var td_beg = "<td>";
-                    var td_end = "</td>";
-                    if (prediction.platform_code === null) {
-                        prediction.platform_code = "TBD"
-                    }
-                    var departure_time = td_beg + prediction.departure_time + td_end;
-                    var headsign = td_beg + prediction.headsign + td_end;
-                    var train_number = td_beg + prediction.train_number + td_end;
-                    var platform_code = td_beg + prediction.platform_code + td_end;
-                    var status = td_beg + prediction.status + td_end;
-                    var innerHTML = "<tr>" + departure_time + headsign + train_number + platform_code + status + "</tr>"
-                    north_station_innerHTML += innerHTML;
-                    //console.log(key, predictionsNorth[key]);
-                });
-
-                document.getElementById('northStationBody').innerHTML = north_station_innerHTML;
-            } 
-
-            if ("south_station" in data && predictionsSouth !== null) {
-                var south_station_innerHTML = "";
-
-                Object.keys(predictionsSouth).forEach(function(key) {
-                    var prediction = predictionsSouth[key];
-                    var td_beg = "<td>";
-                    var td_end = "</td>";
-                    if (prediction.platform_code === null) {
-                        prediction.platform_code = "TBD"
-                    }
-                    var departure_time = td_beg + prediction.departure_time + td_end;
-                    var headsign = td_beg + prediction.headsign + td_end;
-                    var train_number = td_beg + prediction.train_number + td_end;
-                    var platform_code = td_beg + prediction.platform_code + td_end;
-                    var status = td_beg + prediction.status + td_end;
-                    innerHTML = "<tr>" + departure_time + headsign + train_number + platform_code + status + "</tr>"
-                    if (prediction.headsign !== "" || prediction.headsign !== null) {
-                        south_station_innerHTML += innerHTML;
-                    }
-                    //console.log(key, predictionsSouth[key]);
-                });
-
-                document.getElementById('southStationBody').innerHTML = south_station_innerHTML;
-            } 
-
-            if (predictionsNorth === null) {
-                document.getElementById('northStationBody').innerHTML = endOfTrains;
-            } 
-
-            if (predictionsSouth === null) {
-                document.getElementById('southStationBody').innerHTML = endOfTrains;
+            if (data["not_modified"]) {
+                renderClock(data);
+            } else if ("delta" in data) {
+                applyDelta(data);
+            } else {
+                renderBoard(data);
             }
-
-            // M.toast({html: "Data Refreshed!"});
         },
         error: function(xhr, status, error) {
-            //console.log("error")
-            // M.toast({html: "There was an error!"});
             // Could have put cookie logic here, but then would fail first and then go here
         },
-        // dataType : "json"
-        }).done(function(data){
-            //Can do some extra work if needed...
-        });
-    }, 15 * 1000);
-});
\ No newline at end of file
+    });
+}
+
+/**
+ * Fallback for browsers without EventSource, polls /page-info/ every 15 seconds.
+ * The server only answers with what changed since board.version.
+ */
+function startPolling()
+{
+    setInterval(fetchPageInfo, 15 * 1000);
+}
+
+$(document).ready(function() {
+    /*** Live Board Updates
+     * The server pushes the board, or what changed in it, over Server-Sent Events (/board-stream/),
+     * heartbeats in between keep the clock up to date. EventSource reconnects on its own and
+     * resumes with the last version it saw. Browsers without EventSource fall back to polling.
+     */
+    csrfToken = getCookie("csrftoken");
+    if (csrfToken.length === 0) {
+        csrfToken = document.getElementById('cookieToken').innerHTML; //Handle weird situations where people don't have cookies enabled
+    }
+
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    var boardStream = new EventSource("/board-stream/");
+    boardStream.addEventListener("board", function(event) {
+        renderBoard(JSON.parse(event.data));
+    });
+    boardStream.addEventListener("delta", function(event) { //Only sent when we have the version it applies to
+        applyDelta(JSON.parse(event.data));
+    });
+    boardStream.addEventListener("heartbeat", function(event) {
+        renderClock(JSON.parse(event.data));
+    });
+    boardStream.onerror = function() {
+        if (boardStream.readyState === EventSource.CLOSED) { //The server refused the stream, don't leave the board frozen
+            boardStream.close();
+            startPolling();
+        }
+    };
+});